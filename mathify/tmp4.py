@@ -1,169 +1,1257 @@
+import mpmath
+import numpy as np
 import sympy as sp
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+import argparse
+import hashlib
+import json
+import math
+import os
 import random
+import re
+import resource
+import signal
+import sys
+import time
+from sympy.printing.latex import LatexPrinter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # Define the symbol
 x = sp.symbols('x')
 
 # Step 1: Generate More Complex Functions Randomly
-def generate_complex_function():
-    # Define possible function components
-    base_functions = [
-        lambda x: x**random.randint(2, 5),
-        lambda x: sp.exp(random.randint(2, 10)*x),
-        lambda x: sp.sin(random.randint(1, 10)*x),
-        lambda x: sp.cos(random.randint(1, 10)*x),
-        lambda x: sp.tan(random.randint(1, 10)*x),
-        lambda x: sp.log(x),
-        lambda x: sp.sqrt(x),
-        lambda x: sp.asin(x),
-        lambda x: sp.acos(x),
-        lambda x: sp.atan(x),
-        lambda x: sp.sinh(x),
-        lambda x: sp.cosh(x),
-        lambda x: sp.tanh(x),
-        lambda x: sp.erf(x),  # Error function
-    ]
-    
-
-    # Randomly generate a function consisting of a random 4 functions
-    num_terms = 4
-    f_xs = []
-    for _ in range(num_terms):
-        # Randomly select and compose functions
-        num_layers = random.randint(2, 10)  # Depth of composition
-        f_x = x
-        for _ in range(num_layers):
-            func = random.choice(base_functions)
-            f_x = func(f_x)
-
-    return f_x
+#
+# A function is a sum or product of terms, each term a composition of base
+# functions.  Its size is bounded by a count_ops budget and each composition
+# by a depth, which bounds the cost of differentiating and printing it.
+#
+# Problems are posed for x in x_interval.  Every family knows the interval
+# its argument must lie in and the image of an interval under it, so the
+# sampler tracks the range of the composition built so far and only draws
+# families that are real-valued on all of it: asin(exp(2*x)) is never
+# built, rather than built, differentiated and thrown away.
+
+x_interval = (0.0, 1.0)
+
+inf = math.inf
+
+def _image(f, lo, hi):
+    # Image of [lo, hi] under an increasing function.
+    def at(t):
+        try:
+            return f(t)
+        except OverflowError:
+            return math.copysign(inf, t)
+    return at(lo), at(hi)
+
+def _power_image(n, lo, hi):
+    def at(t):
+        try:
+            return t ** n
+        except OverflowError:
+            return math.copysign(inf, t) if n % 2 else inf
+    if n % 2 or lo >= 0:
+        return at(lo), at(hi)
+    if hi <= 0:
+        return at(hi), at(lo)
+    return 0.0, max(at(lo), at(hi))
+
+def _tan_image(lo, hi):
+    # tan is increasing between consecutive poles, at pi/2 + k*pi; None if
+    # [lo, hi] contains one.
+    if not (math.isfinite(lo) and math.isfinite(hi)):
+        return None
+    k = math.floor(lo / math.pi + 0.5)
+    if not (k - 0.5) * math.pi < lo <= hi < (k + 0.5) * math.pi:
+        return None
+    return math.tan(lo), math.tan(hi)
+
+def _cosh_image(lo, hi):
+    if lo >= 0:
+        return _image(math.cosh, lo, hi)
+    if hi <= 0:
+        return _image(math.cosh, -hi, -lo)
+    return 1.0, max(_image(math.cosh, 0, max(-lo, hi)))
+
+@dataclass(frozen=True)
+class Family:
+    name: str
+    weight: float
+    func: object                  # u -> sympy expression
+    domain: tuple = (-inf, inf)   # interval the argument must lie in
+    image: object = None          # (lo, hi) -> interval of the values, or None where undefined
+    scales: tuple = (1,)          # the argument is multiplied by one of these
+
+    def accepts(self, lo, hi):
+        return self.domain[0] <= lo and hi <= self.domain[1] and self.image(lo, hi) is not None
+
+    def valid_scales(self, interval):
+        return [scale for scale in self.scales if self.accepts(scale * interval[0], scale * interval[1])]
+
+def _power_family(n):
+    return Family(f"power{n}", 0.5, lambda u: u**n, image=lambda lo, hi: _power_image(n, lo, hi))
+
+families = [
+    *(_power_family(n) for n in range(2, 6)),
+    Family("exp", 1.0, sp.exp, image=lambda lo, hi: _image(math.exp, lo, hi), scales=tuple(range(2, 11))),
+    Family("sin", 2.0, sp.sin, image=lambda lo, hi: (-1.0, 1.0), scales=tuple(range(1, 11))),
+    Family("cos", 2.0, sp.cos, image=lambda lo, hi: (-1.0, 1.0), scales=tuple(range(1, 11))),
+    Family("tan", 1.0, sp.tan, image=_tan_image, scales=tuple(range(1, 11))),
+    # The smallest positive float as the bound keeps log's argument away from 0.
+    Family("log", 1.0, sp.log, (math.nextafter(0.0, 1.0), inf), lambda lo, hi: _image(math.log, lo, hi)),
+    Family("sqrt", 1.0, sp.sqrt, (0.0, inf), lambda lo, hi: _image(math.sqrt, lo, hi)),
+    Family("asin", 0.5, sp.asin, (-1.0, 1.0), lambda lo, hi: _image(math.asin, lo, hi)),
+    Family("acos", 0.5, sp.acos, (-1.0, 1.0), lambda lo, hi: _image(math.acos, lo, hi)[::-1]),
+    Family("atan", 1.0, sp.atan, image=lambda lo, hi: _image(math.atan, lo, hi)),
+    Family("sinh", 1.0, sp.sinh, image=lambda lo, hi: _image(math.sinh, lo, hi)),
+    Family("cosh", 1.0, sp.cosh, image=_cosh_image),
+    Family("tanh", 1.0, sp.tanh, image=lambda lo, hi: _image(math.tanh, lo, hi)),
+    Family("erf", 0.5, sp.erf, image=lambda lo, hi: _image(math.erf, lo, hi)),  # Error function
+]
+
+def compose(depth, max_ops, rng=random):
+    """A composition of up to `depth` base functions of x with at most `max_ops` operations, or None."""
+    f_x, interval = x, x_interval
+    for _ in range(depth):
+        candidates = [(family, scales) for family in families for scales in [family.valid_scales(interval)] if scales]
+        family, scales = rng.choices(candidates, weights=[family.weight for family, _ in candidates])[0]
+        scale = rng.choice(scales)
+        layer = family.func(scale * f_x)
+        if sp.count_ops(layer) > max_ops:
+            break
+        f_x = layer
+        interval = family.image(scale * interval[0], scale * interval[1])
+    return None if f_x is x else f_x
+
+def generate_complex_function(max_ops=30, max_depth=6, max_terms=3, product_weight=0.3, rng=random):
+    """A random sum or product of up to `max_terms` compositions, within a count_ops budget."""
+    terms = []
+    ops = 0
+    for _ in range(rng.randint(1, max_terms)):
+        # One more operation joins the term to the others.
+        term = compose(rng.randint(1, max_depth), max_ops - ops - len(terms), rng)
+        if term is None:
+            break
+        terms.append(term)
+        ops += sp.count_ops(term)
+    if not terms:
+        # Not even one layer fit the budget: take one regardless, built and
+        # checked like the others.
+        terms.append(compose(1, inf, rng))
+    f_x = terms[0]
+    for term in terms[1:]:
+        f_x = f_x * term if rng.random() < product_weight else f_x + term
+    return rebuild(f_x)
 
 # Step 2: Custom Differentiation Function with Step Recording
-def differentiate_with_steps(expr):
-    steps = []
-    
+#
+# Steps are recorded as structured records and only turned into text by
+# render_steps(), at serialization time.  A record has the rule that was
+# applied, the subexpression it was applied to, its derivative, the IDs of
+# the steps that derived its parts, and any intermediate results the rule
+# produced.  Steps are stored in the order the text used to be emitted, so
+# children always come before their parent.  A step can be the child of
+# several parents when the same subexpression occurs more than once.
+
+@dataclass(slots=True)
+class DiffStep:
+    id: int
+    rule: str
+    expr: sp.Basic
+    result: sp.Basic
+    children: tuple = ()
+    parts: dict = field(default_factory=dict)
+
+# Derivatives of outer functions, by expr.func: (f(u), f'(u)).  Filled the
+# first time each function is differentiated and shared by every problem.
+u = sp.Symbol('u')
+outer_derivatives = {}
+
+def outer_derivative(func):
+    entry = outer_derivatives.get(func)
+    if entry is None:
+        outer_func = func(u)
+        entry = outer_derivatives[func] = (outer_func, sp.diff(outer_func, u))
+    return entry
+
+def rebuild(expr, memo=None):
+    """`expr` constructed again bottom-up with evaluation, as sympify(srepr(expr)) does.
+
+    SymPy's automatic simplification is not idempotent: a product of
+    already-evaluated factors can keep a**2 and a**-2 side by side, which a
+    rebuild cancels.  Problems are rebuilt so that they render the same from
+    their dataset record as when they were made.
+    """
+    if expr.is_Atom:
+        return expr
+    memo = {} if memo is None else memo
+    result = memo.get(expr)
+    if result is None:
+        result = memo[expr] = expr.func(*(rebuild(arg, memo) for arg in expr.args))
+    return result
+
+def differentiate_with_steps(expr, steps=None, derived=None):
+    # Pass the steps and `derived` of an earlier call to continue it: new
+    # steps are appended and may refer to the earlier ones.
+    steps = [] if steps is None else steps
+    first = len(steps)
+    # (subexpression, variable) -> (derivative, step ID).  SymPy expressions
+    # are hashed structurally, so a subtree that occurs several times in a
+    # composition is differentiated once and later occurrences refer to
+    # its step.
+    derived = {} if derived is None else derived
+
+    def record(rule, expr, result, children=(), **parts):
+        steps.append(DiffStep(len(steps), rule, expr, result, tuple(children), parts))
+        return len(steps) - 1
+
+    # Returns (derivative, ID of the step that derived it).
     def diff(expr, var):
+        key = (expr, var)
+        if key not in derived:
+            derived[key] = derive(expr, var)
+        return derived[key]
+
+    def derive(expr, var):
         if expr.is_Atom:
             # Derivative of constants and variables
             if expr == var:
-                steps.append(f"The derivative of \( {sp.latex(expr)} \) with respect to \( {sp.latex(var)} \) is 1.")
-                return sp.Integer(1)
+                return sp.Integer(1), record("variable", expr, sp.Integer(1), var=var)
             else:
-                steps.append(f"The derivative of constant \( {sp.latex(expr)} \) is 0.")
-                return sp.Integer(0)
+                return sp.Integer(0), record("constant", expr, sp.Integer(0))
         elif expr.is_Add:
             # Sum rule
             derivatives = []
+            children = []
             for arg in expr.args:
-                derivative = diff(arg, var)
+                derivative, child = diff(arg, var)
                 derivatives.append(derivative)
+                children.append(child)
             result = sum(derivatives)
-            steps.append(f"Using sum rule, the derivative of \( {sp.latex(expr)} \) is \( {sp.latex(result)} \).")
-            return result
+            return result, record("sum", expr, result, children)
         elif expr.is_Mul:
             # Product rule
             terms = expr.args
             derivatives = []
+            children = []
             for i, term in enumerate(terms):
-                d_term = diff(term, var)
+                d_term, child = diff(term, var)
                 other_terms = sp.Mul(*(terms[:i] + terms[i+1:]))
                 derivative = d_term * other_terms
                 derivatives.append(derivative)
-                steps.append(f"Applying product rule, differentiating \( {sp.latex(term)} \), we get \( {sp.latex(derivative)} \).")
+                children.append(record("product_term", term, derivative, (child,), other_terms=other_terms))
             result = sum(derivatives)
-            steps.append(f"The derivative of the product \( {sp.latex(expr)} \) is \( {sp.latex(result)} \).")
-            return result
+            return result, record("product", expr, result, children)
         elif expr.is_Pow:
             # Power rule and chain rule
             base, exponent = expr.as_base_exp()
             if base.has(var) and exponent.has(var):
                 # Both base and exponent depend on var
                 derivative = sp.diff(expr, var)
-                steps.append(f"Derivative of \( {sp.latex(expr)} \) using general differentiation is \( {sp.latex(derivative)} \).")
-                return derivative
+                return derivative, record("general", expr, derivative)
             elif exponent.has(var):
                 # Exponent depends on variable
                 ln_base = sp.log(base)
-                d_exponent = diff(exponent, var)
+                d_exponent, child = diff(exponent, var)
                 derivative = expr * (ln_base * d_exponent)
-                steps.append(f"Using chain rule for exponent \( {sp.latex(exponent)} \), the derivative is \( {sp.latex(derivative)} \).")
-                return derivative
+                return derivative, record("exponent_chain", expr, derivative, (child,), exponent=exponent)
             elif base.has(var):
-                d_base = diff(base, var)
+                d_base, child = diff(base, var)
                 derivative = exponent * base**(exponent - 1) * d_base
-                steps.append(f"Using power rule, the derivative of \( {sp.latex(expr)} \) is \( {sp.latex(derivative)} \).")
-                return derivative
+                return derivative, record("power", expr, derivative, (child,))
             else:
-                steps.append(f"The derivative of constant \( {sp.latex(expr)} \) is 0.")
-                return sp.Integer(0)
+                return sp.Integer(0), record("constant", expr, sp.Integer(0))
         elif expr.is_Function:
             # Chain rule for functions
             inner = expr.args[0]
-            d_inner = diff(inner, var)
-            # Use a dummy symbol to compute the derivative of the outer function
-            u = sp.Symbol('u')
-            outer_func = expr.func(u)
-            derivative_outer = sp.diff(outer_func, u).subs(u, inner)
+            d_inner, child = diff(inner, var)
+            # Derivative of the outer function in a dummy symbol u
+            outer_func, d_outer = outer_derivative(expr.func)
+            derivative_outer = d_outer.subs(u, inner)
             derivative = derivative_outer * d_inner
-            steps.append(f"Using chain rule, the derivative of \( {sp.latex(expr)} \) is:")
-            steps.append(f"Compute the derivative of the outer function:")
-            steps.append(f"\( \\frac{{d}}{{du}} {sp.latex(outer_func)} = {sp.latex(sp.diff(outer_func, u))} \)")
-            steps.append(f"Substitute back \( u = {sp.latex(inner)} \):")
-            steps.append(f"\( \\frac{{d}}{{du}} {sp.latex(outer_func)} \\bigg|_{{u={sp.latex(inner)}}} = {sp.latex(derivative_outer)} \)")
-            steps.append(f"Multiply by the derivative of the inner function:")
-            steps.append(f"\( {sp.latex(derivative_outer)} \\times {sp.latex(d_inner)} = {sp.latex(derivative)} \)")
-            return derivative
+            return derivative, record("chain", expr, derivative, (child,), inner=inner, d_inner=d_inner,
+                                      outer_func=outer_func, outer_derivative=d_outer,
+                                      derivative_outer=derivative_outer)
         else:
             derivative = sp.diff(expr, var)
-            steps.append(f"Derivative of \( {sp.latex(expr)} \) is \( {sp.latex(derivative)} \).")
-            return derivative
-        
-    derivative = diff(expr, x)
-    return derivative, steps
-
-# Step 3: Reverse Differentiation Steps to Simulate Integration Steps
-def reverse_steps(steps):
-    reversed_steps = steps[::-1]
-    integration_steps = []
-    for step in reversed_steps:
-        # Reverse the logic of differentiation steps to integration steps
-        if "derivative of constant" in step:
-            integration_steps.append(step.replace("derivative of constant", "integral of zero is constant").replace("is 0", "is a constant"))
-        elif "Compute the derivative of the outer function" in step:
-            integration_steps.append(step.replace("Compute the derivative of the outer function", "Find the antiderivative of the outer function"))
-        elif "Using chain rule" in step:
-            integration_steps.append(step.replace("Using chain rule, the derivative", "Using substitution, the integral"))
-        elif "Applying product rule" in step:
-            integration_steps.append(step.replace("Applying product rule, differentiating", "Using integration by parts on"))
-        elif "Using sum rule" in step:
-            integration_steps.append(step.replace("Using sum rule, the derivative", "Using linearity, the integral"))
-        elif "power rule" in step:
-            integration_steps.append(step.replace("Using power rule, the derivative", "Using power rule, the integral"))
+            return derivative, record("fallback", expr, derivative)
+
+    derivative, _ = diff(expr, x)
+    memo = {}
+    for step in steps[first:]:
+        step.expr, step.result = rebuild(step.expr, memo), rebuild(step.result, memo)
+        step.parts = {name: rebuild(value, memo) for name, value in step.parts.items()}
+    return rebuild(derivative, memo), steps
+
+# LaTeX printing is the most expensive part of rendering, and the same
+# subexpressions recur across the steps of a problem (the inner function of
+# one chain step is the expression of the next, the result of the last step
+# is f'(x)).  LatexCache memoizes the LaTeX of every subexpression it
+# prints, not only of whole expressions, so a deep composition is printed
+# once and its subtrees are looked up afterwards.
+
+class _CachingLatexPrinter(LatexPrinter):
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def _print(self, expr, **kwargs):
+        # Keyword arguments (such as exp= for powers of functions) change
+        # the output, so only plain calls are cached.
+        if kwargs or not isinstance(expr, sp.Basic):
+            return super()._print(expr, **kwargs)
+        text = self.cache.get(expr)
+        if text is None:
+            text = super()._print(expr)
+            self.cache.put(expr, text)
+        return text
+
+class LatexCache:
+    """sp.latex() with memoized subexpressions.
+
+    Use one per problem (maxsize=None, dropped with the problem), or one
+    per worker with an LRU bound across problems.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = {} if maxsize is None else OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.printer = _CachingLatexPrinter(self)
+
+    def get(self, expr):
+        text = self.entries.get(expr)
+        if text is None:
+            self.misses += 1
         else:
-            integration_steps.append(step.replace("derivative", "integral").replace("Derivative", "Integral"))
+            self.hits += 1
+            if self.maxsize is not None:
+                self.entries.move_to_end(expr)
+        return text
+
+    def put(self, expr, text):
+        self.entries[expr] = text
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __call__(self, expr):
+        return self.printer.doprint(expr)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# Text of each kind of step.  Fields name attributes of the step or entries
+# of its parts; "{o}" and "{c}" open and close inline math.
+math_templates = {
+    "variable": ["The derivative of {o} {expr} {c} with respect to {o} {var} {c} is 1."],
+    "constant": ["The derivative of constant {o} {expr} {c} is 0."],
+    "sum": ["Using sum rule, the derivative of {o} {expr} {c} is {o} {result} {c}."],
+    "product_term": ["Applying product rule, differentiating {o} {expr} {c}, we get {o} {result} {c}."],
+    "product": ["The derivative of the product {o} {expr} {c} is {o} {result} {c}."],
+    "general": ["Derivative of {o} {expr} {c} using general differentiation is {o} {result} {c}."],
+    "exponent_chain": ["Using chain rule for exponent {o} {exponent} {c}, the derivative is {o} {result} {c}."],
+    "power": ["Using power rule, the derivative of {o} {expr} {c} is {o} {result} {c}."],
+    "chain": ["Using chain rule, the derivative of {o} {expr} {c} is:",
+              "Compute the derivative of the outer function:",
+              "{o} \\frac{{d}}{{du}} {outer_func} = {outer_derivative} {c}",
+              "Substitute back {o} u = {inner} {c}:",
+              "{o} \\frac{{d}}{{du}} {outer_func} \\bigg|_{{u={inner}}} = {derivative_outer} {c}",
+              "Multiply by the derivative of the inner function:",
+              "{o} {derivative_outer} \\times {d_inner} = {result} {c}"],
+    "fallback": ["Derivative of {o} {expr} {c} is {o} {result} {c}."],
+}
+
+plain_templates = dict(math_templates, chain=[
+    "Using chain rule, the derivative of {expr} is:",
+    "Compute the derivative of the outer function:",
+    "d/du {outer_func} = {outer_derivative}",
+    "Substitute back u = {inner}:",
+    "d/du {outer_func} at u = {inner} is {derivative_outer}",
+    "Multiply by the derivative of the inner function:",
+    "{derivative_outer} * {d_inner} = {result}"])
+
+# style -> (templates, whether expressions print as LaTeX, math delimiters)
+styles = {
+    "markdown": (math_templates, True, ("\\(", "\\)")),
+    "latex": (math_templates, True, ("$", "$")),
+    "plain": (plain_templates, False, ("", "")),
+}
+
+# style -> (heading, label, display math) of the problem text around the
+# steps, as format strings.
+layouts = {
+    "markdown": ("### {}", "**{}**", "$$ {} $$"),
+    "latex": ("\\subsection*{{{}}}", "\\textbf{{{}}}", "\\[ {} \\]"),
+    "plain": ("{}", "{}", "{}"),
+}
+
+def _layout(style, latex=None):
+    # (expression printer, heading, label, display math, inline math) of a style.
+    _, uses_latex, (o, c) = styles[style]
+    printer = (latex or LatexCache()) if uses_latex else str
+    heading, label, display = layouts[style]
+    inline = (lambda text: f"{o} {text} {c}") if o else str
+    return printer, heading.format, label.format, display.format, inline
+
+class _Fields(dict):
+    # Renders a field the first time a template asks for it.
+    def __init__(self, step, printer, delimiters):
+        super().__init__(o=delimiters[0], c=delimiters[1])
+        self.step = step
+        self.printer = printer
+
+    def __missing__(self, name):
+        value = self.step.parts[name] if name in self.step.parts else getattr(self.step, name)
+        self[name] = text = self.printer(value)
+        return text
+
+def render_steps(steps, style="markdown", latex=None, templates=None):
+    """The text of differentiation steps, one line per entry, in the given style.
+
+    `latex` prints expressions for the LaTeX styles; pass a LatexCache to
+    share it with the rest of the problem or across problems.  `templates`
+    replaces the style's differentiation templates.
+    """
+    default_templates, uses_latex, delimiters = styles[style]
+    templates = templates or default_templates
+    printer = (latex or LatexCache()) if uses_latex else str
+    lines = []
+    for step in steps:
+        fields = _Fields(step, printer, delimiters)
+        lines.extend(template.format_map(fields) for template in templates[step.rule])
+    if style == "plain":
+        lines = [re.sub(r" ([,.:])", r"\1", " ".join(line.split())) for line in lines]
+    return lines
+
+# Step 3: Invert Differentiation Steps into Integration Steps
+#
+# Every differentiation rule has an integration counterpart, read in the
+# other direction: the chain rule becomes a substitution, the product rule
+# integration by parts, the sum rule linearity.  The integrand of an
+# integration step is the result of the differentiation step it inverts and
+# its antiderivative is that step's expression.  The derivation is a tree
+# with the same shape as the differentiation, and is printed from the whole
+# integrand down to its parts.
+
+@dataclass(slots=True)
+class IntegrationStep:
+    id: int
+    rule: str
+    integrand: sp.Basic
+    antiderivative: sp.Basic
+    children: tuple = ()
+    parts: dict = field(default_factory=dict)
+
+# Differentiation rule -> integration rule.  The terms of a product are
+# folded into its by-parts step (None): the product is integrated as a
+# whole, not one factor at a time.
+inverse_rules = {
+    "variable": "variable",
+    "constant": "constant",
+    "sum": "linearity",
+    "product_term": None,
+    "product": "by_parts",
+    "general": "direct",
+    "exponent_chain": "exponent_substitution",
+    "power": "power",
+    "chain": "substitution",
+    "fallback": "direct",
+}
+
+def invert_steps(steps):
+    """The integration steps that undo `steps`, by step ID; the last one is the root."""
+    integration_steps = []
+    for step in steps:
+        rule, children = inverse_rules[step.rule], step.children
+        if rule == "by_parts":
+            # A product with a single non-constant factor is a constant
+            # multiple, not a case for integration by parts.
+            varying = tuple(child for child in children if steps[child].result != 0)
+            if len(varying) <= 1:
+                rule, children = "constant_multiple", varying
+        elif rule == "substitution" and step.parts["inner"] == x:
+            # u = x substitutes nothing: the outer function is a standard integral.
+            rule, children = "standard", ()
+        elif rule == "power" and step.expr.base == x:
+            children = ()
+        integration_steps.append(IntegrationStep(step.id, rule, step.result, step.expr, children, step.parts))
     return integration_steps
 
-# Step 4: Automate the Entire Process
-def generate_problem():
-    # Generate a complex function f(x)
-    f_x = generate_complex_function()
-    
+def derivation_order(integration_steps):
+    """The steps of the derivation, outermost first, each shared step once."""
+    order = []
+    seen = set()
+    stack = [len(integration_steps) - 1]
+    while stack:
+        step = integration_steps[stack.pop()]
+        if step.id in seen:
+            continue
+        seen.add(step.id)
+        if step.rule is not None:
+            order.append(step)
+        stack.extend(reversed(step.children))
+    return order
+
+integration_math_templates = {
+    "variable": ["The integral of 1 with respect to {o} {var} {c} is {o} {var} {c}."],
+    "constant": ["The integral of 0 is a constant, here {o} {antiderivative} {c}."],
+    "linearity": ["Using linearity, the integral of {o} {integrand} {c} is the sum of the integrals of its terms, "
+                  "{o} {antiderivative} {c}."],
+    "by_parts": ["Using integration by parts, the integral of {o} {integrand} {c} is {o} {antiderivative} {c}."],
+    "constant_multiple": ["Taking out the constant factor, the integral of {o} {integrand} {c} is "
+                          "{o} {antiderivative} {c}."],
+    "standard": ["The integral of {o} {integrand} {c} is the standard integral {o} {antiderivative} {c}."],
+    "direct": ["The integral of {o} {integrand} {c} is {o} {antiderivative} {c}."],
+    "exponent_substitution": ["Using substitution for the exponent {o} {exponent} {c}, "
+                              "the integral of {o} {integrand} {c} is {o} {antiderivative} {c}."],
+    "power": ["Using power rule, the integral of {o} {integrand} {c} is {o} {antiderivative} {c}."],
+    "substitution": ["Using substitution, the integral of {o} {integrand} {c} is:",
+                     "Substitute {o} u = {inner} {c}, so that {o} du = {d_inner} \\, dx {c}.",
+                     "Find the antiderivative of the outer function:",
+                     "{o} \\int {outer_derivative} \\, du = {outer_func} {c}",
+                     "Substitute back {o} u = {inner} {c}:",
+                     "{o} \\int {integrand} \\, dx = {antiderivative} {c}"],
+}
+
+integration_plain_templates = dict(integration_math_templates, substitution=[
+    "Using substitution, the integral of {integrand} is:",
+    "Substitute u = {inner}, so that du = {d_inner} dx.",
+    "Find the antiderivative of the outer function:",
+    "integral of {outer_derivative} du = {outer_func}",
+    "Substitute back u = {inner}:",
+    "integral of {integrand} dx = {antiderivative}"])
+
+integration_templates = {"markdown": integration_math_templates, "latex": integration_math_templates,
+                         "plain": integration_plain_templates}
+
+def render_integration(steps, style="markdown", latex=None):
+    """The text of the integration derivation that undoes differentiation `steps`."""
+    return render_steps(derivation_order(invert_steps(steps)), style, latex, integration_templates[style])
+
+# Step 4: Check the Final Answer Numerically
+#
+# f and f' are lambdified to NumPy once and compared on a batch of points
+# inside x_interval.  The reference derivative is the complex step
+# Im f(t + ih) / h, which unlike a finite difference has no cancellation,
+# so it is accurate to rounding even for the steepest compositions, and
+# needs no symbolic differentiation.  Points where f or f' is not finite
+# or not real (outside the real domain of the function, at a pole) are
+# masked out rather than counted as failures, and so are points where f'
+# is too ill-conditioned to compare: where moving t by a relative 1e-12
+# moves f'(t) by more than the tolerance, two correct forms of f' can
+# disagree by just as much.  Points that still disagree in double
+# precision are checked again with mpmath at 50 digits, against
+# mpmath.diff, before they count as failures: cancellation inside one form
+# of f' (1 - tanh(u)**2 near u = oo) and complex steps through asin near 1
+# would flag correct answers otherwise.
+
+def _erf(z):
+    # NumPy has no erf.  For a complex step the first-order expansion
+    # erf(a + ib) = erf(a) + ib erf'(a) is exact to rounding.
+    if np.iscomplexobj(z):
+        a = z.real
+        return _real_erf(a) + 1j * z.imag * (2 / math.sqrt(math.pi)) * np.exp(-a * a)
+    return _real_erf(z)
+
+_real_erf = np.vectorize(math.erf, otypes=[float])
+
+# lambdify looks names up here before NumPy.
+numpy_functions = {"erf": _erf}
+
+def _lambdify(expr):
+    return sp.lambdify(x, expr, [numpy_functions, "numpy"])
+
+def _real(values, shape):
+    values = np.broadcast_to(np.asarray(values), shape)
+    if np.iscomplexobj(values):
+        real = np.abs(values.imag) <= 1e-12 * np.maximum(1.0, np.abs(values.real))
+        values = np.where(real, values.real, np.nan)
+    return values.astype(float)
+
+def verify_problem(problem, samples=64, rtol=1e-6, atol=1e-9, seed=0):
+    """Whether f' matches the derivative of f numerically on x_interval.
+
+    Returns {"ok", "points", "failures", "max_error"}: "points" is how many
+    sample points were in the real domain of both sides and well enough
+    conditioned to compare, and "ok" is None when there were none.
+    """
+    points = _points(samples, seed)
+    return _compare(problem, points, _sample(problem["f"], points), _sample(problem["f_prime"], points), rtol, atol)
+
+def _points(samples, seed):
+    return np.random.default_rng(seed).uniform(*x_interval, samples)
+
+def _sample(expr, points, h=1e-30):
+    # (values, complex-step derivative, values at slightly moved points) of
+    # expr, from a single lambdify: everything either side of a comparison needs.
+    with np.errstate(all="ignore"):
+        f = _lambdify(expr)
+        values = _real(f(points), points.shape)
+        stepped = np.broadcast_to(np.asarray(f(points + 1j * h), dtype=complex), points.shape)
+        derivative = stepped.imag / h
+        nudged = _real(f(points * (1 + 1e-12)), points.shape)
+    return values, derivative, nudged
+
+def _compare(problem, points, f_sample, f_prime_sample, rtol, atol):
+    # verify_problem on samples of problem["f"] and problem["f_prime"].
+    values, expected, _ = f_sample
+    actual, _, nudged = f_prime_sample
+    with np.errstate(all="ignore"):
+        stable = np.abs(nudged - actual) <= rtol * np.abs(actual) + atol
+        valid = np.isfinite(values) & stable & np.isfinite(expected) & np.isfinite(actual)
+        error = np.abs(expected - actual)[valid]
+        bad = error > rtol * np.abs(expected[valid]) + atol
+    if bad.any():
+        suspects = np.flatnonzero(valid)[bad]
+        confirmed = _disagree_precisely(problem, points[suspects], rtol, atol)
+        error[np.flatnonzero(bad)[~confirmed]] = 0.0
+        bad[np.flatnonzero(bad)[~confirmed]] = False
+    return {"ok": bool(not bad.any()) if valid.any() else None, "points": int(valid.sum()),
+            "failures": int(bad.sum()), "max_error": float(error.max()) if valid.any() else None}
+
+def _disagree_precisely(problem, points, rtol, atol, digits=50):
+    """Which of `points` still fail the comparison at `digits` significant digits.
+
+    Stops at the first confirmed failure and counts the points after it as
+    failing too: a wrong answer is rejected after one slow evaluation.
+    """
+    with mpmath.workdps(digits):
+        f = sp.lambdify(x, problem["f"], "mpmath")
+        f_prime = sp.lambdify(x, problem["f_prime"], "mpmath")
+        disagree = np.ones(len(points), dtype=bool)
+        for i, t in enumerate(points):
+            t = mpmath.mpf(float(t))
+            expected = mpmath.re(mpmath.diff(f, t))
+            actual = mpmath.re(f_prime(t))
+            disagree[i] = abs(expected - actual) > rtol * abs(expected) + atol
+            if disagree[i]:
+                break
+    return disagree
+
+# Step 5: Automate the Entire Process
+def build_problem(verify=False, **budget):
+    # Generate a complex function f(x) within the budget (see generate_complex_function)
+    f_x = generate_complex_function(**budget)
+
     # Differentiate f(x) with steps
     f_prime, diff_steps = differentiate_with_steps(f_x)
-    
-    # Reverse the differentiation steps to simulate integration steps
-    integration_steps = reverse_steps(diff_steps)
-    
+
+    problem = {"task": "integration", "f": f_x, "f_prime": f_prime, "steps": diff_steps}
+    if verify:
+        problem["verification"] = verify_problem(problem)
+    return problem
+
+def format_problem(problem, style="markdown", latex=None):
+    show, heading, label, display, _ = _layout(style, latex)
+    # Invert the differentiation steps into integration steps
+    integration_steps = render_integration(problem["steps"], style, show)
+    lines = [heading("Integration Problem") + "\n",
+             f"Given the derivative:\n",
+             display(f"f'(x) = {show(problem['f_prime'])}") + "\n",
+             label("Chain-of-Thought Solution:") + "\n"]
+    lines += [f"{step}\n" for step in integration_steps]
+    lines += [label("Final Answer:") + "\n",
+              display(f"f(x) = {show(problem['f'])} + C") + "\n",
+              "=" * 80]
+    return "\n".join(lines)
+
+def generate_problem(task="integration", **budget):
     # Output the problem and solutions
-    print("### Integration Problem\n")
-    print(f"Given the derivative:\n")
-    print(f"$$ f'(x) = {sp.latex(f_prime)} $$\n")
-    print("**Chain-of-Thought Solution:**\n")
-    for step in integration_steps:
-        print(f"{step}\n")
-    print(f"**Final Answer:**\n")
-    print(f"$$ f(x) = {sp.latex(f_x)} + C $$\n")
-    print("="*80)
-
-# Generate a single problem for testing
-generate_problem()
+    print(formatters[task](builders[task](**budget)))
+
+def latex_benchmark(depths=(4, 6, 8), count=5, seed=0):
+    """Seconds to render the steps of deep compositions with plain sp.latex and with a LatexCache."""
+    rng = random.Random(seed)
+    layers = [sp.sin, sp.cos, sp.tanh, sp.sinh, sp.atan, sp.erf, sp.sqrt, lambda u: u**3, lambda u: sp.exp(2*u)]
+    results = []
+    for depth in depths:
+        problems = []
+        for _ in range(count):
+            f_x = x
+            for _ in range(depth):
+                f_x = rng.choice(layers)(f_x)
+            problems.append(differentiate_with_steps(f_x)[1])
+        start = time.perf_counter()
+        for steps in problems:
+            render_steps(steps, latex=sp.latex)
+        uncached = time.perf_counter() - start
+        caches = [LatexCache() for _ in problems]
+        start = time.perf_counter()
+        for steps, cache in zip(problems, caches):
+            render_steps(steps, latex=cache)
+        cached = time.perf_counter() - start
+        hits = sum(cache.hits for cache in caches)
+        total = hits + sum(cache.misses for cache in caches)
+        results.append({"depth": depth, "uncached_s": uncached, "cached_s": cached, "hit_rate": hits / total})
+    return results
+
+# Step 6: Higher Derivatives and Differential Equations
+#
+# The k-th derivative is differentiated from the (k-1)-th, not from f: the
+# orders continue one list of steps and one memo of derived
+# subexpressions, so a subexpression that reappears in a later derivative
+# (cos(x), from sin(x)' = cos(x), inside sin(x)'') is derived once for all
+# orders.  order_ends[k - 1] is where the steps of the k-th derivative end.
+#
+# An ODE problem is sum_k a_k y^(k) = g(x) with integer coefficients and
+# a_n = 1, where g is that operator applied to f, so f is a solution.
+
+def derivatives_with_steps(expr, n):
+    """([f', ..., f^(n)], steps, order_ends) for f = expr."""
+    steps, derived = [], {}
+    derivatives, order_ends = [], []
+    for _ in range(n):
+        expr, _ = differentiate_with_steps(expr, steps, derived)
+        derivatives.append(expr)
+        order_ends.append(len(steps))
+    return derivatives, steps, order_ends
+
+def _combine_verifications(results):
+    known = [result for result in results if result["ok"] is not None]
+    return {"ok": all(result["ok"] for result in known) if known else None,
+            "points": min((result["points"] for result in known), default=0),
+            "failures": sum(result["failures"] for result in known),
+            "max_error": max((result["max_error"] for result in known), default=None)}
+
+def _verify_chain(chain, points, rtol, atol):
+    # verify_problem for each consecutive pair of the chain, combined, and
+    # the samples of its members: each is lambdified once, not once per pair.
+    samples = [_sample(expr, points) for expr in chain]
+    return _combine_verifications([_compare({"f": f, "f_prime": f_prime}, points, a, b, rtol, atol)
+                                   for f, f_prime, a, b in zip(chain, chain[1:], samples, samples[1:])]), samples
+
+def verify_derivatives(f_x, derivatives, samples=64, rtol=1e-6, atol=1e-9, seed=0):
+    """verify_problem for each consecutive pair of f, f', ..., f^(n), combined."""
+    return _verify_chain([f_x] + derivatives, _points(samples, seed), rtol, atol)[0]
+
+def verify_ode(problem, samples=64, rtol=1e-6, atol=1e-9, seed=0):
+    """Whether f satisfies the ODE: the derivative chain checks, and sum_k a_k f^(k) - g vanishes numerically.
+
+    g is read back from its srepr, as a dataset stores it; the g in memory
+    is that very sum, so comparing with it would check nothing.
+    """
+    points = _points(samples, seed)
+    chain = [problem["f"]] + problem["derivatives"]
+    derivatives, chain_samples = _verify_chain(chain, points, rtol, atol)
+    stored = sp.sympify(sp.srepr(problem["rhs"]))
+    with np.errstate(all="ignore"):
+        terms = np.array([a * values for a, (values, _, _) in zip(problem["coefficients"], chain_samples)])
+        rhs = _real(_lambdify(stored)(points), points.shape)
+        valid = np.isfinite(terms).all(axis=0) & np.isfinite(rhs)
+        residual = np.abs(terms.sum(axis=0) - rhs)[valid]
+        bad = residual > rtol * np.abs(terms).sum(axis=0)[valid] + atol
+    substitution = {"ok": bool(not bad.any()) if valid.any() else None, "points": int(valid.sum()),
+                    "failures": int(bad.sum()), "max_error": float(residual.max()) if valid.any() else None}
+    return _combine_verifications([derivatives, substitution])
+
+def build_derivative_problem(verify=False, order=2, **budget):
+    f_x = generate_complex_function(**budget)
+    derivatives, steps, order_ends = derivatives_with_steps(f_x, order)
+    problem = {"task": "derivative", "f": f_x, "f_prime": derivatives[0], "derivatives": derivatives,
+               "steps": steps, "order_ends": order_ends}
+    if verify:
+        problem["verification"] = verify_derivatives(f_x, derivatives)
+    return problem
+
+def build_ode_problem(verify=False, order=2, **budget):
+    problem = build_derivative_problem(order=order, **budget)
+    problem["task"] = "ode"
+    # a_0 .. a_n, the coefficient of y^(k) at index k.
+    coefficients = [random.randint(-5, 5) for _ in range(order)] + [1]
+    chain = [problem["f"]] + problem["derivatives"]
+    problem["coefficients"] = coefficients
+    problem["rhs"] = rebuild(sp.Add(*(a * y for a, y in zip(coefficients, chain))))
+    if verify:
+        problem["verification"] = verify_ode(problem)
+    return problem
+
+def _prime(k, style="markdown"):
+    if k <= 3:
+        return "y" + "'" * k
+    return f"y^({k})" if style == "plain" else f"y^{{({k})}}"
+
+def ode_operator(coefficients, style="markdown"):
+    """sum_k a_k y^(k), highest order first, as LaTeX (or text in the plain style)."""
+    text = ""
+    for k in reversed(range(len(coefficients))):
+        a = coefficients[k]
+        if a == 0:
+            continue
+        sign = "-" if a < 0 else "+"
+        factor = "" if abs(a) == 1 else f"{abs(a)} "
+        prime = _prime(k, style)
+        text += f" {sign} {factor}{prime}" if text else f"{'-' if a < 0 else ''}{factor}{prime}"
+    return text
+
+def _derivative_lines(problem, style, show, label, display):
+    lines = []
+    start = 0
+    for k, end in enumerate(problem["order_ends"], 1):
+        lines.append(label(f"Derivative {k}:") + "\n")
+        lines += [f"{step}\n" for step in render_steps(problem["steps"][start:end], style, show)]
+        lines.append(display(f"{_prime(k, style).replace('y', 'f', 1)}(x) = {show(problem['derivatives'][k - 1])}")
+                     + "\n")
+        start = end
+    return lines
+
+def format_derivative_problem(problem, style="markdown", latex=None):
+    show, heading, label, display, _ = _layout(style, latex)
+    n = len(problem["derivatives"])
+    lines = [heading("Higher Derivative Problem") + "\n",
+             f"Find derivative {n} of:\n",
+             display(f"f(x) = {show(problem['f'])}") + "\n",
+             label("Chain-of-Thought Solution:") + "\n"]
+    lines += _derivative_lines(problem, style, show, label, display)
+    lines += ["=" * 80]
+    return "\n".join(lines)
+
+def format_ode_problem(problem, style="markdown", latex=None):
+    show, heading, label, display, inline = _layout(style, latex)
+    lines = [heading("Differential Equation Problem") + "\n",
+             "Find a solution of:\n",
+             display(f"{ode_operator(problem['coefficients'], style)} = {show(problem['rhs'])}") + "\n",
+             label("Chain-of-Thought Solution:") + "\n",
+             "Try " + inline(f"y = {show(problem['f'])}") + " and differentiate it.\n"]
+    lines += _derivative_lines(problem, style, show, label, display)
+    lines += ["Substituting " + inline("y")
+              + " and its derivatives into the left-hand side gives the right-hand side.\n",
+              label("Final Answer:") + "\n",
+              display(f"y(x) = {show(problem['f'])}") + "\n",
+              "=" * 80]
+    return "\n".join(lines)
+
+builders = {"integration": build_problem, "derivative": build_derivative_problem, "ode": build_ode_problem}
+formatters = {"integration": format_problem, "derivative": format_derivative_problem, "ode": format_ode_problem}
+
+# Step 7: Generate many problems in a process pool
+#
+# Each worker solves one problem at a time.  A problem that runs past its
+# wall-clock timeout gets its worker killed and replaced, since SymPy cannot
+# be interrupted from the outside; a problem that hits the memory limit fails
+# with MemoryError inside the worker.  Either way the problem is recorded as
+# skipped and the batch carries on.  Workers share nothing, so throughput
+# scales with the number of workers.
+
+def problem_seed(seed, index):
+    # Problem `index` is reproducible on its own, whichever worker runs it.
+    return f"{seed}:{index}"
+
+def _worker(conn, seed, memory_mb, task, budget, serialize):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        index = conn.recv()
+        if index is None:
+            return
+        random.seed(problem_seed(seed, index))
+        start = time.perf_counter()
+        try:
+            problem, status = builders[task](verify=True, **budget), "ok"
+            if serialize:
+                problem = problem_record(problem)
+        except MemoryError:
+            problem, status = None, "memory"
+        except Exception as e:
+            problem, status = None, f"error: {e!r}"
+        elapsed = time.perf_counter() - start
+        # send() pickles the whole message before writing any of it, so a
+        # problem too large to pickle under the memory limit leaves the pipe
+        # clean for a status-only reply.
+        try:
+            conn.send((index, status, problem, elapsed))
+        except MemoryError:
+            problem = None
+            conn.send((index, "memory", None, elapsed))
+        except Exception as e:
+            conn.send((index, f"error: {e!r}", None, elapsed))
+
+class _Slot:
+    def __init__(self, seed, memory_mb, task, budget, serialize):
+        self.conn, child = Pipe()
+        self.process = Process(target=_worker, args=(child, seed, memory_mb, task, budget, serialize), daemon=True)
+        self.process.start()
+        child.close()
+        self.index = None
+        self.deadline = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+def iter_problems(indices, workers=os.cpu_count(), timeout_s=60.0, seed=0, memory_mb=2048, budget=None,
+                  serialize=False, task="integration"):
+    """Generate the problems with the given indices, yielding one record per problem as it finishes.
+
+    `task` names the builder (see builders) and `budget` holds its keyword
+    arguments: those of generate_complex_function, and `order` for the
+    derivative and ODE tasks.
+
+    A record has the index, a status ("ok", "timeout", "memory", "crashed" or
+    "error: ..."), the problem (None unless ok) and the seconds it took.
+    Problems carry the result of verify_problem under "verification".  With
+    `serialize` the worker turns each problem into a dataset record (see
+    problem_record) and that record is the problem.
+    """
+    pending = deque(indices)
+    remaining = len(pending)
+    options = (seed, memory_mb, task, budget or {}, serialize)
+    slots = [_Slot(*options) for _ in range(min(workers, remaining))]
+    try:
+        while remaining:
+            for slot in slots:
+                if slot.index is None and pending:
+                    slot.index = pending.popleft()
+                    slot.deadline = time.monotonic() + timeout_s
+                    slot.conn.send(slot.index)
+            busy = [slot for slot in slots if slot.index is not None]
+            timeout = max(0.0, min(slot.deadline for slot in busy) - time.monotonic())
+            ready = wait([slot.conn for slot in busy], timeout)
+            for i, slot in enumerate(slots):
+                if slot.index is None:
+                    continue
+                if slot.conn in ready:
+                    try:
+                        index, status, problem, elapsed = slot.conn.recv()
+                    except EOFError:
+                        # The worker died, e.g. killed by the OOM killer.
+                        record = {"index": slot.index, "status": "crashed", "problem": None,
+                                  "elapsed_s": timeout_s - (slot.deadline - time.monotonic())}
+                        slot.kill()
+                        slots[i] = _Slot(*options)
+                    else:
+                        record = {"index": index, "status": status, "problem": problem, "elapsed_s": elapsed}
+                        slot.index = None
+                elif time.monotonic() >= slot.deadline:
+                    record = {"index": slot.index, "status": "timeout", "problem": None, "elapsed_s": timeout_s}
+                    slot.kill()
+                    slots[i] = _Slot(*options)
+                else:
+                    continue
+                remaining -= 1
+                yield record
+    finally:
+        for slot in slots:
+            if slot.index is None and slot.process.is_alive():
+                slot.conn.send(None)
+            else:
+                slot.process.kill()
+            slot.process.join()
+
+def generate_problems(n, workers=os.cpu_count(), timeout_s=60.0, seed=0, memory_mb=2048, budget=None,
+                      task="integration"):
+    """Generate problems 0..n-1; returns one record per problem in index order (see iter_problems)."""
+    records = {record["index"]: record for record in iter_problems(range(n), workers, timeout_s, seed, memory_mb,
+                                                                     budget, task=task)}
+    return [records[index] for index in range(n)]
+
+# Step 8: Store problems as a dataset
+#
+# A dataset is a directory of shards plus manifest.json.  Shard i holds the
+# problems with indices [i * shard_size, (i + 1) * shard_size) that were
+# generated successfully, in index order, as JSON lines or Parquet.  A shard
+# is written once all of its problems are done, to a temporary name that is
+# then renamed, and only then added to the manifest; an interrupted run is
+# resumed by skipping the shards the manifest lists.  Expressions are stored
+# as srepr, which sp.sympify reads back exactly, and as LaTeX.  Markdown is
+# rendered from stored records by a separate pass (render_dataset).
+
+def _expression(expr, latex):
+    return {"srepr": sp.srepr(expr), "latex": latex(expr)}
+
+def _depth(expr):
+    return 1 + max((_depth(arg) for arg in expr.args), default=0)
+
+def problem_features(problem):
+    """Difficulty features of a problem."""
+    rules = {}
+    for step in problem["steps"]:
+        rules[step.rule] = rules.get(step.rule, 0) + 1
+    return {"ops": int(sp.count_ops(problem["f"])),
+            "ops_derivative": int(sp.count_ops(problem.get("derivatives", [problem["f_prime"]])[-1])),
+            "depth": _depth(problem["f"]),
+            "steps": len(problem["steps"]),
+            "rules": rules,
+            "functions": sorted({type(f).__name__ for f in problem["f"].atoms(sp.Function)})}
+
+# The expression a problem is posed with, which deduplication is keyed on.
+questions = {"integration": "f_prime", "derivative": "f", "ode": "rhs"}
+
+def problem_record(problem, latex=None):
+    """A problem as a JSON-compatible dataset record."""
+    latex = latex or LatexCache()
+    question = problem[questions[problem["task"]]]
+    record = {"task": problem["task"],
+              "f": _expression(problem["f"], latex),
+              "f_prime": _expression(problem["f_prime"], latex),
+              "steps": [{"id": step.id, "rule": step.rule, "expr": sp.srepr(step.expr),
+                         "result": sp.srepr(step.result), "children": list(step.children),
+                         "parts": {name: sp.srepr(value) for name, value in step.parts.items()}}
+                        for step in problem["steps"]],
+              "features": problem_features(problem),
+              "verification": problem.get("verification"),
+              "keys": {"exact": canonical_key(question).hex(),
+                       "template": canonical_key(question, template=True).hex()}}
+    if "derivatives" in problem:
+        record["derivatives"] = [_expression(derivative, latex) for derivative in problem["derivatives"]]
+        record["order_ends"] = problem["order_ends"]
+    if "rhs" in problem:
+        record["coefficients"] = problem["coefficients"]
+        record["rhs"] = _expression(problem["rhs"], latex)
+    return record
+
+def record_problem(record):
+    """The problem a dataset record was made from, with its SymPy expressions rebuilt."""
+    steps = [DiffStep(step["id"], step["rule"], sp.sympify(step["expr"]), sp.sympify(step["result"]),
+                      tuple(step["children"]), {name: sp.sympify(value) for name, value in step["parts"].items()})
+             for step in record["steps"]]
+    problem = {"task": record.get("task", "integration"), "f": sp.sympify(record["f"]["srepr"]),
+               "f_prime": sp.sympify(record["f_prime"]["srepr"]), "steps": steps,
+               "verification": record.get("verification")}
+    if "derivatives" in record:
+        problem["derivatives"] = [sp.sympify(derivative["srepr"]) for derivative in record["derivatives"]]
+        problem["order_ends"] = record["order_ends"]
+    if "rhs" in record:
+        problem["coefficients"] = record["coefficients"]
+        problem["rhs"] = sp.sympify(record["rhs"]["srepr"])
+    return problem
+
+def _write_json(path, value):
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def _write_shard(path, rows, format):
+    if format == "parquet":
+        # Steps differ in shape from rule to rule, so they are stored as JSON text.
+        table = pa.Table.from_pylist([dict(row, steps=json.dumps(row["steps"])) for row in rows])
+        pq.write_table(table, path + ".tmp")
+    else:
+        with open(path + ".tmp", "w") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+    os.replace(path + ".tmp", path)
+
+def read_shard(path):
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise RuntimeError("reading Parquet needs pyarrow")
+        return [dict(row, steps=json.loads(row["steps"])) for row in pq.read_table(path).to_pylist()]
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def write_dataset(directory, count, shard_size=1000, format="jsonl", workers=os.cpu_count(), timeout_s=60.0,
+                  seed=0, memory_mb=2048, budget=None, dedup=None, bloom_error_rate=1e-4, task="integration"):
+    """Generate problems 0..count-1 into a dataset directory, resuming a previous run; returns the manifest.
+
+    `dedup` is None, "exact" or "template" (see canonical_key): problems
+    whose integrand has the key of an earlier problem are not stored.
+    """
+    if format == "parquet" and pq is None:
+        raise RuntimeError("writing Parquet needs pyarrow")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "manifest.json")
+    settings = {"count": count, "shard_size": shard_size, "format": format, "seed": seed, "budget": budget or {},
+                "dedup": dedup, "task": task}
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        # Datasets written before tasks existed are integration datasets.
+        stored = dict(manifest, task=manifest.get("task", "integration"))
+        if {key: stored.get(key) for key in settings} != settings:
+            raise ValueError(f"{directory} holds a dataset with different settings: "
+                             f"{ {key: stored.get(key) for key in settings} }")
+    else:
+        manifest = dict(settings, shards=[])
+    deduplicator = Deduplicator(count, error_rate=bloom_error_rate) if dedup else None
+    if deduplicator:
+        for shard in manifest["shards"]:
+            for row in read_shard(os.path.join(directory, shard["path"])):
+                deduplicator.seen.add(bytes.fromhex(row["keys"][dedup]))
+    # Shards are written in order, so the ones in the manifest are a prefix
+    # and which of two duplicates is kept does not depend on timing.
+    todo = list(range(len(manifest["shards"]), -(-count // shard_size)))
+    ranges = {shard: range(shard * shard_size, min((shard + 1) * shard_size, count)) for shard in todo}
+    indices = [index for shard in todo for index in ranges[shard]]
+    # Finished problems of each shard that is not written yet.
+    open_shards = {shard: [] for shard in todo}
+    for record in iter_problems(indices, workers, timeout_s, seed, memory_mb, budget, serialize=True, task=task):
+        open_shards[record["index"] // shard_size].append(record)
+        while todo and len(open_shards[todo[0]]) == len(ranges[todo[0]]):
+            shard = todo.pop(0)
+            records = sorted(open_shards.pop(shard), key=lambda record: record["index"])
+            rows, duplicates = [], 0
+            for record in records:
+                if record["status"] != "ok":
+                    continue
+                if deduplicator and not deduplicator.new(bytes.fromhex(record["problem"]["keys"][dedup])):
+                    duplicates += 1
+                    continue
+                rows.append(dict(record["problem"], index=record["index"], seed=problem_seed(seed, record["index"]),
+                                 elapsed_s=record["elapsed_s"]))
+            name = f"shard-{shard:05d}.{format}"
+            _write_shard(os.path.join(directory, name), rows, format)
+            manifest["shards"].append({"shard": shard, "path": name, "first_index": ranges[shard].start,
+                                       "end_index": ranges[shard].stop, "records": len(rows),
+                                       "duplicates": duplicates,
+                                       "skipped": [[record["index"], record["status"]] for record in records
+                                                   if record["status"] != "ok"]})
+            _write_json(path, manifest)
+    return manifest
+
+# Step 9: Deduplicate integrands
+#
+# Random compositions often produce the same f'(x) twice.  Integrands are
+# keyed by a hash of srepr(sp.sympify(f')), which is canonical because
+# SymPy orders the arguments of sums and products.  The template key first
+# replaces every constant other than 0, +-1 and +-1/2 (which encode
+# subtraction, division and square roots) with a placeholder, so
+# sin(3*x) and sin(7*x) share a template.  Keys are kept in a set, or in a
+# Bloom filter when a dataset has more integrands than fit in memory.
+
+_constant = re.compile(r"Integer\((-?\d+)\)|Rational\((-?\d+), (\d+)\)|Float\('[^']*', precision=\d+\)")
+_kept_constants = {"Integer(0)", "Integer(1)", "Integer(-1)", "Rational(1, 2)", "Rational(-1, 2)"}
+
+def _renormalize(match):
+    return match.group(0) if match.group(0) in _kept_constants else "Constant()"
+
+def canonical_key(expr, template=False):
+    """16-byte hash of the canonical structure of `expr` (an expression or its srepr)."""
+    text = sp.srepr(sp.sympify(expr))
+    if template:
+        text = _constant.sub(_renormalize, text)
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+class BloomFilter:
+    """Set of 16-byte keys with false positives at about `error_rate` once it holds `capacity` keys."""
+
+    def __init__(self, capacity, error_rate=1e-4):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: the two halves of the key act as two hash functions.
+        h1 = int.from_bytes(key[:8], "little")
+        h2 = int.from_bytes(key[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+class Deduplicator:
+    """Remembers integrand keys; new() says whether a key is seen for the first time.
+
+    Keys go to an exact set when at most `exact_limit` are expected, and to
+    a Bloom filter otherwise, which may drop a few unique integrands.
+    """
+
+    def __init__(self, expected, exact_limit=5_000_000, error_rate=1e-4):
+        self.seen = set() if expected <= exact_limit else BloomFilter(expected, error_rate)
+        self.checked = 0
+        self.duplicates = 0
+
+    def new(self, key):
+        self.checked += 1
+        if key in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen.add(key)
+        return True
+
+    @property
+    def duplicate_rate(self):
+        return self.duplicates / self.checked if self.checked else 0.0
+
+def render_dataset(directory, style="markdown"):
+    """Markdown (or another style) of every stored problem, in index order."""
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    latex = LatexCache(100_000)
+    for shard in manifest["shards"]:
+        for record in read_shard(os.path.join(directory, shard["path"])):
+            problem = record_problem(record)
+            yield formatters[problem["task"]](problem, style, latex)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate integration problems by differentiating random functions.")
+    parser.add_argument("--count", type=int, help="generate this many problems in a process pool")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds allowed per problem")
+    parser.add_argument("--memory-mb", type=int, default=2048, help="memory limit per worker")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-ops", type=int, default=30, help="count_ops budget of each function")
+    parser.add_argument("--max-depth", type=int, default=6, help="deepest composition in a term")
+    parser.add_argument("--max-terms", type=int, default=3, help="most terms in the sum or product")
+    parser.add_argument("--task", choices=["integration", "derivative", "ode"], default="integration")
+    parser.add_argument("--order", type=int, default=2, help="derivative or ODE order for those tasks")
+    parser.add_argument("--latex-cache", type=int, default=0,
+                        help="share an LRU LaTeX cache of this many subexpressions across problems")
+    parser.add_argument("--output", help="with --count, write a dataset to this directory (resumes a previous run)")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl", help="dataset shard format")
+    parser.add_argument("--shard-size", type=int, default=1000, help="problems per dataset shard")
+    parser.add_argument("--dedup", choices=["exact", "template"],
+                        help="store only the first problem with each integrand (template: up to constants)")
+    parser.add_argument("--bloom-error-rate", type=float, default=1e-4,
+                        help="false positive rate of the Bloom filter used for datasets too large for an exact set")
+    parser.add_argument("--render", metavar="DATASET", help="print the problems stored in a dataset directory")
+    parser.add_argument("--style", choices=sorted(styles), default="markdown", help="style for --render")
+    parser.add_argument("--latex-benchmark", action="store_true",
+                        help="time step rendering on deep compositions with and without the LaTeX cache")
+    args = parser.parse_args()
+    budget = {"max_ops": args.max_ops, "max_depth": args.max_depth, "max_terms": args.max_terms}
+    if args.task != "integration":
+        budget["order"] = args.order
+
+    if args.latex_benchmark:
+        for result in latex_benchmark(seed=args.seed):
+            print(f"depth {result['depth']}: {result['uncached_s']:.3f}s uncached, {result['cached_s']:.3f}s cached, "
+                  f"hit rate {result['hit_rate']:.1%}")
+    elif args.render:
+        for text in render_dataset(args.render, args.style):
+            print(text)
+    elif args.count is None:
+        # Generate a single problem for testing
+        generate_problem(args.task, **budget)
+    elif args.output:
+        start = time.perf_counter()
+        manifest = write_dataset(args.output, args.count, args.shard_size, args.format, args.workers, args.timeout,
+                                 args.seed, args.memory_mb, budget, args.dedup, args.bloom_error_rate, args.task)
+        records = sum(shard["records"] for shard in manifest["shards"])
+        duplicates = sum(shard.get("duplicates", 0) for shard in manifest["shards"])
+        print(f"{records}/{args.count} problems in {len(manifest['shards'])} shards, "
+              f"{time.perf_counter() - start:.1f}s this run", file=sys.stderr)
+        if args.dedup:
+            print(f"{duplicates} duplicates dropped ({duplicates / max(1, records + duplicates):.1%})", file=sys.stderr)
+    else:
+        start = time.perf_counter()
+        records = generate_problems(args.count, args.workers, args.timeout, args.seed, args.memory_mb, budget,
+                                    args.task)
+        latex = LatexCache(args.latex_cache) if args.latex_cache else None
+        for record in records:
+            if record["status"] == "ok":
+                print(formatters[args.task](record["problem"], latex=latex))
+        skipped = [record for record in records if record["status"] != "ok"]
+        print(f"{len(records) - len(skipped)}/{len(records)} problems in {time.perf_counter() - start:.1f}s, "
+              f"skipped: {[(record['index'], record['status']) for record in skipped]}", file=sys.stderr)
+        failed = [record["index"] for record in records
+                  if record["status"] == "ok" and record["problem"]["verification"]["ok"] is False]
+        print(f"verification failed for {failed}", file=sys.stderr)
+        if latex is not None:
+            print(f"LaTeX cache hit rate {latex.hit_rate:.1%}", file=sys.stderr)
@@ -0,0 +1,393 @@
+from multiprocessing import get_context
+from typing import Dict, List
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import profiling
+from generate import generate_proof, proof_to_record
+from rewrite import (BinaryOp, Expression, ExpressionPrinter, Number, ProofGenerator, Rule, UnaryOp, Variable,
+                     basic_rules, generate_random_expression, simple_rules)
+from rng import proof_rng
+
+# Benchmarks recurse over expression trees; the deepest trees in the sweep
+# need more than the default limit.
+sys.setrecursionlimit(20000)
+
+def random_expression_of_size(size: int, rng: random.Random) -> Expression:
+    """A random expression with exactly `size` nodes (rounded down to odd for binary trees)."""
+    if size <= 1:
+        if rng.random() < 0.5:
+            return Number(rng.randint(0, 10))
+        return Variable(rng.choice("abcxyz"))
+    if size == 2:
+        return UnaryOp("-", random_expression_of_size(1, rng))
+    left = rng.randint(1, size - 2)
+    return BinaryOp(rng.choice("+-*/"), random_expression_of_size(left, rng),
+                    random_expression_of_size(size - 1 - left, rng))
+
+def synthetic_rules(count: int, seed: int = 0) -> List[Rule]:
+    """Random, well-formed rules: every replacement only uses pattern variables."""
+    rng = random.Random(seed)
+    names = ["A", "B", "C"]
+
+    def pattern(depth: int) -> Expression:
+        if depth == 0 or rng.random() < 0.3:
+            return Variable(rng.choice(names)) if rng.random() < 0.8 else Number(rng.randint(0, 3))
+        return BinaryOp(rng.choice("+-*/"), pattern(depth - 1), pattern(depth - 1))
+
+    def template(depth: int, variables: List[str]) -> Expression:
+        if depth == 0 or rng.random() < 0.3:
+            return Variable(rng.choice(variables)) if variables else Number(rng.randint(0, 3))
+        return BinaryOp(rng.choice("+-*/"), template(depth - 1, variables), template(depth - 1, variables))
+
+    rules = []
+    while len(rules) < count:
+        lhs = pattern(2)
+        if isinstance(lhs, (Variable, Number)):
+            continue
+        variables = sorted({sub.name for sub in _leaves(lhs) if isinstance(sub, Variable)})
+        rules.append(Rule(f"Synthetic {len(rules)}", lhs, template(2, variables)))
+    return rules
+
+def _leaves(expr: Expression):
+    if isinstance(expr, BinaryOp):
+        yield from _leaves(expr.left)
+        yield from _leaves(expr.right)
+    elif isinstance(expr, UnaryOp):
+        yield from _leaves(expr.expr)
+    else:
+        yield expr
+
+rule_sets = {
+    "proof": lambda: basic_rules,
+    "newdat": lambda: simple_rules,
+    "synthetic-100": lambda: synthetic_rules(100),
+    "synthetic-500": lambda: synthetic_rules(500),
+}
+
+def timed(run, min_time: float) -> float:
+    """Seconds per call of `run`, calling it until at least `min_time` seconds have passed."""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        run()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+def summarize(times: List[float]) -> tuple:
+    """(best, spread) of repeated timings; spread is (slowest - best) / best.
+
+    Other load on the machine only ever slows a repetition down, so the
+    fastest one is the least noisy estimate.
+    """
+    best = min(times)
+    return best, (max(times) - best) / best
+
+def run_case(case: dict, repeats: int = 5, min_time: float = 0.2) -> dict:
+    """Run one benchmark case in a fresh process.
+
+    Walking and printing are each timed `repeats` times, every repetition
+    running for at least `min_time` seconds.  Throughputs come from the
+    fastest repetition, and `spread` holds how far the slowest one lagged,
+    which compare() treats as noise.  `peak_memory_kb` is the most memory
+    the walks had allocated at once, over what the process held before them.
+    """
+    rules = rule_sets[case["rules"]]()
+    rng = random.Random(case["seed"])
+    starts = [random_expression_of_size(case["size"], rng) for _ in range(case["walks"])]
+    generator = ProofGenerator(rules)
+
+    def walk():
+        random.seed(case["seed"])
+        return [generator.random_walk(expr, case["steps"]) for expr in starts]
+
+    proofs = walk()
+    printer = ExpressionPrinter()
+
+    def print_all():
+        for proof in proofs:
+            for _, expr, _ in proof:
+                printer.to_string(expr)
+
+    walk_times = [timed(walk, min_time) for _ in range(repeats)]
+    print_times = [timed(print_all, min_time) for _ in range(repeats)]
+
+    # Replay the same walks with instrumentation on to count match attempts.
+    random.seed(case["seed"])
+    profiling.enable()
+    for expr in starts:
+        generator.random_walk(expr, case["steps"])
+    attempts = sum(stats.attempts for stats in profiling.disable().rules.values())
+
+    # And once more under tracemalloc, which only sees allocations made after
+    # it starts, so the interpreter and the imports are not counted.
+    random.seed(case["seed"])
+    tracemalloc.start()
+    replayed = [generator.random_walk(expr, case["steps"]) for expr in starts]
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del replayed
+
+    steps = sum(len(proof) - 1 for proof in proofs)
+    printed = sum(len(proof) for proof in proofs)
+    proof_bytes = sum(len(json.dumps(proof_to_record(proof))) for proof in proofs)
+    walk_time, walk_spread = summarize(walk_times)
+    print_time, print_spread = summarize(print_times)
+    return dict(case,
+                walks_per_sec=len(proofs) / walk_time,
+                steps_per_sec=steps / walk_time,
+                match_attempts_per_sec=attempts / walk_time,
+                prints_per_sec=printed / print_time,
+                bytes_per_proof=proof_bytes / len(proofs),
+                peak_memory_kb=peak_memory / 1024,
+                spread={"walks_per_sec": walk_spread, "steps_per_sec": walk_spread,
+                        "match_attempts_per_sec": walk_spread, "prints_per_sec": print_spread})
+
+# Fewer walks than this make a case dominated by one or two start expressions.
+min_walks = 20
+
+def cases(quick: bool = False) -> List[dict]:
+    """One-dimensional sweeps around a default case of size 100, 10 steps, newdat rules."""
+    base = {"size": 101, "steps": 10, "rules": "newdat", "seed": 1234}
+    sizes = [11, 101, 1001] if quick else [11, 101, 1001, 10001]
+    steps = [5, 10, 20] if quick else [5, 10, 20, 50]
+    rules = ["proof", "newdat", "synthetic-100"] if quick else list(rule_sets)
+    sweep = [dict(base, size=size) for size in sizes]
+    sweep += [dict(base, steps=n) for n in steps if n != base["steps"]]
+    sweep += [dict(base, rules=name) for name in rules if name != base["rules"]]
+    for case in sweep:
+        # Keep every case at a comparable amount of work.
+        case["walks"] = max(min_walks, 20000 // (case["size"] * case["steps"]))
+        if case["rules"].startswith("synthetic"):
+            case["walks"] = max(min_walks, case["walks"] // 10)
+        case["name"] = f"size={case['size']},steps={case['steps']},rules={case['rules']}"
+    return sweep
+
+# Metrics where larger is better; the rest (memory, output size) should not grow.
+throughput_metrics = ["walks_per_sec", "steps_per_sec", "match_attempts_per_sec", "prints_per_sec"]
+# Peak memory is measured per case rather than as the process's peak RSS,
+# which the interpreter and the imports dominate.
+cost_metrics = ["peak_memory_kb", "bytes_per_proof", "bytes_per_node", "bytes_per_full_proof", "bytes_per_compact_proof"]
+
+def compare(baseline: List[dict], current: List[dict], threshold: float = 0.05) -> List[str]:
+    """Describe every metric that regressed by more than `threshold` and by more than its noise.
+
+    The noise of a throughput is the sum of its spreads in the two runs.
+    """
+    before: Dict[str, dict] = {result["name"]: result for result in baseline}
+    regressions = []
+    for result in current:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        for metric in throughput_metrics + cost_metrics:
+            if not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            noise = 0.0
+            if metric in throughput_metrics:
+                change = -change
+                noise = old.get("spread", {}).get(metric, 0.0) + result.get("spread", {}).get(metric, 0.0)
+            if change > max(threshold, noise):
+                regressions.append(f"{result['name']}: {metric} {old[metric]:.4g} -> {result[metric]:.4g} "
+                                   f"({change:+.1%} worse, noise {noise:.1%})")
+    return regressions
+
+def memory_case(walks: int = 2000, depth: int = 5, steps: int = 20, seed: int = 1234) -> dict:
+    """Bytes per expression node and per proof held in memory, in full and compact form."""
+    leaf_a, leaf_b = Variable("a"), Number(1)
+    tracemalloc.start()
+    nodes = [BinaryOp("+", leaf_a, leaf_b) for _ in range(100000)]
+    bytes_per_node = tracemalloc.get_traced_memory()[0] / len(nodes)
+    tracemalloc.stop()
+    del nodes
+
+    generator = ProofGenerator(simple_rules)
+    results = {"name": f"memory,depth={depth},steps={steps}", "bytes_per_node": bytes_per_node}
+    for form in ("full", "compact"):
+        tracemalloc.start()
+        proofs = []
+        for index in range(walks):
+            rng = proof_rng(seed, index)
+            proof = generator.random_walk(generate_random_expression(depth, rng), steps, rng)
+            proofs.append(generator.compact(proof) if form == "compact" else proof)
+        results[f"bytes_per_{form}_proof"] = tracemalloc.get_traced_memory()[0] / walks
+        tracemalloc.stop()
+        results["steps_per_proof"] = sum(len(proof) - 1 for proof in proofs) / walks
+        del proofs
+    return results
+
+def forms_case(walks: int = 300, depth: int = 3, steps: int = 10, seed: int = 1234) -> dict:
+    """Walk length and speed of the binary and the flattened n-ary form from the same start expressions.
+
+    A walk stops early once no rule applies, so a rule set that cannot see
+    into the n-ary chains shows up as short walks.
+    """
+    result = {"name": f"forms,depth={depth},steps={steps}"}
+    for form in ("binary", "nary"):
+        began = time.perf_counter()
+        lengths = [len(generate_proof(seed, index, depth, steps, form=form)) - 1 for index in range(walks)]
+        result[f"{form}_walks_per_sec"] = walks / (time.perf_counter() - began)
+        result[f"{form}_steps_per_walk"] = sum(lengths) / walks
+        result[f"{form}_stuck_walks"] = sum(length == 0 for length in lengths) / walks
+    result["nary_to_binary_steps"] = result["nary_steps_per_walk"] / result["binary_steps_per_walk"]
+    return result
+
+# N-ary walks are somewhat shorter by design: the sorted chains absorb
+# commutativity and associativity steps.  Below this ratio the n-ary rules
+# have lost sight of most redexes.
+min_nary_to_binary_steps = 0.5
+
+# Start expressions of the algebra.ipynb rewriting cells.
+notebook_expressions = ["3 + x", "3 * (x+1) + sin(x)**2 + cos(x)**2", "5 + (3 * 2 / x)"]
+
+def sympy_case(text: str, steps: int = 5, walks: int = 5, seed: int = 1234) -> dict:
+    """algebra.ipynb's replace()-based rewriting against the native engine on the notebook's rules.
+
+    The native side includes converting the start from SymPy and the result
+    back to SymPy, so both sides begin and end with a SymPy expression.  A
+    notebook walk gives up after max_tries=1000 attempts, so its steps taken
+    are reported next to the walk rate.
+    """
+    import sympy as sp
+    from sympy_bridge import from_sympy, notebook_rules, rules_from_sympy, sympy_rewrite, to_sympy
+
+    pairs = notebook_rules()
+    start = sp.parse_expr(text, evaluate=False)
+    rng = random.Random(seed)
+    began = time.perf_counter()
+    sympy_steps = sum(sympy_rewrite(start, pairs, steps, rng)[1] for _ in range(walks))
+    sympy_time = time.perf_counter() - began
+
+    generator = ProofGenerator(rules_from_sympy(pairs))
+    native_walks = walks * 1000
+    native_steps = 0
+    began = time.perf_counter()
+    for _ in range(native_walks):
+        proof = generator.random_walk(from_sympy(start), steps, rng)
+        to_sympy(proof[-1][1])
+        native_steps += len(proof) - 1
+    native_time = time.perf_counter() - began
+    return {"name": f"sympy,expr={text},steps={steps}",
+            "sympy_walks_per_sec": walks / sympy_time,
+            "sympy_steps_per_walk": sympy_steps / walks,
+            "native_walks_per_sec": native_walks / native_time,
+            "native_steps_per_walk": native_steps / native_walks,
+            "speedup": (native_walks / native_time) / (walks / sympy_time)}
+
+def latex_case(walks: int = 500, depth: int = 5, steps: int = 20, seed: int = 1234, sympy_walks: int = 20) -> dict:
+    """Per-step LaTeX of whole proofs: batch rendering against one expression at a time and SymPy's latex()."""
+    from latex import LatexRenderer
+
+    generator = ProofGenerator(simple_rules)
+    proofs = []
+    for index in range(walks):
+        rng = proof_rng(seed, index)
+        proofs.append(generator.random_walk(generate_random_expression(depth, rng), steps, rng))
+    count = sum(len(proof) for proof in proofs)
+
+    renderer = LatexRenderer()
+    began = time.perf_counter()
+    renderer.render_batch(proofs)
+    batch_time = time.perf_counter() - began
+    began = time.perf_counter()
+    for proof in proofs:
+        for _, expr, _ in proof:
+            LatexRenderer().render(expr)
+    single_time = time.perf_counter() - began
+    result = {"name": f"latex,depth={depth},steps={steps}",
+              "batch_exprs_per_sec": count / batch_time,
+              "uncached_exprs_per_sec": count / single_time,
+              "cache_hit_rate": renderer.hits / (renderer.hits + renderer.misses)}
+    try:
+        from sympy_bridge import to_latex
+    except ImportError:
+        return result
+    sample = [expr for proof in proofs[:sympy_walks] for _, expr, _ in proof]
+    began = time.perf_counter()
+    for expr in sample:
+        to_latex(expr)
+    result["sympy_exprs_per_sec"] = len(sample) / (time.perf_counter() - began)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proof generator.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the benchmark sweep")
+    run.add_argument("--output", default="bench.json")
+    run.add_argument("--quick", action="store_true", help="skip the largest sizes and rule sets")
+    run.add_argument("--repeats", type=int, default=5, help="timed repetitions of each case")
+    run.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per repetition")
+    memory = sub.add_parser("memory", help="measure bytes per node and per in-memory proof")
+    memory.add_argument("--output", default="bench-memory.json")
+    sympy_cmd = sub.add_parser("sympy", help="compare with SymPy replace() rewriting on algebra.ipynb's rules")
+    sympy_cmd.add_argument("--output", default="bench-sympy.json")
+    latex = sub.add_parser("latex", help="measure LaTeX rendering of whole proofs")
+    latex.add_argument("--output", default="bench-latex.json")
+    forms = sub.add_parser("forms", help="compare walk lengths of the binary and n-ary forms")
+    forms.add_argument("--output", default="bench-forms.json")
+    cmp = sub.add_parser("compare", help="flag regressions between two result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=0.05)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = []
+        context = get_context("spawn")
+        for case in cases(args.quick):
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case, args.repeats, args.min_time))
+            print(f"{result['name']:<40} {result['walks_per_sec']:>10.1f} walks/s "
+                  f"{result['steps_per_sec']:>10.1f} steps/s {result['peak_memory_kb']:>8.0f} KB", file=sys.stderr)
+            results.append(result)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    elif args.command == "memory":
+        result = memory_case()
+        for key, value in result.items():
+            print(f"{key:<28} {value}", file=sys.stderr)
+        with open(args.output, "w") as f:
+            json.dump([result], f, indent=2)
+    elif args.command == "latex":
+        result = latex_case()
+        for key, value in result.items():
+            print(f"{key:<28} {value}", file=sys.stderr)
+        with open(args.output, "w") as f:
+            json.dump([result], f, indent=2)
+    elif args.command == "forms":
+        result = forms_case()
+        for key, value in result.items():
+            print(f"{key:<28} {value}", file=sys.stderr)
+        with open(args.output, "w") as f:
+            json.dump([result], f, indent=2)
+        if result["nary_to_binary_steps"] < min_nary_to_binary_steps:
+            print(f"n-ary walks are {result['nary_to_binary_steps']:.2f}x as long as binary ones "
+                  f"(minimum {min_nary_to_binary_steps})", file=sys.stderr)
+            sys.exit(1)
+    elif args.command == "sympy":
+        results = [sympy_case(text) for text in notebook_expressions]
+        for result in results:
+            print(f"{result['name']:<50} {result['sympy_walks_per_sec']:>8.2f} -> "
+                  f"{result['native_walks_per_sec']:>8.1f} walks/s ({result['speedup']:.0f}x), steps per walk "
+                  f"{result['sympy_steps_per_walk']:.1f} -> {result['native_steps_per_walk']:.1f}", file=sys.stderr)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for line in regressions:
+            print(line)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
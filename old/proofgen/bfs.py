@@ -0,0 +1,327 @@
+from multiprocessing import Pipe, Process
+from typing import Dict, IO, Iterable, Iterator, List, Tuple
+import argparse
+import glob
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from generate import rules_by_form
+from nary import flatten
+from rewrite import (Expression, ExpressionPrinter, RuleIndex, parse_expression, rewrite_redex,
+                     subexpressions)
+
+printer = ExpressionPrinter()
+
+# Exhaustive breadth-first enumeration of every expression reachable from a
+# seed within k rewrite steps.
+#
+# States are partitioned across worker processes by a hash of their printed
+# form, which is canonical for a tree (and for a flattened tree, whose
+# operands are sorted).  The search is level-synchronous: at each level a
+# worker reads the candidates other workers sent it, keeps the ones it has
+# not seen, and writes their successors to per-destination exchange files in
+# batches.  The parent only tells the workers when to start the next level.
+
+def state_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+def owner(key: bytes, workers: int) -> int:
+    return int.from_bytes(key[:8], "little") % workers
+
+def sorted_chunks(run: np.ndarray, chunk: int) -> Iterator[bytes]:
+    """The keys of a sorted run, read `chunk` at a time."""
+    for start in range(0, len(run), chunk):
+        yield from run[start:start + chunk].tolist()
+
+class VisitedSet:
+    """Set of 16-byte state keys that spills to sorted runs on disk.
+
+    New keys go to an in-memory set; when it holds `memory_limit` keys it is
+    written out as a sorted run of raw keys and cleared.  Lookups
+    binary-search the memory-mapped runs, a whole batch at a time.  Once
+    there are more than `max_runs` runs they are merged into one by a
+    streaming k-way merge, which holds `merge_chunk` keys of each run in
+    memory at a time.
+    """
+
+    def __init__(self, directory: str, memory_limit: int = 5_000_000, max_runs: int = 16,
+                 merge_chunk: int = 65536):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.max_runs = max_runs
+        self.merge_chunk = merge_chunk
+        self.memory: set = set()
+        self.runs: List[np.ndarray] = []
+        self.paths: List[str] = []
+        self.spilled = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.memory) + sum(len(run) for run in self.runs)
+
+    def contains(self, keys: List[bytes]) -> np.ndarray:
+        found = np.array([key in self.memory for key in keys], dtype=bool)
+        if self.runs and keys:
+            batch = np.array(keys, dtype="S16")
+            for run in self.runs:
+                positions = np.minimum(np.searchsorted(run, batch), len(run) - 1)
+                found |= run[positions] == batch
+        return found
+
+    def add(self, keys: List[bytes]):
+        self.memory.update(keys)
+        if len(self.memory) >= self.memory_limit:
+            self._spill([np.array(sorted(self.memory), dtype="S16")])
+            self.memory = set()
+            if len(self.runs) > self.max_runs:
+                self._merge()
+
+    def _merge(self):
+        runs, paths = self.runs, self.paths
+        self.runs, self.paths = [], []
+        merged = heapq.merge(*(sorted_chunks(run, self.merge_chunk) for run in runs))
+        self._spill(self._deduplicated(merged))
+        del runs
+        for path in paths:
+            os.remove(path)
+
+    def _deduplicated(self, keys: Iterator[bytes]) -> Iterator[np.ndarray]:
+        """Sorted `keys` without repeats, in arrays of up to `merge_chunk` keys."""
+        chunk: List[bytes] = []
+        previous = None
+        for key in keys:
+            if key != previous:
+                chunk.append(key)
+                previous = key
+                if len(chunk) == self.merge_chunk:
+                    yield np.array(chunk, dtype="S16")
+                    chunk = []
+        if chunk:
+            yield np.array(chunk, dtype="S16")
+
+    def _spill(self, chunks: Iterable[np.ndarray]):
+        path = os.path.join(self.directory, f"run-{self.spilled:05d}.keys")
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                chunk.tofile(f)
+        self.spilled += 1
+        self.runs.append(np.memmap(path, dtype="S16", mode="r"))
+        self.paths.append(path)
+
+def count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+
+def expression_size(expr: Expression) -> int:
+    return sum(1 for _ in subexpressions(expr))
+
+def exchange_path(directory: str, depth: int, destination: int, source) -> str:
+    return os.path.join(directory, "exchange", f"level-{depth:03d}", f"to-{destination:03d}-from-{source}.jsonl")
+
+class Worker:
+    """One partition of the search: its visited set, its output shard and its outgoing batches."""
+
+    def __init__(self, worker: int, workers: int, directory: str, form: str, max_depth: int, max_size: int,
+                 memory_limit: int, batch_size: int):
+        self.worker = worker
+        self.workers = workers
+        self.directory = directory
+        self.form = form
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.memory_limit = memory_limit
+        self.batch_size = batch_size
+        self.index = RuleIndex(rules_by_form[form])
+        self.visited = VisitedSet(os.path.join(directory, "visited", f"{worker:03d}"), memory_limit)
+        self.output = open(os.path.join(directory, f"states-{worker:03d}.jsonl"), "w")
+
+    def read(self, text: str) -> Expression:
+        expr = parse_expression(text)
+        return flatten(expr) if self.form == "nary" else expr
+
+    def level(self, depth: int) -> Tuple[int, int, int]:
+        """Process the candidates sent to this worker for `depth`; returns (candidates, new, sent).
+
+        A level with more than `memory_limit` candidates is first split by
+        key into partitions on disk, each of which fits in memory, and the
+        partitions are processed one at a time.
+        """
+        inbox = sorted(glob.glob(exchange_path(self.directory, depth, self.worker, "*")))
+        candidates = sum(count_lines(path) for path in inbox)
+        partitions = -(-candidates // self.memory_limit)
+        groups = self.partition(inbox, depth, partitions) if partitions > 1 else [inbox]
+        new = sent = 0
+        for paths in groups:
+            states = self.deduplicate(paths, depth)
+            new += len(states)
+            if depth < self.max_depth:
+                sent += self.expand(states, depth + 1)
+        return candidates, new, sent
+
+    def partition(self, inbox: List[str], depth: int, partitions: int) -> List[List[str]]:
+        """Move the candidates in `inbox` into `partitions` files by key; returns them as one-file inboxes."""
+        directory = os.path.join(self.directory, "exchange", f"level-{depth:03d}", f"partitions-{self.worker:03d}")
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, f"{i:05d}.jsonl") for i in range(partitions)]
+        files = [open(path, "w") for path in paths]
+        for path in inbox:
+            with open(path) as f:
+                for line in f:
+                    # The low bytes of the key pick the worker, so use the high ones here.
+                    key = state_key(json.loads(line)[0])
+                    files[int.from_bytes(key[8:], "little") % partitions].write(line)
+            os.remove(path)
+        for f in files:
+            f.close()
+        return [[path] for path in paths]
+
+    def deduplicate(self, inbox: List[str], depth: int) -> List[list]:
+        """Read and delete the candidate files in `inbox`; writes and returns the states not visited before."""
+        # Among several ways of reaching a state at this depth keep the
+        # smallest (parent, rule, path), so the output does not depend on the
+        # number of workers or the order batches arrive in.
+        best: Dict[bytes, list] = {}
+        for path in inbox:
+            with open(path) as f:
+                for line in f:
+                    candidate = json.loads(line)
+                    key = state_key(candidate[0])
+                    if key not in best or candidate[1:] < best[key][1:]:
+                        best[key] = candidate
+            os.remove(path)
+        keys = sorted(best)
+        new = []
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            seen = self.visited.contains(batch)
+            fresh = [key for key, old in zip(batch, seen) if not old]
+            self.visited.add(fresh)
+            new.extend(best[key] for key in fresh)
+        for text, parent, rule, path in new:
+            self.output.write(json.dumps({"expression": text, "depth": depth, "parent": parent,
+                                          "rule": rule, "path": path}) + "\n")
+        self.output.flush()
+        return new
+
+    def expand(self, states: List[list], depth: int) -> int:
+        # Appends, since each partition of a level expands into the same files.
+        outboxes: Dict[int, IO] = {}
+        buffers: Dict[int, List[str]] = {}
+        sent = 0
+
+        def flush(destination: int):
+            if destination not in outboxes:
+                path = exchange_path(self.directory, depth, destination, f"{self.worker:03d}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                outboxes[destination] = open(path, "a")
+            outboxes[destination].writelines(buffers.pop(destination))
+
+        for text, _, _, _ in states:
+            expr = self.read(text)
+            for redex in self.index.redexes(expr):
+                successor = rewrite_redex(expr, redex)
+                if expression_size(successor) > self.max_size:
+                    continue
+                successor_text = printer.to_string(successor)
+                destination = owner(state_key(successor_text), self.workers)
+                line = json.dumps([successor_text, text, redex[0].name, list(redex[1])]) + "\n"
+                buffers.setdefault(destination, []).append(line)
+                sent += 1
+                if len(buffers[destination]) >= self.batch_size:
+                    flush(destination)
+        for destination in list(buffers):
+            flush(destination)
+        for f in outboxes.values():
+            f.close()
+        return sent
+
+    def close(self) -> int:
+        self.output.close()
+        return len(self.visited)
+
+def worker_main(conn, *args):
+    worker = Worker(*args)
+    while True:
+        command, depth = conn.recv()
+        if command == "level":
+            conn.send(worker.level(depth))
+        else:
+            conn.send(worker.close())
+            return
+
+def enumerate_states(seed: str, directory: str, max_depth: int, max_size: int, workers: int = os.cpu_count(),
+                     form: str = "binary", memory_limit: int = 5_000_000, batch_size: int = 4096) -> dict:
+    """Write every state reachable from `seed` in at most `max_depth` steps to `directory`; returns counts."""
+    if os.path.exists(os.path.join(directory, "exchange")):
+        shutil.rmtree(os.path.join(directory, "exchange"))
+    if os.path.exists(os.path.join(directory, "visited")):
+        shutil.rmtree(os.path.join(directory, "visited"))
+    os.makedirs(directory, exist_ok=True)
+    expr = parse_expression(seed)
+    start = printer.to_string(flatten(expr) if form == "nary" else expr)
+    path = exchange_path(directory, 0, owner(state_key(start), workers), "seed")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(json.dumps([start, None, None, None]) + "\n")
+
+    pipes, processes = [], []
+    for worker in range(workers):
+        parent_end, child_end = Pipe()
+        process = Process(target=worker_main, args=(child_end, worker, workers, directory, form, max_depth,
+                                                    max_size, memory_limit, batch_size))
+        process.start()
+        pipes.append(parent_end)
+        processes.append(process)
+
+    levels = []
+    began = time.perf_counter()
+    try:
+        for depth in range(max_depth + 1):
+            for conn in pipes:
+                conn.send(("level", depth))
+            results = [conn.recv() for conn in pipes]
+            candidates, new, sent = (sum(column) for column in zip(*results))
+            levels.append({"depth": depth, "candidates": candidates, "new_states": new,
+                           "per_worker": [result[1] for result in results]})
+            print(json.dumps(levels[-1]), file=sys.stderr)
+            if not sent:
+                break
+        for conn in pipes:
+            conn.send(("close", None))
+        visited = sum(conn.recv() for conn in pipes)
+    finally:
+        for process in processes:
+            process.join()
+    shutil.rmtree(os.path.join(directory, "exchange"), ignore_errors=True)
+    summary = {"seed": start, "form": form, "max_depth": max_depth, "max_size": max_size, "workers": workers,
+               "states": visited, "levels": levels, "elapsed_s": round(time.perf_counter() - began, 3)}
+    with open(os.path.join(directory, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Enumerate every expression reachable from a seed in k steps.")
+    parser.add_argument("seed", help="seed expression in the printed form, e.g. '((a + b) * c)'")
+    parser.add_argument("output", help="directory for the state shards")
+    parser.add_argument("--depth", type=int, default=3, help="maximum number of rewrite steps")
+    parser.add_argument("--max-size", type=int, default=15, help="drop states with more nodes than this")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--form", choices=sorted(rules_by_form), default="binary")
+    parser.add_argument("--memory-states", type=int, default=5_000_000,
+                        help="visited keys each worker keeps in memory before spilling to disk")
+    parser.add_argument("--batch-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    summary = enumerate_states(args.seed, args.output, args.depth, args.max_size, args.workers, args.form,
+                               args.memory_states, args.batch_size)
+    print(json.dumps({key: summary[key] for key in ("states", "elapsed_s")}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import argparse
+import glob
+import json
+import os
+import sys
+
+from nary import flatten, nary_rules, on_operand_pairs
+from rewrite import Expression, Path, Rule, basic_rules, children, parse_expression, replace_at, simple_rules
+
+def rules_by_name(rules: List[Rule]) -> Dict[str, Rule]:
+    return {rule.name: rule for rule in rules}
+
+# The operand-pair versions act as the plain rules outside n-ary chains, so
+# one table replays both forms.
+default_rules = rules_by_name(basic_rules + on_operand_pairs(simple_rules) + nary_rules)
+
+def descend(expr: Expression, path: Path) -> Optional[Expression]:
+    for i in path:
+        kids = children(expr)
+        if not 0 <= i < len(kids):
+            return None
+        expr = kids[i]
+    return expr
+
+def replay_step(expr: Expression, rule: Rule, path: Path) -> Optional[Expression]:
+    """Apply `rule` exactly at `path`.
+
+    Only the subexpression at `path` is matched and only the spine above it is
+    rebuilt, so a step costs O(depth + pattern size) and the rest of the tree
+    is shared with the previous expression.
+    """
+    sub = descend(expr, path)
+    if sub is None:
+        return None
+    bindings = {}
+    if not rule.match(sub, rule.pattern, bindings):
+        return None
+    return replace_at(expr, path, rule.instantiate(rule.replacement, bindings))
+
+def check_steps(start: Expression, steps: List[Tuple[str, Path]], conclusion: Expression,
+                rules: Dict[str, Rule] = default_rules,
+                read: Callable[[Expression], Expression] = lambda expr: expr) -> Optional[str]:
+    """Replay a proof from its start; returns None if valid, else the reason it is not.
+
+    The replayed result is passed through `read` before comparing it with the
+    conclusion.
+    """
+    current = start
+    for i, (name, path) in enumerate(steps, 1):
+        rule = rules.get(name)
+        if rule is None:
+            return f"step {i}: unknown rule {name!r}"
+        current = replay_step(current, rule, tuple(path))
+        if current is None:
+            return f"step {i}: {name!r} does not apply at {list(path)}"
+    if read(current) != conclusion:
+        return "replayed proof does not end at the stated conclusion"
+    return None
+
+def check_record(record: dict, rules: Dict[str, Rule] = default_rules, strict: bool = False) -> Optional[str]:
+    """Check one record written by generate.py.
+
+    By default only the start, which must match both the theorem and the first
+    step, the (rule, path) annotations and the conclusion are used; `strict` also compares every stored intermediate expression.
+    A two-operand sum prints the same in both forms, so expressions of "nary"
+    records are flattened after parsing.
+    """
+    read = flatten if record.get("form") == "nary" else (lambda expr: expr)
+    steps = record["steps"]
+    start = read(parse_expression(steps[0][1]))
+    if read(parse_expression(record["theorem"][0])) != start:
+        return "theorem does not start from the first step"
+    conclusion = read(parse_expression(record["theorem"][1]))
+    if any(len(step) < 3 or step[2] is None for step in steps[1:]):
+        return "proof has steps without a position"
+    error = check_steps(start, [(name, path) for name, _, path in steps[1:]], conclusion, rules, read)
+    if error is None and strict:
+        current = start
+        for i, (name, text, path) in enumerate(steps[1:], 1):
+            current = replay_step(current, rules[name], tuple(path))
+            if read(current) != read(parse_expression(text)):
+                return f"step {i}: stored expression differs from the replayed one"
+    return error
+
+def check_file(path: str, strict: bool = False) -> Tuple[int, List[Tuple[str, int, str]]]:
+    """Check every proof in a JSONL file; returns (count, [(file, line, reason)])."""
+    count = 0
+    invalid = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            count += 1
+            try:
+                error = check_record(json.loads(line), strict=strict)
+            except (ValueError, KeyError, IndexError) as e:
+                error = f"malformed record: {e}"
+            if error is not None:
+                invalid.append((path, line_number, error))
+    return count, invalid
+
+def dataset_files(directory: str) -> Iterator[str]:
+    return iter(sorted(glob.glob(os.path.join(directory, "**", "*.jsonl"), recursive=True)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check generated proofs by replaying their annotated steps.")
+    parser.add_argument("dataset", help="a JSONL file or a directory of them")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--strict", action="store_true", help="also compare every stored intermediate expression")
+    args = parser.parse_args()
+
+    files = [args.dataset] if os.path.isfile(args.dataset) else list(dataset_files(args.dataset))
+    total = 0
+    failures = 0
+    with Pool(args.workers) as pool:
+        for count, invalid in pool.starmap(check_file, [(path, args.strict) for path in files]):
+            total += count
+            failures += len(invalid)
+            for path, line_number, error in invalid:
+                print(f"{path}:{line_number}: {error}")
+    print(f"{total - failures}/{total} proofs valid", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
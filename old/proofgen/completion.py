@@ -0,0 +1,473 @@
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+
+from rewrite import (BinaryOp, Expression, ExpressionPrinter, NaryOp, Number, Rule, UnaryOp, Undefined, Variable,
+                     children, evaluate_expression, evaluate_op, head, pattern_variables, replace_at, simple_rules,
+                     subexpressions)
+from inverse import canonical_form, rename_variables
+from nary import flat_ops, make_nary
+
+# Equations and oriented rules are plain (left, right) pairs during completion.
+Equation = Tuple[Expression, Expression]
+
+# Operator precedence used by the reduction orderings, highest first.  Unary
+# minus is written "neg" to tell it apart from subtraction.  Constants sit
+# below every operator and are ordered by value.  "+" above "*" orients
+# doubling as A + A -> 2 * A, which shrinks terms, under both LPO and KBO.
+default_precedence = ["+", "/", "*", "-", "neg"]
+
+def symbol(expr: Expression) -> tuple:
+    if isinstance(expr, BinaryOp):
+        return ("op", expr.op)
+    elif isinstance(expr, UnaryOp):
+        return ("op", "neg" if expr.op == "-" else expr.op)
+    elif isinstance(expr, Number):
+        return ("num", expr.value)
+    elif isinstance(expr, Undefined):
+        return ("undefined",)
+    return ("var", expr.name)
+
+def occurs(name: str, expr: Expression) -> bool:
+    return any(isinstance(sub, Variable) and sub.name == name for _, sub in subexpressions(expr))
+
+def substitute(expr: Expression, subst: Dict[str, Expression]) -> Expression:
+    if isinstance(expr, Variable):
+        return subst.get(expr.name, expr)
+    elif isinstance(expr, BinaryOp):
+        return BinaryOp(expr.op, substitute(expr.left, subst), substitute(expr.right, subst))
+    elif isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, substitute(expr.expr, subst))
+    return expr
+
+def unify(s: Expression, t: Expression) -> Optional[Dict[str, Expression]]:
+    """Most general unifier of two patterns, or None."""
+    subst: Dict[str, Expression] = {}
+    stack = [(s, t)]
+    while stack:
+        s, t = stack.pop()
+        s, t = substitute(s, subst), substitute(t, subst)
+        if s == t:
+            continue
+        if isinstance(t, Variable) and not isinstance(s, Variable):
+            s, t = t, s
+        if isinstance(s, Variable):
+            if occurs(s.name, t):
+                return None
+            subst = {name: substitute(value, {s.name: t}) for name, value in subst.items()}
+            subst[s.name] = t
+        elif symbol(s) == symbol(t) and type(s) is type(t):
+            stack.extend(zip(children(s), children(t)))
+        else:
+            return None
+    return subst
+
+class LPO:
+    """Lexicographic path ordering over a total precedence on operators."""
+
+    def __init__(self, precedence: List[str] = default_precedence):
+        self.rank = {name: len(precedence) - i for i, name in enumerate(precedence)}
+
+    def precedes(self, f: tuple, g: tuple) -> bool:
+        """True if symbol f is strictly greater than symbol g."""
+        if f[0] == "op" and g[0] == "op":
+            return self.rank.get(f[1], 0) > self.rank.get(g[1], 0)
+        if f[0] == "op":
+            return g[0] == "num"
+        if f[0] == "num" and g[0] == "num":
+            return f[1] > g[1]
+        return False
+
+    def greater(self, s: Expression, t: Expression) -> bool:
+        if isinstance(s, Variable):
+            return False
+        if isinstance(t, Variable):
+            return s != t and occurs(t.name, s)
+        s_args, t_args = children(s), children(t)
+        if any(si == t or self.greater(si, t) for si in s_args):
+            return True
+        f, g = symbol(s), symbol(t)
+        if self.precedes(f, g):
+            return all(self.greater(s, ti) for ti in t_args)
+        if f == g:
+            for si, ti in zip(s_args, t_args):
+                if si != ti:
+                    return self.greater(si, ti) and all(self.greater(s, tj) for tj in t_args)
+        return False
+
+class KBO(LPO):
+    """Knuth-Bendix ordering with unit weights unless given otherwise."""
+
+    def __init__(self, precedence: List[str] = default_precedence, weights: Optional[Dict[str, int]] = None):
+        super().__init__(precedence)
+        self.weights = weights or {}
+
+    def weight(self, expr: Expression) -> int:
+        total = 0
+        for _, sub in subexpressions(expr):
+            sym = symbol(sub)
+            total += self.weights.get(sym[1], 1) if sym[0] == "op" else 1
+        return total
+
+    def variable_counts(self, expr: Expression) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for _, sub in subexpressions(expr):
+            if isinstance(sub, Variable):
+                counts[sub.name] = counts.get(sub.name, 0) + 1
+        return counts
+
+    def greater(self, s: Expression, t: Expression) -> bool:
+        if isinstance(s, Variable):
+            return False
+        s_vars, t_vars = self.variable_counts(s), self.variable_counts(t)
+        if any(s_vars.get(name, 0) < n for name, n in t_vars.items()):
+            return False
+        if isinstance(t, Variable):
+            return s != t
+        ws, wt = self.weight(s), self.weight(t)
+        if ws != wt:
+            return ws > wt
+        f, g = symbol(s), symbol(t)
+        if self.precedes(f, g):
+            return True
+        if f == g:
+            for si, ti in zip(children(s), children(t)):
+                if si != ti:
+                    return self.greater(si, ti)
+        return False
+
+def is_ac_rule(rule: Rule) -> bool:
+    """Commutativity and associativity cannot be oriented and are left out of completion."""
+    _, _, pattern, replacement = canonical_form(rule)
+    a, b, c = Variable("_0"), Variable("_1"), Variable("_2")
+    if isinstance(pattern, BinaryOp):
+        op = pattern.op
+        if (pattern, replacement) == (BinaryOp(op, a, b), BinaryOp(op, b, a)):
+            return True
+        left_assoc, right_assoc = BinaryOp(op, BinaryOp(op, a, b), c), BinaryOp(op, a, BinaryOp(op, b, c))
+        if (pattern, replacement) in ((left_assoc, right_assoc), (right_assoc, left_assoc)):
+            return True
+    return False
+
+def divisors(expr: Expression) -> List[Expression]:
+    """The divisors of `expr` that may be zero: every one but a nonzero constant."""
+    return [sub.right for _, sub in subexpressions(expr)
+            if isinstance(sub, BinaryOp) and sub.op == "/" and not (isinstance(sub.right, Number) and sub.right.value)]
+
+def cancels_division(rule: Equation) -> bool:
+    """Whether a rule removes a division by something that may be zero, such as (A / A) -> 1.
+
+    Division by zero is undefined, so such a rule would normalize 0 / 0 to 1.
+    """
+    lhs, rhs = rule
+    kept = divisors(rhs)
+    return any(divisor not in kept for divisor in divisors(lhs))
+
+def size(expr: Expression) -> int:
+    return sum(1 for _ in subexpressions(expr))
+
+def match(pattern: Expression, expr: Expression, bindings: Dict[str, Expression]) -> bool:
+    return Rule("", pattern, pattern).match(expr, pattern, bindings)
+
+def rewrite_once(expr: Expression, rules: List[Equation]) -> Optional[Expression]:
+    for path, sub in subexpressions(expr):
+        for lhs, rhs in rules:
+            bindings = {}
+            if match(lhs, sub, bindings):
+                return replace_at(expr, path, substitute(rhs, bindings))
+    return None
+
+def reduce(expr: Expression, rules: List[Equation]) -> Expression:
+    while True:
+        expr = evaluate_expression(expr)
+        new_expr = rewrite_once(expr, rules)
+        if new_expr is None:
+            return expr
+        expr = new_expr
+
+def rename_apart(rule: Equation, suffix: str) -> Equation:
+    lhs, rhs = rule
+    renaming = {name: name + suffix for name in pattern_variables(BinaryOp("->", lhs, rhs))}
+    return rename_variables(lhs, renaming), rename_variables(rhs, renaming)
+
+def tidy(rule: Equation) -> Equation:
+    """Rename the variables of a derived rule to A, B, C, ... in order of occurrence."""
+    lhs, rhs = rule
+    names = pattern_variables(BinaryOp("->", lhs, rhs))
+    renaming = {name: chr(ord("A") + i) if i < 26 else f"V{i}" for i, name in enumerate(names)}
+    return rename_variables(lhs, renaming), rename_variables(rhs, renaming)
+
+def critical_pairs(rule1: Equation, rule2: Equation) -> List[Equation]:
+    """Overlaps of rule2's left side into the non-variable positions of rule1's."""
+    l1, r1 = rename_apart(rule1, "'")
+    l2, r2 = rename_apart(rule2, "''")
+    pairs = []
+    for path, sub in subexpressions(l1):
+        if isinstance(sub, Variable):
+            continue
+        subst = unify(sub, l2)
+        if subst is None:
+            continue
+        pairs.append((substitute(r1, subst), substitute(replace_at(l1, path, r2), subst)))
+    return pairs
+
+printer = ExpressionPrinter()
+
+class CompletionResult:
+    def __init__(self, rules: List[Equation], unorientable: List[Equation], complete: bool):
+        self.rules = rules
+        self.unorientable = unorientable
+        # True when every critical pair was joined and nothing was left unoriented,
+        # i.e. the system is confluent as well as terminating.
+        self.complete = complete
+        # Input rules left out of completion, each with the reason.
+        self.dropped: List[Tuple[Rule, str]] = []
+        # Derived rules withheld because they cancel a division (see cancels_division).
+        self.partial: List[Equation] = []
+
+def complete(equations: List[Equation], ordering: LPO, max_rules: int = 50,
+             max_steps: int = 1000) -> CompletionResult:
+    """Knuth-Bendix completion (Huet's variant with inter-reduction)."""
+    pending = list(equations)
+    rules: List[Equation] = []
+    unorientable: List[Equation] = []
+    partial: List[Equation] = []
+    steps = 0
+    while pending:
+        steps += 1
+        if steps > max_steps or len(rules) > max_rules:
+            result = CompletionResult(rules, unorientable + pending, False)
+            result.partial = partial
+            return result
+        s, t = pending.pop(0)
+        s, t = reduce(s, rules), reduce(t, rules)
+        if s == t:
+            continue
+        if ordering.greater(s, t):
+            new_rule = tidy((s, t))
+        elif ordering.greater(t, s):
+            new_rule = tidy((t, s))
+        else:
+            unorientable.append((s, t))
+            continue
+        if cancels_division(new_rule):
+            # Sound only where the divisor is nonzero, which a rule cannot check.
+            if new_rule not in partial:
+                partial.append(new_rule)
+            continue
+        kept = []
+        for lhs, rhs in rules:
+            if rewrite_once(lhs, [new_rule]) is not None:
+                pending.append((lhs, rhs))
+            else:
+                kept.append((lhs, reduce(rhs, kept + [new_rule] + rules)))
+        rules = kept + [new_rule]
+        for rule in rules:
+            pending.extend(critical_pairs(rule, new_rule))
+            if rule is not new_rule:
+                pending.extend(critical_pairs(new_rule, rule))
+        # Equations that could not be oriented may become joinable with the new rule.
+        pending.extend(unorientable)
+        unorientable = []
+    unorientable = [(s, t) for s, t in unorientable if reduce(s, rules) != reduce(t, rules)]
+    result = CompletionResult(rules, unorientable, not unorientable and not partial)
+    result.partial = partial
+    return result
+
+def complete_rules(rules: List[Rule], ordering: Optional[LPO] = None, **limits) -> CompletionResult:
+    """Complete the plain, non-AC rules of a rule set.
+
+    Rules with custom matching (EvalRule, GeneralRule) are not equations;
+    constant folding is built into the normalizer instead.  Equations are
+    added one at a time and any equation that keeps completion from
+    succeeding within the limits is dropped.  Every input rule left out is
+    reported in `dropped` with the reason.
+    """
+    ordering = ordering or LPO()
+    accepted: List[Equation] = []
+    dropped: List[Tuple[Rule, str]] = []
+    result = CompletionResult([], [], True)
+    candidates = []
+    for rule in rules:
+        if type(rule) is not Rule or rule.evaluate:
+            dropped.append((rule, "custom matching"))
+        elif is_ac_rule(rule):
+            dropped.append((rule, "commutativity or associativity cannot be oriented"))
+        elif cancels_division((rule.pattern, rule.replacement)) or cancels_division((rule.replacement, rule.pattern)):
+            dropped.append((rule, "cancels a division by a term that may be zero"))
+        else:
+            candidates.append(rule)
+    # Small equations first, so a large troublemaker such as distributivity is
+    # dropped rather than the identities it fails to join with.
+    candidates.sort(key=lambda rule: size(rule.pattern) + size(rule.replacement))
+    for rule in candidates:
+        attempt = complete(accepted + [(rule.pattern, rule.replacement)], ordering, **limits)
+        if attempt.complete:
+            accepted.append((rule.pattern, rule.replacement))
+            result = attempt
+        elif attempt.partial:
+            dropped.append((rule, "completion derives a rule that cancels a division"))
+        elif attempt.unorientable:
+            s, t = attempt.unorientable[0]
+            dropped.append((rule, f"leaves {printer.to_string(s)} = {printer.to_string(t)} unorientable"))
+        else:
+            dropped.append((rule, "completion did not finish within the limits"))
+    result.dropped = dropped
+    return result
+
+def compile_pattern(pattern: Expression) -> Callable[[Expression, dict], bool]:
+    """Compile a pattern into a matcher closure with no per-node type dispatch."""
+    if isinstance(pattern, Variable):
+        name = pattern.name
+        def match_variable(expr, bindings):
+            bound = bindings.get(name)
+            if bound is None:
+                bindings[name] = expr
+                return True
+            return bound == expr
+        return match_variable
+    elif isinstance(pattern, Number):
+        value = pattern.value
+        return lambda expr, bindings: type(expr) is Number and expr.value == value
+    elif isinstance(pattern, BinaryOp):
+        op, left, right = pattern.op, compile_pattern(pattern.left), compile_pattern(pattern.right)
+        return lambda expr, bindings: (type(expr) is BinaryOp and expr.op == op and
+                                       left(expr.left, bindings) and right(expr.right, bindings))
+    op, operand = pattern.op, compile_pattern(pattern.expr)
+    return lambda expr, bindings: type(expr) is UnaryOp and expr.op == op and operand(expr.expr, bindings)
+
+def compile_template(template: Expression) -> Callable[[dict], Expression]:
+    if isinstance(template, Variable):
+        name = template.name
+        return lambda bindings: bindings[name]
+    elif isinstance(template, Number):
+        return lambda bindings: template
+    elif isinstance(template, BinaryOp):
+        op, left, right = template.op, compile_template(template.left), compile_template(template.right)
+        return lambda bindings: BinaryOp(op, left(bindings), right(bindings))
+    op, operand = template.op, compile_template(template.expr)
+    return lambda bindings: UnaryOp(op, operand(bindings))
+
+class Normalizer:
+    """Innermost normalizer for a terminating rewrite system.
+
+    Rules are compiled to closures and dispatched on the head symbol of each
+    subexpression, and normal forms are memoized per node so shared subtrees
+    are only normalized once.
+    """
+
+    def __init__(self, rules: List[Equation], fold_constants: bool = True):
+        self.rules = rules
+        self.fold_constants = fold_constants
+        self._by_head: Dict[tuple, List[tuple]] = {}
+        self._wildcard: List[tuple] = []
+        for lhs, rhs in rules:
+            compiled = (compile_pattern(lhs), compile_template(rhs))
+            if isinstance(lhs, Variable):
+                self._wildcard.append(compiled)
+            else:
+                self._by_head.setdefault(head(lhs), []).append(compiled)
+
+    def normalize(self, expr: Expression) -> Expression:
+        return self._normalize(expr, {})
+
+    def equivalent(self, a: Expression, b: Expression) -> bool:
+        return self.normalize(a) == self.normalize(b)
+
+    def _normalize(self, expr: Expression, memo: dict) -> Expression:
+        hit = memo.get(id(expr))
+        if hit is not None and hit[0] is expr:
+            return hit[1]
+        node = expr
+        if isinstance(expr, BinaryOp):
+            left, right = self._normalize(expr.left, memo), self._normalize(expr.right, memo)
+            if left is not expr.left or right is not expr.right:
+                node = BinaryOp(expr.op, left, right)
+        elif isinstance(expr, UnaryOp):
+            operand = self._normalize(expr.expr, memo)
+            if operand is not expr.expr:
+                node = UnaryOp(expr.op, operand)
+        elif isinstance(expr, NaryOp):
+            args = [self._normalize(arg, memo) for arg in expr.args]
+            if any(new is not old for new, old in zip(args, expr.args)):
+                # Normalized operands may be chains themselves or out of order.
+                node = make_nary(expr.op, args)
+                if not isinstance(node, NaryOp):
+                    node = self._normalize(node, memo)
+        result = node
+        folded = self._fold(node)
+        if folded is not None:
+            result = folded
+        elif isinstance(node, NaryOp):
+            rewritten = self._rewrite_pair(node)
+            if rewritten is not None:
+                result = self._normalize(rewritten, memo)
+        else:
+            for matcher, builder in self._by_head.get(head(node), []) + self._wildcard:
+                bindings = {}
+                if matcher(node, bindings):
+                    result = self._normalize(builder(bindings), memo)
+                    break
+        memo[id(expr)] = (expr, result)
+        return result
+
+    def _rewrite_pair(self, node: NaryOp) -> Optional[Expression]:
+        """The chain with the first rule over two adjacent operands applied, as nary.OperandPairs does."""
+        rules = self._by_head.get((BinaryOp, node.op), []) + self._wildcard
+        args = node.args
+        for i in range(len(args) - 1):
+            for left, right in ((args[i], args[i + 1]), (args[i + 1], args[i])):
+                pair = BinaryOp(node.op, left, right)
+                for matcher, builder in rules:
+                    bindings = {}
+                    if matcher(pair, bindings):
+                        chain = make_nary(node.op, list(args[:i]) + [builder(bindings)] + list(args[i + 2:]))
+                        if chain != node:
+                            return chain
+        return None
+
+    def _fold(self, node: Expression) -> Optional[Expression]:
+        if not self.fold_constants:
+            return None
+        if isinstance(node, BinaryOp):
+            return evaluate_op(node.op, node.left, node.right)
+        elif isinstance(node, UnaryOp):
+            return evaluate_op(node.op, node.expr)
+        elif isinstance(node, NaryOp) and node.op in flat_ops:
+            # Constants sort first in a chain; fold them into one.
+            constants = [arg for arg in node.args if isinstance(arg, (Number, Undefined))]
+            if len(constants) < 2:
+                return None
+            value = constants[0]
+            for constant in constants[1:]:
+                value = evaluate_op(node.op, value, constant)
+            return make_nary(node.op, [value] + [arg for arg in node.args if not isinstance(arg, (Number, Undefined))])
+        return None
+
+def build_normalizer(rules: List[Rule] = simple_rules, ordering: Optional[LPO] = None, **limits) -> Normalizer:
+    return Normalizer(complete_rules(rules, ordering, **limits).rules)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Complete the non-AC rules of simple_rules.")
+    parser.add_argument("--ordering", choices=["lpo", "kbo"], default="lpo")
+    parser.add_argument("--max-rules", type=int, default=50)
+    args = parser.parse_args()
+
+    ordering = KBO() if args.ordering == "kbo" else LPO()
+    result = complete_rules(simple_rules, ordering, max_rules=args.max_rules)
+    print(f"Completed: {result.complete}")
+    for rule, reason in result.dropped:
+        print(f"Dropped: {rule.name} ({reason})")
+    for lhs, rhs in result.partial:
+        print(f"Withheld: {printer.to_string(lhs)} -> {printer.to_string(rhs)} (cancels a division)")
+    print("Rules:")
+    for lhs, rhs in result.rules:
+        print(f"  {printer.to_string(lhs)} -> {printer.to_string(rhs)}")
+    if result.unorientable:
+        print("Unorientable:")
+        for s, t in result.unorientable:
+            print(f"  {printer.to_string(s)} = {printer.to_string(t)}")
+
+    normalizer = Normalizer(result.rules)
+    expr = BinaryOp("+", UnaryOp("-", UnaryOp("-", Variable("a"))),
+                    BinaryOp("*", Variable("b"), BinaryOp("+", Number(2), Number(3))))
+    print(f"\n{printer.to_string(expr)} => {printer.to_string(normalizer.normalize(expr))}")
@@ -0,0 +1,204 @@
+from typing import Dict, Iterable, Iterator, List, Tuple
+import argparse
+import json
+import sys
+import zlib
+
+import numpy as np
+
+from rewrite import BinaryOp, Expression, NaryOp, Number, Undefined, Variable, tokenize
+
+commutative_ops = {"+", "*"}
+
+def abstract(expr: Expression, names: Dict[str, str]) -> str:
+    """A string for `expr` that ignores constants, variable names and the order of commutative operands."""
+    if isinstance(expr, Number):
+        return "#"
+    elif isinstance(expr, Undefined):
+        return "undefined"
+    elif isinstance(expr, Variable):
+        if expr.name not in names:
+            names[expr.name] = f"v{len(names)}"
+        return names[expr.name]
+    elif isinstance(expr, BinaryOp):
+        left, right = abstract(expr.left, names), abstract(expr.right, names)
+        if expr.op in commutative_ops and right < left:
+            left, right = right, left
+        return f"({left}{expr.op}{right})"
+    elif isinstance(expr, NaryOp):
+        operands = [abstract(arg, names) for arg in expr.args]
+        if expr.op in commutative_ops:
+            operands.sort()
+        return "(" + expr.op.join(operands) + ")"
+    return f"{expr.op}({abstract(expr.expr, names)})"
+
+def abstract_text(text: str, names: Dict[str, str]) -> str:
+    """abstract() applied to printed text, without building the expression tree."""
+    tokens = tokenize(text)
+    pos = 0
+
+    def walk() -> str:
+        nonlocal pos
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            operands = [walk()]
+            op = tokens[pos]
+            while tokens[pos] == op:
+                pos += 1
+                operands.append(walk())
+            pos += 1
+            if op in commutative_ops:
+                operands.sort()
+            return "(" + op.join(operands) + ")"
+        if pos < len(tokens) and tokens[pos] == "(" and not token[-1].isdigit():
+            pos += 1
+            operand = walk()
+            pos += 1
+            return f"{token}({operand})"
+        if token[-1].isdigit():
+            return "#"
+        if token == "undefined":
+            return token
+        if token not in names:
+            names[token] = f"v{len(names)}"
+        return names[token]
+
+    return walk()
+
+def shingles(record: dict, ngram: int = 3) -> np.ndarray:
+    """32-bit hashes of the rule-name n-grams and abstracted expressions of a proof record."""
+    steps = record["steps"]
+    rule_names = [step[0] for step in steps[1:]]
+    features = set()
+    for i in range(max(1, len(rule_names) - ngram + 1)):
+        features.add("r:" + "|".join(rule_names[i:i + ngram]))
+    names: Dict[str, str] = {}
+    for step in steps:
+        features.add("e:" + abstract_text(step[1], names))
+    return np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint64)
+
+def choose_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """The (bands, rows) split whose S-curve midpoint (1/b)^(1/r) is closest to the threshold."""
+    splits = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+class NearDuplicateFilter:
+    """Streaming MinHash/LSH filter over proof records.
+
+    Records are processed in batches: signatures for a whole batch are computed
+    with one vectorized pass, then each record is looked up in the LSH bands.
+    A record whose estimated Jaccard similarity to an earlier kept record is at
+    least `threshold` joins that record's cluster; at most `max_per_cluster`
+    records are kept per cluster (1 drops every near duplicate).
+
+    Only the low `signature_bits` bits of each kept signature are stored (b-bit
+    MinHash), in one array growing by doubling: 128 bytes per cluster instead
+    of a kilobyte.  Two unrelated values agree on those bits with probability
+    2^-b, which the similarity estimate corrects for.
+    """
+
+    prime = (1 << 31) - 1
+    signature_bits = 8
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, max_per_cluster: int = 1, seed: int = 0):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.max_per_cluster = max_per_cluster
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, self.prime, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, self.prime, size=(num_perm, 1), dtype=np.uint64)
+        self.buckets: List[Dict[bytes, int]] = [{} for _ in range(self.bands)]
+        self.signatures = np.empty((1024, num_perm), dtype=np.uint8)
+        self.cluster_sizes: List[int] = []
+        self.seen = 0
+        self.dropped = 0
+
+    def signature_batch(self, shingle_sets: List[np.ndarray]) -> np.ndarray:
+        """MinHash signatures, one row per shingle set; every value is below 2^31, so they fit uint32."""
+        lengths = np.array([max(len(s), 1) for s in shingle_sets])
+        values = np.concatenate([s if len(s) else np.zeros(1, dtype=np.uint64) for s in shingle_sets])
+        hashed = (self.a * (values % self.prime) + self.b) % self.prime
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.minimum.reduceat(hashed, starts, axis=1).T.astype(np.uint32)
+
+    def similarity(self, cluster: int, signature: np.ndarray) -> float:
+        """Estimated Jaccard similarity of `signature` and the stored signature of `cluster`."""
+        collision = 2.0 ** -self.signature_bits
+        agree = np.mean(self.signatures[cluster] == signature.astype(np.uint8))
+        return (agree - collision) / (1 - collision)
+
+    def _lookup(self, signature: np.ndarray) -> int:
+        """Index of the cluster this signature belongs to, or -1."""
+        for band, bucket in enumerate(self.buckets):
+            cluster = bucket.get(signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            if cluster is not None and self.similarity(cluster, signature) >= self.threshold:
+                return cluster
+        return -1
+
+    def _add(self, signature: np.ndarray) -> int:
+        cluster = len(self.cluster_sizes)
+        if cluster == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        # The uint8 cast keeps the low signature_bits bits.
+        self.signatures[cluster] = signature.astype(np.uint8)
+        self.cluster_sizes.append(0)
+        for band, bucket in enumerate(self.buckets):
+            bucket.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), cluster)
+        return cluster
+
+    def filter_batch(self, records: List[dict], shingle_sets: List[np.ndarray] = None) -> List[dict]:
+        """Keep the records of a batch that are not near duplicates.
+
+        Shingling is most of the per-record cost and needs no shared state, so
+        callers with a worker pool should compute `shingle_sets` with shingles()
+        in the workers and leave only MinHash and LSH to this process.
+        """
+        if not records:
+            return []
+        if shingle_sets is None:
+            shingle_sets = [shingles(record) for record in records]
+        signatures = self.signature_batch(shingle_sets)
+        kept = []
+        for record, signature in zip(records, signatures):
+            self.seen += 1
+            cluster = self._lookup(signature)
+            if cluster < 0:
+                cluster = self._add(signature)
+            if self.cluster_sizes[cluster] >= self.max_per_cluster:
+                self.dropped += 1
+                continue
+            self.cluster_sizes[cluster] += 1
+            kept.append(record)
+        return kept
+
+    def filter(self, records: Iterable[dict], batch_size: int = 512) -> Iterator[dict]:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield from self.filter_batch(batch)
+                batch = []
+        yield from self.filter_batch(batch)
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop near-duplicate proofs from a JSONL dataset.")
+    parser.add_argument("input")
+    parser.add_argument("--output", help="JSONL file to write (default: stdout)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="estimated Jaccard similarity of duplicates")
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--max-per-cluster", type=int, default=1)
+    args = parser.parse_args()
+
+    dedup = NearDuplicateFilter(args.threshold, args.num_perm, args.max_per_cluster)
+    out = open(args.output, "w") if args.output else sys.stdout
+    with open(args.input) as f:
+        for record in dedup.filter(json.loads(line) for line in f if line.strip()):
+            out.write(json.dumps(record) + "\n")
+    if args.output:
+        out.close()
+    print(f"kept {dedup.seen - dedup.dropped}/{dedup.seen} ({len(dedup.cluster_sizes)} clusters)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+from multiprocessing import Pool
+from typing import List
+import argparse
+import json
+import random
+import sys
+
+import profiling
+from latex import LatexRenderer
+from nary import flatten, nary_rules, on_operand_pairs
+from rewrite import ExpressionPrinter, ProofGenerator, generate_random_expression, simple_rules
+from rng import proof_rng, rng_kind
+
+printer = ExpressionPrinter()
+
+# "nary" proofs start from the flattened expression; the binary rules also
+# apply to adjacent operands of its chains, next to the like-term
+# collection rules of nary.py.
+rules_by_form = {"binary": simple_rules, "nary": on_operand_pairs(simple_rules) + nary_rules}
+
+def proof_to_record(proof: List[tuple], renderer: LatexRenderer = None) -> dict:
+    record = {"theorem": [printer.to_string(proof[0][1]), printer.to_string(proof[-1][1])],
+              "steps": [[name, printer.to_string(expr), None if path is None else list(path)]
+                        for name, expr, path in proof]}
+    if renderer is not None:
+        record["latex"] = renderer.render_proof(proof)
+    return record
+
+def proof_metadata(seed: int, index: int, depth: int, steps: int, form: str = "binary") -> dict:
+    """Everything needed to regenerate one proof with generate_proof()."""
+    return {"seed": seed, "index": index, "depth": depth, "max_steps": steps, "form": form, "rng": rng_kind}
+
+def generate_proof(seed: int, index: int, depth: int, steps: int, generator: ProofGenerator = None,
+                   form: str = "binary") -> list:
+    """Proof `index` of the dataset with the given seed, independent of every other proof."""
+    generator = generator or ProofGenerator(rules_by_form[form])
+    rng = proof_rng(seed, index)
+    start = generate_random_expression(depth, rng)
+    if form == "nary":
+        start = flatten(start)
+    return generator.random_walk(start, steps, rng)
+
+def rematerialize(metadata: dict) -> dict:
+    if metadata["rng"] != rng_kind:
+        # The other stream would silently produce a different proof.
+        raise ValueError(f"proof was generated with the {metadata['rng']} random stream, "
+                         f"but this installation uses {rng_kind}")
+    proof = generate_proof(metadata["seed"], metadata["index"], metadata["depth"], metadata["max_steps"],
+                           form=metadata.get("form", "binary"))
+    return dict(proof_to_record(proof), **metadata)
+
+def generate_batch(indices: List[int], depth: int, steps: int, seed: int, profile: bool,
+                   metadata_only: bool = False, form: str = "binary", latex: bool = False) -> tuple:
+    """Generate the proofs with the given indices; runs in-process or inside a pool worker."""
+    if profile:
+        profiling.enable()
+    generator = ProofGenerator(rules_by_form[form])
+    renderer = LatexRenderer() if latex else None
+    records = []
+    for index in indices:
+        metadata = proof_metadata(seed, index, depth, steps, form)
+        if metadata_only:
+            records.append(metadata)
+        else:
+            proof = generate_proof(seed, index, depth, steps, generator, form)
+            records.append(dict(proof_to_record(proof, renderer), **metadata))
+            if renderer is not None:
+                renderer.clear()
+    collected = profiling.disable() if profile else None
+    return records, collected.to_dict() if collected else None
+
+def parse_indices(text: str) -> List[int]:
+    """Parse a list such as "5,10-20" into proof indices."""
+    indices = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            indices.extend(range(int(first), int(last) + 1))
+        elif part:
+            indices.append(int(part))
+    return indices
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate theorem/proof pairs by random walks.")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--start", type=int, default=0, help="index of the first proof")
+    parser.add_argument("--indices", type=parse_indices,
+                        help="generate only these proof indices, e.g. 5,10-20 (overrides --count/--start)")
+    parser.add_argument("--depth", type=int, default=3, help="depth of the random start expressions")
+    parser.add_argument("--steps", type=int, default=10, help="maximum rewrite steps per proof")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, help="dataset seed (random if omitted)")
+    parser.add_argument("--metadata-only", action="store_true",
+                        help="write only the seed and index of each proof instead of the proof")
+    parser.add_argument("--form", choices=sorted(rules_by_form), default="binary",
+                        help="binary + and * chains, or flattened n-ary sums and products")
+    parser.add_argument("--latex", action="store_true", help="also store the LaTeX of every step")
+    parser.add_argument("--output", help="JSONL file to write (default: stdout)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="write a per-rule report to PREFIX.txt and collapsed stacks to PREFIX.collapsed")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.getrandbits(63)
+    indices = args.indices or list(range(args.start, args.start + args.count))
+    chunks = [indices[i::args.workers] for i in range(args.workers)]
+    jobs = [(chunk, args.depth, args.steps, seed, bool(args.profile), args.metadata_only, args.form, args.latex) for chunk in chunks]
+    if args.workers == 1:
+        results = [generate_batch(*jobs[0])]
+    else:
+        with Pool(args.workers) as pool:
+            results = pool.starmap(generate_batch, jobs)
+
+    records = sorted((record for batch, _ in results for record in batch), key=lambda record: record["index"])
+    out = open(args.output, "w") if args.output else sys.stdout
+    for record in records:
+        out.write(json.dumps(record) + "\n")
+    if args.output:
+        out.close()
+
+    if args.profile:
+        profile = profiling.merge_profiles([collected for _, collected in results])
+        profile.write(args.profile)
+        print(profile.report(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
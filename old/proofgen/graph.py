@@ -0,0 +1,178 @@
+from typing import Dict, List, Tuple
+import argparse
+import json
+import random
+import sys
+
+import numpy as np
+
+from generate import rules_by_form
+from nary import flatten
+from rewrite import Expression, ExpressionPrinter, Path, ProofGenerator, Step, parse_expression
+from rng import proof_rng
+
+printer = ExpressionPrinter()
+
+class ProofGraph:
+    """All walks from one seed expression merged into a single state graph.
+
+    Nodes are distinct expressions, numbered in order of discovery with the
+    seed as node 0.  Edges are (source, rule, path) -> target; an edge taken
+    by several walks is stored once.  `form` is the generate.py form of the
+    rules, "binary" or "nary".
+    """
+
+    def __init__(self, generator: ProofGenerator, seed_expression: Expression, form: str = "binary"):
+        self.generator = generator
+        self.form = form
+        self.nodes: List[Expression] = []
+        self.ids: Dict[Expression, int] = {}
+        self.edges: Dict[Tuple[int, int, Path], int] = {}
+        self.walks = 0
+        # Number of states after each walk, for the growth curve.
+        self.growth: List[int] = []
+        self.node(seed_expression)
+
+    def node(self, expr: Expression) -> int:
+        node = self.ids.get(expr)
+        if node is None:
+            node = self.ids[expr] = len(self.nodes)
+            self.nodes.append(expr)
+        return node
+
+    def add_walk(self, proof: List[Step]):
+        source = self.node(proof[0][1])
+        for name, expr, path in proof[1:]:
+            target = self.node(expr)
+            self.edges.setdefault((source, self.generator.rule_ids[name], path), target)
+            source = target
+        self.walks += 1
+        self.growth.append(len(self.nodes))
+
+    def explore(self, walks: int, steps: int, seed: int):
+        """Run `walks` more walks from the seed; walk i uses the stream of proof i."""
+        for index in range(self.walks, self.walks + walks):
+            self.add_walk(self.generator.random_walk(self.nodes[0], steps, proof_rng(seed, index)))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """The graph in CSR form.
+
+        Edges of node i are indptr[i]:indptr[i + 1] in `targets`, `rules` and
+        `path_ptr`; the path of edge e is path_data[path_ptr[e]:path_ptr[e + 1]].
+        Node i is the UTF-8 text node_data[node_ptr[i]:node_ptr[i + 1]], so
+        every node takes its own length rather than that of the longest.
+        """
+        edges = sorted(self.edges.items(), key=lambda item: item[0][0])
+        counts = np.bincount([source for (source, _, _), _ in edges], minlength=len(self.nodes))
+        paths = [path for (_, _, path), _ in edges]
+        texts = [printer.to_string(expr).encode() for expr in self.nodes]
+        return {
+            "indptr": np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            "targets": np.array([target for _, target in edges], dtype=np.int64),
+            "rules": np.array([rule for (_, rule, _), _ in edges], dtype=np.uint16),
+            "path_ptr": np.concatenate(([0], np.cumsum([len(path) for path in paths]))).astype(np.int64),
+            "path_data": np.array([i for path in paths for i in path], dtype=np.uint16),
+            "node_ptr": np.concatenate(([0], np.cumsum([len(text) for text in texts]))).astype(np.int64),
+            "node_data": np.frombuffer(b"".join(texts), dtype=np.uint8),
+            "rule_names": np.array([rule.name for rule in self.generator.rules]),
+            "growth": np.array(self.growth, dtype=np.int64),
+            "form": np.array(self.form),
+        }
+
+def distances(indptr: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Fewest steps from the seed to every node (-1 if unreachable)."""
+    dist = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    dist[0] = 0
+    frontier = [0]
+    while frontier:
+        following = []
+        for node in frontier:
+            for target in targets[indptr[node]:indptr[node + 1]]:
+                if dist[target] < 0:
+                    dist[target] = dist[node] + 1
+                    following.append(target)
+        frontier = following
+    return dist
+
+def statistics(arrays: Dict[str, np.ndarray]) -> dict:
+    indptr, growth = arrays["indptr"], arrays["growth"]
+    degrees = np.diff(indptr)
+    dist = distances(indptr, arrays["targets"])
+    checkpoints = sorted({n for n in (1, 10, 100, 1000, 10000, 100000) if n < len(growth)} | {len(growth)})
+    return {"states": int(len(degrees)),
+            "edges": int(len(arrays["targets"])),
+            "walks": int(len(growth)),
+            "mean_out_degree": float(degrees.mean()),
+            "max_out_degree": int(degrees.max()),
+            "dead_ends": int((degrees == 0).sum()),
+            "states_by_distance": np.bincount(dist[dist >= 0]).tolist(),
+            "states_after_walks": {n: int(growth[n - 1]) for n in checkpoints}}
+
+class GraphSampler:
+    """Draws proofs from a saved graph without running the rewrite engine."""
+
+    def __init__(self, path: str):
+        with np.load(path) as data:
+            self.arrays = {key: data[key] for key in data.files}
+        self.indptr = self.arrays["indptr"].tolist()
+        self.targets = self.arrays["targets"].tolist()
+        self.rules = self.arrays["rules"].tolist()
+        self.path_ptr = self.arrays["path_ptr"].tolist()
+        self.path_data = self.arrays["path_data"].tolist()
+        self.node_ptr = self.arrays["node_ptr"].tolist()
+        self.node_data = self.arrays["node_data"].tobytes()
+        self.rule_names = self.arrays["rule_names"].tolist()
+        self.form = str(self.arrays["form"])
+
+    def node(self, i: int) -> str:
+        return self.node_data[self.node_ptr[i]:self.node_ptr[i + 1]].decode()
+
+    def sample(self, steps: int, rng=random) -> dict:
+        """A random walk of up to `steps` edges from the seed, as a generate.py record."""
+        node = 0
+        record_steps = [["Initial", self.node(0), None]]
+        for _ in range(steps):
+            first, last = self.indptr[node], self.indptr[node + 1]
+            if first == last:
+                break
+            edge = first + int(rng.random() * (last - first))
+            node = self.targets[edge]
+            path = self.path_data[self.path_ptr[edge]:self.path_ptr[edge + 1]]
+            record_steps.append([self.rule_names[self.rules[edge]], self.node(node), path])
+        return {"theorem": [self.node(0), self.node(node)], "steps": record_steps, "form": self.form}
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge random walks from one expression into a state graph.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="run walks and save the graph as .npz")
+    build.add_argument("expression", help="seed expression in the printed form, e.g. '((a + b) * c)'")
+    build.add_argument("--output", default="graph.npz")
+    build.add_argument("--walks", type=int, default=1000)
+    build.add_argument("--steps", type=int, default=10)
+    build.add_argument("--seed", type=int, default=0)
+    build.add_argument("--form", choices=sorted(rules_by_form), default="binary")
+    sample = sub.add_parser("sample", help="draw proofs from a saved graph")
+    sample.add_argument("graph")
+    sample.add_argument("--count", type=int, default=10)
+    sample.add_argument("--steps", type=int, default=10)
+    sample.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = parse_expression(args.expression)
+        if args.form == "nary":
+            start = flatten(start)
+        graph = ProofGraph(ProofGenerator(rules_by_form[args.form]), start, args.form)
+        graph.explore(args.walks, args.steps, args.seed)
+        arrays = graph.arrays()
+        np.savez_compressed(args.output, **arrays)
+        print(json.dumps(statistics(arrays), indent=2))
+    else:
+        sampler = GraphSampler(args.graph)
+        rng = random.Random(args.seed)
+        for _ in range(args.count):
+            print(json.dumps(sampler.sample(args.steps, rng)))
+        print(json.dumps(statistics(sampler.arrays)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+from typing import Dict, List, Optional
+import random
+
+from rewrite import (BinaryOp, Expression, ExpressionPrinter, Number, ProofGenerator, Rule, Step, UnaryOp,
+                     Variable, pattern_variables, rewrite_redex, simple_rules)
+
+def rename_variables(expr: Expression, renaming: Dict[str, str]) -> Expression:
+    if isinstance(expr, Variable):
+        return Variable(renaming.get(expr.name, expr.name))
+    elif isinstance(expr, BinaryOp):
+        return BinaryOp(expr.op, rename_variables(expr.left, renaming), rename_variables(expr.right, renaming))
+    elif isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, rename_variables(expr.expr, renaming))
+    return expr
+
+def canonical_form(rule: Rule) -> tuple:
+    """The rule with its variables renamed in order of first occurrence.
+
+    Two rules with equal canonical forms rewrite exactly the same way.
+    """
+    names = pattern_variables(BinaryOp("->", rule.pattern, rule.replacement))
+    renaming = {name: f"_{i}" for i, name in enumerate(names)}
+    return (type(rule), rule.evaluate,
+            rename_variables(rule.pattern, renaming), rename_variables(rule.replacement, renaming))
+
+def is_reversible(rule: Rule) -> bool:
+    """A plain rule is reversible when both sides bind the same variables.
+
+    Rules that fold constants, or that drop or invent variables (such as
+    "Additive Inverse" or "Rewrite 1 as X/X"), cannot be replayed backwards.
+    """
+    if type(rule) is not Rule or rule.evaluate:
+        return False
+    return set(pattern_variables(rule.pattern)) == set(pattern_variables(rule.replacement))
+
+def dedupe_rules(rules: List[Rule]) -> List[Rule]:
+    """Drop rules that are identical to an earlier rule up to variable names."""
+    seen = set()
+    unique = []
+    for rule in rules:
+        form = canonical_form(rule)
+        if form not in seen:
+            seen.add(form)
+            unique.append(rule)
+    return unique
+
+class InverseTable:
+    """Maps every reversible rule to its inverse.
+
+    Self-inverse rules such as commutativity map to themselves instead of
+    getting a second, duplicate entry.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = dedupe_rules(rules)
+        self.inverse: Dict[Rule, Rule] = {}
+        self.forward: Dict[Rule, Rule] = {}
+        by_form = {canonical_form(rule): rule for rule in self.rules}
+        for rule in self.rules:
+            if not is_reversible(rule):
+                continue
+            inverse = Rule(f"{rule.name} (reverse)", rule.replacement, rule.pattern)
+            inverse = by_form.get(canonical_form(inverse), inverse)
+            self.inverse[rule] = inverse
+            self.forward[inverse] = rule
+
+    def inverse_rules(self) -> List[Rule]:
+        return list(dict.fromkeys(self.inverse.values()))
+
+    def __getitem__(self, rule: Rule) -> Optional[Rule]:
+        return self.inverse.get(rule)
+
+class BackwardProofGenerator:
+    """Generates hard expressions by expanding a simple target with inverse rules.
+
+    The walk runs over the inverse rules with the same indexed matcher as the
+    forward generator, and the proof is reported in the simplifying direction:
+    it starts at the expanded expression and ends at the target.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.table = InverseTable(rules)
+        self.generator = ProofGenerator(self.table.inverse_rules())
+
+    def random_walk(self, target: Expression, steps: int, rng=random) -> List[Step]:
+        current = target
+        trace = [current]
+        names = []
+        paths = []
+        for _ in range(steps):
+            redexes = self.generator.index.redexes(current)
+            if not redexes:
+                break
+            redex = self.generator.choose(redexes, rng)
+            current = rewrite_redex(current, redex)
+            trace.append(current)
+            names.append(self.table.forward[redex[0]].name)
+            paths.append(redex[1])
+        # The forward rule fires at the same position its inverse did.
+        proof = [("Initial", trace[-1], None)]
+        for name, expr, path in zip(reversed(names), reversed(trace[:-1]), reversed(paths)):
+            proof.append((name, expr, path))
+        return proof
+
+if __name__ == "__main__":
+    printer = ExpressionPrinter()
+    table = InverseTable(simple_rules)
+    print("Inverse rules:")
+    for rule, inverse in table.inverse.items():
+        print(f"  {rule.name} <- {inverse.name}")
+
+    generator = BackwardProofGenerator(simple_rules)
+    targets = [
+        Variable("x"),
+        BinaryOp("*", Number(2), Variable("x")),
+        BinaryOp("+", Variable("a"), Variable("b"))
+    ]
+    for target in targets:
+        proof = generator.random_walk(target, 6)
+        print(f"\nTheorem: {printer.to_string(proof[0][1])} = {printer.to_string(target)}")
+        print("Proof:")
+        for step, expr, _ in proof:
+            print(f"{step}: {printer.to_string(expr)}")
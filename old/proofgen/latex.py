@@ -0,0 +1,130 @@
+from fractions import Fraction
+from typing import Dict, List, Tuple
+import math
+import sys
+
+from rewrite import BinaryOp, Expression, NaryOp, Number, Step, UnaryOp, Undefined, Variable, parse_expression
+
+# Precedence of the rendered forms, loosest first.  A subexpression is put in
+# parentheses only when its precedence is lower than its position needs; the
+# right operand of a binary operator also needs them at equal precedence,
+# so every rendering still determines its tree (a + (b + c) keeps its
+# parentheses and an Associativity step stays visible).
+SUM, PRODUCT, NEGATION, FRACTION, POWER, FUNCTION, ATOM = range(7)
+
+binary_ops = {"+": (SUM, "+"), "-": (SUM, "-"), "*": (PRODUCT, "\\cdot")}
+
+functions = {"sin", "cos", "tan", "exp", "log", "ln", "sqrt", "sinh", "cosh", "tanh", "arcsin", "arccos", "arctan"}
+
+Rendered = Tuple[str, int]  # (LaTeX, precedence)
+
+def parenthesize(rendered: Rendered) -> str:
+    return f"\\left({rendered[0]}\\right)"
+
+class LatexRenderer:
+    """Renders proofgen expressions as LaTeX with minimal parentheses.
+
+    Renderings are cached by node identity.  Consecutive steps of a proof
+    share every subtree the rewrite did not touch, and leaves are interned,
+    so in a batch of proofs most subtrees are rendered once and then looked
+    up.  The cache keeps its nodes alive; clear() it between batches.
+    """
+
+    def __init__(self):
+        self.cache: Dict[int, Tuple[Expression, Rendered]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.cache.clear()
+
+    def render(self, expr: Expression) -> str:
+        return self._render(expr)[0]
+
+    def render_proof(self, proof: List[Step]) -> List[str]:
+        return [self.render(expr) for _, expr, _ in proof]
+
+    def render_batch(self, proofs: List[List[Step]]) -> List[List[str]]:
+        """LaTeX of every step of every proof; the cache is emptied afterwards."""
+        try:
+            return [self.render_proof(proof) for proof in proofs]
+        finally:
+            self.clear()
+
+    def _render(self, expr: Expression) -> Rendered:
+        hit = self.cache.get(id(expr))
+        if hit is not None and hit[0] is expr:
+            self.hits += 1
+            return hit[1]
+        self.misses += 1
+        rendered = self._render_node(expr)
+        self.cache[id(expr)] = (expr, rendered)
+        return rendered
+
+    def _operand(self, expr: Expression, precedence: int, right: bool) -> str:
+        rendered = self._render(expr)
+        # A right operand starting with a minus sign is parenthesized too: a - (-b), not a - -b.
+        if rendered[1] < precedence or right and (rendered[1] == precedence or rendered[0][0] == "-"):
+            return parenthesize(rendered)
+        return rendered[0]
+
+    def _render_node(self, expr: Expression) -> Rendered:
+        if isinstance(expr, Number):
+            return render_number(expr.value)
+        elif isinstance(expr, Variable):
+            return (expr.name, ATOM)
+        elif isinstance(expr, Undefined):
+            return ("\\text{undefined}", ATOM)
+        elif isinstance(expr, UnaryOp):
+            if expr.op == "-":
+                operand = self._render(expr.expr)
+                text = parenthesize(operand) if operand[1] <= NEGATION else operand[0]
+                return (f"-{text}", NEGATION)
+            name = f"\\{expr.op}" if expr.op in functions else f"\\operatorname{{{expr.op}}}"
+            return (f"{name}\\left({self.render(expr.expr)}\\right)", FUNCTION)
+        elif isinstance(expr, BinaryOp):
+            if expr.op == "/":
+                return (f"\\frac{{{self.render(expr.left)}}}{{{self.render(expr.right)}}}", FRACTION)
+            if expr.op == "^":
+                base = self._operand(expr.left, POWER + 1, False)
+                return (f"{base}^{{{self.render(expr.right)}}}", POWER)
+            precedence, symbol = binary_ops.get(expr.op, (SUM, expr.op))
+            left = self._operand(expr.left, precedence, False)
+            right = self._operand(expr.right, precedence, True)
+            return (f"{left} {symbol} {right}", precedence)
+        elif isinstance(expr, NaryOp):
+            precedence, symbol = binary_ops[expr.op]
+            operands = [self._operand(arg, precedence, i > 0) for i, arg in enumerate(expr.args)]
+            return (f" {symbol} ".join(operands), precedence)
+        raise TypeError(f"cannot render {expr!r}")
+
+def render_number(value) -> Rendered:
+    if isinstance(value, Fraction):
+        text = f"\\frac{{{abs(value.numerator)}}}{{{value.denominator}}}"
+        return (f"-{text}", NEGATION) if value < 0 else (text, FRACTION)
+    if isinstance(value, float):
+        text, precedence = render_float(abs(value))
+        return (f"-{text}", NEGATION) if value < 0 else (text, precedence)
+    text = str(value)
+    return (text, NEGATION) if value < 0 else (text, ATOM)
+
+def render_float(value: float) -> Rendered:
+    """A nonnegative float to 15 significant digits, so the binary rounding of
+    0.1 + 0.2 shows as 0.3, with any exponent written as a power of ten."""
+    if value == math.inf:
+        return ("\\infty", ATOM)
+    if value != value:
+        return ("\\mathrm{NaN}", ATOM)
+    mantissa, _, exponent = f"{value:.15g}".partition("e")
+    if exponent:
+        return (f"{mantissa} \\times 10^{{{int(exponent)}}}", PRODUCT)
+    return (mantissa, ATOM)
+
+def to_latex(expr: Expression) -> str:
+    return LatexRenderer().render(expr)
+
+if __name__ == "__main__":
+    examples = sys.argv[1:] or ["((a + b) * (c - (d - e)))", "(((x ^ 2) ^ 3) + ((1 / 2) * -(y)))",
+                                "(sin((x / y)) - (-3 * 1/3))", "((a * b) / (c + (d + e)))"]
+    for text in examples:
+        print(f"{text}  ->  {to_latex(parse_expression(text))}")
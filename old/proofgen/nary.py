@@ -0,0 +1,265 @@
+from functools import cmp_to_key
+from typing import Dict, Iterable, List, Optional, Tuple
+import sys
+
+from rewrite import (BinaryOp, Expression, ExpressionPrinter, NaryOp, Number, Rule, UnaryOp, Undefined, Variable,
+                     children, evaluate_op, number, parse_expression)
+
+printer = ExpressionPrinter()
+
+# Operators whose chains are flattened, with their identity elements.
+flat_ops = {"+": 0, "*": 1}
+
+_rank = {Number: 0, Variable: 1, Undefined: 2, UnaryOp: 3, BinaryOp: 4, NaryOp: 5}
+
+def compare(a: Expression, b: Expression) -> int:
+    """Canonical operand order: constants first, then variables, then compound terms.
+
+    The trees are walked only down to their first difference, which is
+    usually at the root, so sorting a chain does not cost a print of every
+    operand.
+    """
+    if a is b:
+        return 0
+    if type(a) is not type(b):
+        return -1 if _rank[type(a)] < _rank[type(b)] else 1
+    if isinstance(a, Number):
+        return (a.value > b.value) - (a.value < b.value)
+    elif isinstance(a, Variable):
+        return (a.name > b.name) - (a.name < b.name)
+    elif isinstance(a, Undefined):
+        return 0
+    if a.op != b.op:
+        return -1 if a.op < b.op else 1
+    kids_a, kids_b = children(a), children(b)
+    for kid_a, kid_b in zip(kids_a, kids_b):
+        order = compare(kid_a, kid_b)
+        if order:
+            return order
+    return (len(kids_a) > len(kids_b)) - (len(kids_a) < len(kids_b))
+
+sort_key = cmp_to_key(compare)
+
+def make_nary(op: str, args: List[Expression]) -> Expression:
+    """The sorted `op` chain of `args`, splicing in operands that are themselves `op` chains.
+
+    Two operands stay a BinaryOp, as parse_expression() reads them, so the
+    binary rules keep applying to them; only longer chains become a NaryOp.
+    """
+    flat = []
+    stack = list(reversed(args))
+    while stack:
+        arg = stack.pop()
+        if isinstance(arg, (BinaryOp, NaryOp)) and arg.op == op:
+            stack.extend(reversed(children(arg)))
+        else:
+            flat.append(arg)
+    if not flat:
+        return number(flat_ops[op])
+    if len(flat) == 1:
+        return flat[0]
+    flat.sort(key=sort_key)
+    if len(flat) == 2:
+        return BinaryOp(op, flat[0], flat[1])
+    return NaryOp(op, tuple(flat))
+
+def flatten(expr: Expression) -> Expression:
+    """Convert every + and * chain of three or more operands of a binary expression into a NaryOp."""
+    if isinstance(expr, BinaryOp) and expr.op in flat_ops:
+        operands = []
+        stack = [expr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, BinaryOp) and node.op == expr.op:
+                stack.append(node.right)
+                stack.append(node.left)
+            else:
+                operands.append(flatten(node))
+        return make_nary(expr.op, operands)
+    elif isinstance(expr, BinaryOp):
+        return BinaryOp(expr.op, flatten(expr.left), flatten(expr.right))
+    elif isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, flatten(expr.expr))
+    elif isinstance(expr, NaryOp):
+        return make_nary(expr.op, [flatten(arg) for arg in expr.args])
+    return expr
+
+def unflatten(expr: Expression) -> Expression:
+    """Convert every NaryOp back into a left-leaning binary chain."""
+    if isinstance(expr, NaryOp):
+        args = [unflatten(arg) for arg in expr.args]
+        result = args[0]
+        for arg in args[1:]:
+            result = BinaryOp(expr.op, result, arg)
+        return result
+    elif isinstance(expr, BinaryOp):
+        return BinaryOp(expr.op, unflatten(expr.left), unflatten(expr.right))
+    elif isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, unflatten(expr.expr))
+    return expr
+
+def split_coefficient(term: Expression) -> Tuple[Expression, Expression]:
+    """(coefficient, rest) of a term such as 3*a; the coefficient of a bare term is 1.
+
+    A constant is its own coefficient, of 1, so the constants of a sum are
+    collected together.
+    """
+    if isinstance(term, Number):
+        return term, number(1)
+    elif isinstance(term, NaryOp) and term.op == "*" and isinstance(term.args[0], Number):
+        return term.args[0], make_nary("*", list(term.args[1:]))
+    elif isinstance(term, BinaryOp) and term.op == "*" and isinstance(term.left, Number):
+        return term.left, term.right
+    return number(1), term
+
+def split_exponent(factor: Expression) -> Tuple[Expression, Expression]:
+    """(base, exponent) of a factor such as x^3; the exponent of a bare factor is 1."""
+    if isinstance(factor, BinaryOp) and factor.op == "^" and isinstance(factor.right, Number):
+        return factor.left, factor.right
+    return factor, number(1)
+
+def group(items: List[Tuple[Expression, Expression]]) -> Dict[Expression, List[Expression]]:
+    """Group (key, number) pairs by key in one pass, keeping first-occurrence order."""
+    groups: Dict[Expression, List[Expression]] = {}
+    for key, value in items:
+        groups.setdefault(key, []).append(value)
+    return groups
+
+class CollectLikeTerms(Rule):
+    """Collects the like terms of a sum, e.g. a + b + a + 2*a + 1 + 2 -> 3 + 4*a + b.
+
+    The operands are grouped by hashing in a single pass, so a sum of n terms
+    is collected in O(n), wherever the like terms sit in the sum.
+    """
+
+    def keys(self) -> List[Optional[tuple]]:
+        # Two-term sums are BinaryOps.
+        return [(NaryOp, "+"), (BinaryOp, "+")]
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if not (isinstance(expr, (BinaryOp, NaryOp)) and expr.op == "+"):
+            return False
+        terms = children(expr)
+        groups = group([split_coefficient(arg)[::-1] for arg in terms])
+        if len(groups) == len(terms):
+            return False
+        bindings["groups"] = groups
+        return True
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        terms = []
+        one = number(1)
+        for term, coefficients in bindings["groups"].items():
+            total = coefficients[0]
+            for coefficient in coefficients[1:]:
+                total = evaluate_op("+", total, coefficient)
+            if total.value == 0:
+                continue
+            elif term == one:
+                terms.append(total)
+            elif total == one:
+                terms.append(term)
+            else:
+                terms.append(make_nary("*", [total, term]))
+        return make_nary("+", terms)
+
+class CollectRepeatedFactors(Rule):
+    """Collects the repeated factors of a product into powers, e.g. x * y * x * x -> x^3 * y."""
+
+    def keys(self) -> List[Optional[tuple]]:
+        return [(NaryOp, "*"), (BinaryOp, "*")]
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if not (isinstance(expr, (BinaryOp, NaryOp)) and expr.op == "*"):
+            return False
+        factors = children(expr)
+        groups = group([split_exponent(arg) for arg in factors])
+        if len(groups) == len(factors):
+            return False
+        bindings["groups"] = groups
+        return True
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        factors = []
+        for base, exponents in bindings["groups"].items():
+            total = sum(e.value for e in exponents)
+            if total == 1:
+                factors.append(base)
+            elif total != 0:
+                factors.append(BinaryOp("^", base, number(total)))
+        return make_nary("*", factors)
+
+# Binding under which OperandPairs keeps the rewritten chain; not a valid variable name.
+_rewritten = "rewritten chain"
+
+class OperandPairs(Rule):
+    """A binary rule that also applies to two adjacent operands of a longer + or * chain.
+
+    e.g. Eval on (2 + 3 + x) -> (5 + x), or Identity of Addition on
+    (0 + a + b) -> (a + b).  Operands are sorted, so constants sit next to
+    each other, and so do equal terms.  Both orders of each adjacent pair are
+    tried and the first rewrite that changes the chain is used; a rule such
+    as commutativity, which the sorted form already absorbs, never fires.
+    Elsewhere the rule behaves as the one it wraps, under the same name.
+    """
+
+    def __init__(self, rule: Rule, ops: Iterable[str]):
+        super().__init__(rule.name, rule.pattern, rule.replacement, rule.evaluate)
+        self.rule = rule
+        self.ops = list(ops)
+
+    def keys(self) -> List[Optional[tuple]]:
+        return self.rule.keys() + [(NaryOp, op) for op in self.ops]
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if not (isinstance(expr, NaryOp) and expr.op in self.ops):
+            return self.rule.match(expr, pattern, bindings)
+        args = expr.args
+        for i in range(len(args) - 1):
+            for left, right in ((args[i], args[i + 1]), (args[i + 1], args[i])):
+                pair = {}
+                if self.rule.match(BinaryOp(expr.op, left, right), self.rule.pattern, pair):
+                    rewritten = self.rule.instantiate(self.rule.replacement, pair)
+                    chain = make_nary(expr.op, list(args[:i]) + [rewritten] + list(args[i + 2:]))
+                    if chain != expr:
+                        bindings[_rewritten] = chain
+                        return True
+        return False
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        if _rewritten in bindings:
+            return bindings[_rewritten]
+        return self.rule.instantiate(template, bindings)
+
+def on_operand_pairs(rules: List[Rule]) -> List[Rule]:
+    """`rules` for the flattened form: each + or * rule, and each rule that may
+    fire anywhere (Eval), also applies to adjacent operands of longer chains."""
+    lifted = []
+    for rule in rules:
+        if isinstance(rule.pattern, BinaryOp) and rule.pattern.op in flat_ops:
+            rule = OperandPairs(rule, [rule.pattern.op])
+        elif rule.key() is None:
+            rule = OperandPairs(rule, flat_ops)
+        lifted.append(rule)
+    return lifted
+
+# Rules over the flattened form; the patterns only serve as index keys.
+nary_rules = [
+    CollectLikeTerms("Collect Like Terms",
+         NaryOp("+", (Variable("a"), Variable("a"))),
+         BinaryOp("*", Variable("count"), Variable("a"))),
+    CollectRepeatedFactors("Collect Repeated Factors",
+         NaryOp("*", (Variable("x"), Variable("x"))),
+         BinaryOp("^", Variable("x"), Variable("count"))),
+]
+
+if __name__ == "__main__":
+    examples = sys.argv[1:] or ["(((a + a) + a) + a)", "((x * x) * x)", "((a + (b + a)) + (2 * a))",
+                                "((x * (y * x)) * (x ^ 2))"]
+    for text in examples:
+        expr = flatten(parse_expression(text))
+        print(f"{text}  ->  {printer.to_string(expr)}")
+        for rule in nary_rules:
+            for path, rewritten in rule.rewrites(expr):
+                print(f"  {rule.name} at {list(path)}: {printer.to_string(rewritten)}"
+                      f"  (binary: {printer.to_string(unflatten(rewritten))})")
@@ -0,0 +1,217 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+
+from check import check_record
+from dedup import NearDuplicateFilter, shingles
+from generate import generate_batch
+
+def _ignore_sigint():
+    # Workers finish their chunk; the parent decides when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Pool tasks return (batch, items processed, seconds spent) so the parent can
+# keep per-stage metrics.
+
+def generate_chunk(indices: List[int], depth: int, steps: int, seed: int) -> tuple:
+    """Worker side of the generation stage: proofs plus their dedup shingles."""
+    start = time.perf_counter()
+    records, _ = generate_batch(indices, depth, steps, seed, profile=False)
+    batch = [(record, shingles(record)) for record in records]
+    return batch, len(batch), time.perf_counter() - start
+
+def validate_chunk(batch: list) -> tuple:
+    start = time.perf_counter()
+    valid = [(record, shingle_set) for record, shingle_set in batch if check_record(record) is None]
+    return valid, len(batch), time.perf_counter() - start
+
+class StageMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.kept = 0
+        self.busy = 0.0
+
+    def to_dict(self, elapsed: float) -> dict:
+        return {"stage": self.name, "items": self.items, "busy_s": round(self.busy, 3),
+                "items_per_s": round(self.items / elapsed, 1) if elapsed else 0.0}
+
+class ShardWriter:
+    def __init__(self, directory: str, shard_size: int):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.shard = 0
+        self.in_shard = 0
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, records: List[dict]):
+        for record in records:
+            if self.file is None or self.in_shard == self.shard_size:
+                self.close()
+                self.file = open(os.path.join(self.directory, f"shard-{self.shard:05d}.jsonl"), "w")
+                self.shard += 1
+                self.in_shard = 0
+            self.file.write(json.dumps(record) + "\n")
+            self.in_shard += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Pipeline:
+    """generate -> validate -> dedup -> write, connected by bounded queues.
+
+    Items move between stages in batches.  Every queue is bounded, so a slow
+    stage fills the queue in front of it and the generator stops submitting
+    work instead of piling up results in memory.  Generation and validation run
+    in a process pool and disk writes run in a thread, so none of them blocks
+    the event loop.
+    On SIGINT no new work is submitted, but everything already in flight is
+    drained through every stage and written out.
+    """
+
+    def __init__(self, output: str, count: int, seed: int, depth: int = 3, steps: int = 10,
+                 workers: int = os.cpu_count(), chunk_size: int = 256, queue_size: int = 8,
+                 shard_size: int = 100000, threshold: float = 0.8, report_every: float = 5.0):
+        self.output = output
+        self.count = count
+        self.seed = seed
+        self.depth = depth
+        self.steps = steps
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.writer = ShardWriter(output, shard_size)
+        self.dedup = NearDuplicateFilter(threshold)
+        self.metrics = {name: StageMetrics(name) for name in ("generate", "validate", "dedup", "write")}
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.stopping: Optional[asyncio.Event] = None
+        self.queues: List[asyncio.Queue] = []
+
+    async def generate(self, out: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        metrics = self.metrics["generate"]
+        pending = set()
+        for start in range(0, self.count, self.chunk_size):
+            if self.stopping.is_set():
+                break
+            indices = list(range(start, min(start + self.chunk_size, self.count)))
+            pending.add(loop.run_in_executor(self.pool, generate_chunk, indices, self.depth, self.steps, self.seed))
+            if len(pending) >= self.workers:
+                pending = await self._forward(pending, out, metrics)
+        while pending:
+            pending = await self._forward(pending, out, metrics)
+        await out.put(None)
+
+    async def validate(self, inp: asyncio.Queue, out: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        metrics = self.metrics["validate"]
+        pending = set()
+        while (batch := await inp.get()) is not None:
+            pending.add(loop.run_in_executor(self.pool, validate_chunk, batch))
+            if len(pending) >= self.workers:
+                pending = await self._forward(pending, out, metrics)
+        while pending:
+            pending = await self._forward(pending, out, metrics)
+        await out.put(None)
+
+    async def _forward(self, pending: set, out: asyncio.Queue, metrics: StageMetrics) -> set:
+        """Wait for at least one pool task and pass its batch downstream."""
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            batch, seen, busy = future.result()
+            metrics.items += seen
+            metrics.kept += len(batch)
+            metrics.busy += busy
+            # Blocks while the next stage is behind: this is the backpressure
+            # that keeps the stage from submitting more work to the pool.
+            await out.put(batch)
+        return pending
+
+    async def deduplicate(self, inp: asyncio.Queue, out: asyncio.Queue):
+        metrics = self.metrics["dedup"]
+        while (batch := await inp.get()) is not None:
+            start = time.perf_counter()
+            # MinHash and LSH are CPU-bound; off the loop, the other stages keep feeding
+            # and draining the pool meanwhile.  This stage is the filter's only caller.
+            kept = await asyncio.to_thread(self.dedup.filter_batch, [record for record, _ in batch],
+                                           [s for _, s in batch])
+            metrics.busy += time.perf_counter() - start
+            metrics.items += len(batch)
+            await out.put(kept)
+        await out.put(None)
+
+    async def write(self, inp: asyncio.Queue):
+        metrics = self.metrics["write"]
+        while (batch := await inp.get()) is not None:
+            start = time.perf_counter()
+            await asyncio.to_thread(self.writer.write, batch)
+            metrics.busy += time.perf_counter() - start
+            metrics.items += len(batch)
+        await asyncio.to_thread(self.writer.close)
+
+    def report(self, elapsed: float) -> dict:
+        return {"elapsed_s": round(elapsed, 3),
+                "stages": [metrics.to_dict(elapsed) for metrics in self.metrics.values()],
+                "queue_depths": [queue.qsize() for queue in self.queues],
+                "invalid": self.metrics["validate"].items - self.metrics["validate"].kept,
+                "duplicates": self.dedup.dropped}
+
+    async def _reporter(self, started: float):
+        while True:
+            await asyncio.sleep(self.report_every)
+            print(json.dumps(self.report(time.perf_counter() - started)), file=sys.stderr)
+
+    async def run(self) -> dict:
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+        self.queues = [asyncio.Queue(self.queue_size) for _ in range(3)]
+        generated, validated, deduplicated = self.queues
+        started = time.perf_counter()
+        reporter = asyncio.create_task(self._reporter(started))
+        try:
+            with ProcessPoolExecutor(self.workers, initializer=_ignore_sigint) as self.pool:
+                await asyncio.gather(self.generate(generated),
+                                     self.validate(generated, validated),
+                                     self.deduplicate(validated, deduplicated),
+                                     self.write(deduplicated))
+        finally:
+            reporter.cancel()
+            loop.remove_signal_handler(signal.SIGINT)
+        report = self.report(time.perf_counter() - started)
+        report["interrupted"] = self.stopping.is_set()
+        with open(os.path.join(self.output, "metrics.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate, validate, deduplicate and shard a proof dataset.")
+    parser.add_argument("output", help="directory for the shards")
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--queue-size", type=int, default=8, help="batches each queue holds before applying backpressure")
+    parser.add_argument("--shard-size", type=int, default=100000)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--report-every", type=float, default=5.0, help="seconds between metric reports")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.output, args.count, args.seed, args.depth, args.steps, args.workers,
+                        args.chunk_size, args.queue_size, args.shard_size, args.threshold, args.report_every)
+    print(json.dumps(asyncio.run(pipeline.run()), indent=2))
+
+if __name__ == "__main__":
+    main()
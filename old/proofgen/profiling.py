@@ -0,0 +1,209 @@
+from collections import Counter
+from typing import Dict, List, Optional
+import functools
+import time
+
+import rewrite
+from rewrite import ProofGenerator, Rule
+
+class RuleStats:
+    fields = ("attempts", "successes", "nodes", "match_time", "instantiations", "instantiate_time",
+              "applies", "apply_time")
+
+    def __init__(self):
+        for field in self.fields:
+            setattr(self, field, 0)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.fields}
+
+    def merge(self, other: dict):
+        for field in self.fields:
+            setattr(self, field, getattr(self, field) + other.get(field, 0))
+
+class Profile:
+    """Per-rule counters for the rewrite engine.
+
+    Profiles are plain data and can be shipped between processes with
+    to_dict() and combined with merge().
+    """
+
+    def __init__(self):
+        self.rules: Dict[str, RuleStats] = {}
+        self.walks = 0
+        self.walk_time = 0.0
+        self.chosen: Counter = Counter()
+        self.walk_histograms: List[Counter] = []
+
+    def rule(self, name: str) -> RuleStats:
+        stats = self.rules.get(name)
+        if stats is None:
+            stats = self.rules[name] = RuleStats()
+        return stats
+
+    def record_walk(self, proof: list, elapsed: float):
+        histogram = Counter(step[0] for step in proof[1:])
+        self.walks += 1
+        self.walk_time += elapsed
+        self.chosen.update(histogram)
+        self.walk_histograms.append(histogram)
+
+    def to_dict(self) -> dict:
+        return {
+            "rules": {name: stats.to_dict() for name, stats in self.rules.items()},
+            "walks": self.walks,
+            "walk_time": self.walk_time,
+            "walk_histograms": [dict(histogram) for histogram in self.walk_histograms],
+        }
+
+    def merge(self, other: dict) -> "Profile":
+        for name, stats in other["rules"].items():
+            self.rule(name).merge(stats)
+        self.walks += other["walks"]
+        self.walk_time += other["walk_time"]
+        for histogram in other["walk_histograms"]:
+            histogram = Counter(histogram)
+            self.chosen.update(histogram)
+            self.walk_histograms.append(histogram)
+        return self
+
+    def report(self) -> str:
+        lines = [f"{self.walks} walks in {self.walk_time:.3f}s", "",
+                 f"{'rule':<40} {'attempts':>10} {'successes':>10} {'nodes':>10} "
+                 f"{'match s':>9} {'inst s':>9} {'chosen':>8}"]
+        ranked = sorted(self.rules.items(), key=lambda item: -(item[1].match_time + item[1].instantiate_time))
+        for name, stats in ranked:
+            lines.append(f"{name[:40]:<40} {stats.attempts:>10} {stats.successes:>10} {stats.nodes:>10} "
+                         f"{stats.match_time:>9.4f} {stats.instantiate_time:>9.4f} {self.chosen[name]:>8}")
+        return "\n".join(lines)
+
+    def collapsed_stacks(self) -> List[str]:
+        """Lines in the folded format read by flamegraph.pl and speedscope (weights in microseconds)."""
+        lines = []
+        matched = 0.0
+        for name, stats in self.rules.items():
+            frame = name.replace(";", ",")
+            for phase, seconds in (("match", stats.match_time), ("instantiate", stats.instantiate_time)):
+                if seconds > 0:
+                    lines.append(f"random_walk;{phase};{frame} {int(seconds * 1e6)}")
+                    matched += seconds
+        rest = self.walk_time - matched
+        if rest > 0:
+            lines.append(f"random_walk {int(rest * 1e6)}")
+        return lines
+
+    def write(self, prefix: str):
+        with open(prefix + ".txt", "w") as f:
+            f.write(self.report() + "\n")
+        with open(prefix + ".collapsed", "w") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
+
+# The active profile; None means instrumentation is off and the engine runs
+# its original, unwrapped methods.
+profile: Optional[Profile] = None
+_originals: Dict[tuple, object] = {}
+_depth = 0
+
+def _rule_classes() -> List[type]:
+    classes = [Rule]
+    for cls in classes:
+        classes.extend(sub for sub in cls.__subclasses__() if sub not in classes)
+    return classes
+
+def _wrap_match(fn):
+    @functools.wraps(fn)
+    def match(self, expr, pattern, bindings):
+        global _depth
+        stats = profile.rule(self.name)
+        stats.nodes += 1
+        if _depth:
+            return fn(self, expr, pattern, bindings)
+        _depth += 1
+        start = time.perf_counter()
+        try:
+            matched = fn(self, expr, pattern, bindings)
+        finally:
+            _depth -= 1
+        stats.match_time += time.perf_counter() - start
+        stats.attempts += 1
+        stats.successes += bool(matched)
+        return matched
+    return match
+
+def _wrap_instantiate(fn):
+    @functools.wraps(fn)
+    def instantiate(self, template, bindings):
+        global _depth
+        if _depth:
+            return fn(self, template, bindings)
+        _depth += 1
+        start = time.perf_counter()
+        try:
+            return fn(self, template, bindings)
+        finally:
+            _depth -= 1
+            stats = profile.rule(self.name)
+            stats.instantiations += 1
+            stats.instantiate_time += time.perf_counter() - start
+    return instantiate
+
+def _wrap_apply(fn):
+    @functools.wraps(fn)
+    def apply(self, expr):
+        start = time.perf_counter()
+        try:
+            return fn(self, expr)
+        finally:
+            stats = profile.rule(self.name)
+            stats.applies += 1
+            stats.apply_time += time.perf_counter() - start
+    return apply
+
+def _wrap_random_walk(fn):
+    @functools.wraps(fn)
+    def random_walk(self, *args, **kwargs):
+        start = time.perf_counter()
+        proof = fn(self, *args, **kwargs)
+        profile.record_walk(proof, time.perf_counter() - start)
+        return proof
+    return random_walk
+
+def enable() -> Profile:
+    """Start profiling by wrapping the engine's hot methods."""
+    global profile
+    if profile is not None:
+        return profile
+    profile = Profile()
+    wrappers = {"match": _wrap_match, "instantiate": _wrap_instantiate, "apply": _wrap_apply}
+    targets = [(cls, name, wrapper) for cls in _rule_classes() for name, wrapper in wrappers.items()]
+    targets.append((ProofGenerator, "random_walk", _wrap_random_walk))
+    for cls, name, wrapper in targets:
+        if name in cls.__dict__:
+            _originals[(cls, name)] = cls.__dict__[name]
+            setattr(cls, name, wrapper(cls.__dict__[name]))
+    return profile
+
+def disable() -> Optional[Profile]:
+    """Restore the original methods and return the collected profile."""
+    global profile
+    for (cls, name), fn in _originals.items():
+        setattr(cls, name, fn)
+    _originals.clear()
+    collected, profile = profile, None
+    return collected
+
+def merge_profiles(profiles: List[dict]) -> Profile:
+    merged = Profile()
+    for other in profiles:
+        merged.merge(other)
+    return merged
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(0)
+    enable()
+    generator = ProofGenerator(rewrite.simple_rules)
+    for _ in range(200):
+        generator.random_walk(rewrite.generate_random_expression(4), 10)
+    print(disable().report())
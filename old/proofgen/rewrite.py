@@ -0,0 +1,610 @@
+from array import array
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import random
+import re
+
+debug = False
+
+# AST node types.  Nodes are immutable and slotted: proofs keep every
+# intermediate expression alive, and untouched subtrees are shared between
+# consecutive steps, so per-node size bounds how many proofs fit in memory.
+@dataclass(frozen=True, slots=True)
+class Number:
+    value: Union[int, Fraction, float]
+
+@dataclass(frozen=True, slots=True)
+class Variable:
+    name: str
+
+@dataclass(frozen=True, slots=True)
+class BinaryOp:
+    op: str
+    left: 'Expression'
+    right: 'Expression'
+
+@dataclass(frozen=True, slots=True)
+class UnaryOp:
+    op: str
+    expr: 'Expression'
+
+# Optional flattened form of + and * (see nary.py): the operands of a whole
+# chain, sorted so that equal terms are adjacent and the order is canonical.
+@dataclass(frozen=True, slots=True)
+class NaryOp:
+    op: str
+    args: Tuple['Expression', ...]
+
+# The value of an operation that has none, such as 1 / 0.  It absorbs every
+# operation folded over it.
+@dataclass(frozen=True, slots=True)
+class Undefined:
+    pass
+
+undefined = Undefined()
+
+Expression = Union[Number, Variable, BinaryOp, UnaryOp, NaryOp, Undefined]
+
+_leaves: Dict[tuple, Expression] = {}
+
+def leaf(cls: type, value) -> Expression:
+    """A shared Number or Variable node; leaves are by far the most common nodes."""
+    key = (cls, type(value), value)
+    node = _leaves.get(key)
+    if node is None:
+        node = _leaves[key] = cls(value)
+    return node
+
+# Interned constants: every int in [-1024, 1024] and fractions with small
+# terms.  Larger values are rare and would only grow the tables.
+_small_ints = [leaf(Number, value) for value in range(-1024, 1025)]
+_fractions: Dict[Tuple[int, int], Number] = {}
+
+def number(value: Union[int, Fraction, float]) -> Number:
+    """The Number node of a value.
+
+    Constants stay exact: ints while they can, Fraction once a division does
+    not come out even.  Only floats read from input stay floats.
+    """
+    if type(value) is int:
+        if -1024 <= value <= 1024:
+            return _small_ints[value + 1024]
+        return Number(value)
+    if type(value) is Fraction:
+        p, q = value.numerator, value.denominator
+        if q == 1:
+            return number(p)
+        if -1024 <= p <= 1024 and q <= 1024:
+            node = _fractions.get((p, q))
+            if node is None:
+                node = _fractions[(p, q)] = Number(value)
+            return node
+    return Number(value)
+
+# A path is the sequence of child indices from the root to a subexpression:
+# 0/1 select the left/right operand of a BinaryOp, 0 the operand of a UnaryOp
+# and i the i-th operand of a NaryOp.
+Path = Tuple[int, ...]
+
+class ExpressionPrinter:
+    def to_string(self, expr: Expression) -> str:
+        if isinstance(expr, Number):
+            return str(expr.value)
+        elif isinstance(expr, Undefined):
+            return "undefined"
+        elif isinstance(expr, Variable):
+            return expr.name
+        elif isinstance(expr, BinaryOp):
+            return f"({self.to_string(expr.left)} {expr.op} {self.to_string(expr.right)})"
+        elif isinstance(expr, UnaryOp):
+            return f"{expr.op}({self.to_string(expr.expr)})"
+        elif isinstance(expr, NaryOp):
+            return "(" + f" {expr.op} ".join(self.to_string(arg) for arg in expr.args) + ")"
+
+# A Fraction prints as "1/3", without the spaces the printer puts around "/".
+_token = re.compile(r"\s*(-?\d+(?:/\d+|(?:\.\d+)?(?:e[-+]?\d+)?)|[A-Za-z_]\w*|\S)")
+
+def tokenize(text: str) -> List[str]:
+    return _token.findall(text)
+
+def parse_expression(text: str) -> Expression:
+    """Parse the fully parenthesized output of ExpressionPrinter.to_string.
+
+    "(a + b + c)" is read as a NaryOp; two operands always give a BinaryOp.
+    """
+    tokens = tokenize(text)
+    pos = 0
+
+    def parse() -> Expression:
+        nonlocal pos
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            left = parse()
+            op = tokens[pos]
+            pos += 1
+            args = [left, parse()]
+            while tokens[pos] == op:
+                pos += 1
+                args.append(parse())
+            pos += 1  # ")"
+            return BinaryOp(op, *args) if len(args) == 2 else NaryOp(op, tuple(args))
+        if pos < len(tokens) and tokens[pos] == "(" and not token[-1].isdigit():
+            pos += 1
+            operand = parse()
+            pos += 1  # ")"
+            return UnaryOp(token, operand)
+        if token[-1].isdigit():
+            if "/" in token:
+                return number(Fraction(token))
+            return number(float(token) if "." in token or "e" in token else int(token))
+        if token == "undefined":
+            return undefined
+        return leaf(Variable, token)
+
+    return parse()
+
+def children(expr: Expression) -> Tuple[Expression, ...]:
+    if isinstance(expr, BinaryOp):
+        return (expr.left, expr.right)
+    elif isinstance(expr, UnaryOp):
+        return (expr.expr,)
+    elif isinstance(expr, NaryOp):
+        return expr.args
+    return ()
+
+def subexpressions(expr: Expression, path: Path = ()) -> Iterator[Tuple[Path, Expression]]:
+    """Yield every (path, subexpression) pair in pre-order."""
+    stack = [(path, expr)]
+    while stack:
+        path, expr = stack.pop()
+        yield path, expr
+        kids = children(expr)
+        for i in range(len(kids) - 1, -1, -1):
+            stack.append((path + (i,), kids[i]))
+
+def get_at(expr: Expression, path: Path) -> Expression:
+    for i in path:
+        expr = children(expr)[i]
+    return expr
+
+def replace_at(expr: Expression, path: Path, new: Expression) -> Expression:
+    if not path:
+        return new
+    i, rest = path[0], path[1:]
+    if isinstance(expr, BinaryOp):
+        if i == 0:
+            return BinaryOp(expr.op, replace_at(expr.left, rest, new), expr.right)
+        return BinaryOp(expr.op, expr.left, replace_at(expr.right, rest, new))
+    elif isinstance(expr, UnaryOp):
+        return UnaryOp(expr.op, replace_at(expr.expr, rest, new))
+    elif isinstance(expr, NaryOp):
+        return NaryOp(expr.op, expr.args[:i] + (replace_at(expr.args[i], rest, new),) + expr.args[i + 1:])
+    raise IndexError(f"path {path} does not exist in {expr}")
+
+def head(expr: Expression) -> tuple:
+    """The root symbol of an expression, used as the key of the rule index."""
+    if isinstance(expr, BinaryOp):
+        return (BinaryOp, expr.op)
+    elif isinstance(expr, UnaryOp):
+        return (UnaryOp, expr.op)
+    elif isinstance(expr, NaryOp):
+        return (NaryOp, expr.op)
+    elif isinstance(expr, Number):
+        return (Number, expr.value)
+    elif isinstance(expr, Undefined):
+        return (Undefined,)
+    return (Variable, expr.name)
+
+def pattern_variables(pattern: Expression) -> List[str]:
+    """Names of the pattern variables in order of first occurrence."""
+    names = []
+    for _, sub in subexpressions(pattern):
+        if isinstance(sub, Variable) and sub.name not in names:
+            names.append(sub.name)
+    return names
+
+def divide(a: Union[int, Fraction, float], b: Union[int, Fraction, float]) -> Union[int, Fraction, float]:
+    """a / b for b != 0, exact unless one side is a float."""
+    if type(a) is int and type(b) is int:
+        quotient, remainder = divmod(a, b)
+        return quotient if remainder == 0 else Fraction(a, b)
+    if isinstance(a, float) or isinstance(b, float):
+        return a / b
+    return Fraction(a) / b
+
+def evaluate_op(op: str, left: Expression, right: Optional[Expression] = None) -> Optional[Expression]:
+    """Fold one operator applied to constant operands, or None if it cannot be folded.
+
+    Folding is exact; division by zero, and any operation on undefined, gives undefined.
+    """
+    if right is None:
+        if op == '-':
+            if type(left) is Number:
+                return number(-left.value)
+            if type(left) is Undefined:
+                return undefined
+        return None
+    if type(left) is Number and type(right) is Number:
+        a, b = left.value, right.value
+        if type(a) is int and type(b) is int:
+            # Small-int fast path: no Fraction arithmetic at all.
+            if op == '+':
+                return number(a + b)
+            elif op == '-':
+                return number(a - b)
+            elif op == '*':
+                return number(a * b)
+            elif op == '/':
+                if b == 0:
+                    return undefined
+                quotient, remainder = divmod(a, b)
+                return number(quotient if remainder == 0 else Fraction(a, b))
+            return None
+        if op == '+':
+            return number(a + b)
+        elif op == '-':
+            return number(a - b)
+        elif op == '*':
+            return number(a * b)
+        elif op == '/':
+            if b == 0:
+                return undefined
+            return number(a / b if isinstance(a, float) or isinstance(b, float) else Fraction(a) / b)
+        return None
+    if isinstance(left, (Number, Undefined)) and isinstance(right, (Number, Undefined)) and op in "+-*/":
+        return undefined
+    return None
+
+class Rule:
+    def __init__(self, name: str, pattern: Expression, replacement: Expression, evaluate: bool = False):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.evaluate = evaluate  # flag to indicate if evaluation should be performed
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r})"
+
+    def key(self) -> Optional[tuple]:
+        """Index key of the pattern root, or None if the rule may fire anywhere."""
+        if isinstance(self.pattern, Variable):
+            return None
+        return head(self.pattern)
+
+    def keys(self) -> List[Optional[tuple]]:
+        """Every index key the rule is filed under; see key()."""
+        return [self.key()]
+
+    def apply(self, expr: Expression) -> Optional[Expression]:
+        """Rewrite the first match in pre-order, or return None."""
+        for path, new_expr in self.rewrites(expr):
+            return new_expr
+        return None
+
+    def apply_at(self, expr: Expression, path: Path) -> Optional[Expression]:
+        new_sub = self._apply_to_root(get_at(expr, path))
+        if new_sub is None:
+            return None
+        return replace_at(expr, path, new_sub)
+
+    def rewrites(self, expr: Expression) -> Iterator[Tuple[Path, Expression]]:
+        """Yield (path, rewritten expression) for every position the rule matches."""
+        for path, sub in subexpressions(expr):
+            new_sub = self._apply_to_root(sub)
+            if new_sub is not None:
+                yield path, replace_at(expr, path, new_sub)
+
+    def _apply_to_root(self, expr: Expression) -> Optional[Expression]:
+        bindings = {}
+        if self.match(expr, self.pattern, bindings):
+            return self.instantiate(self.replacement, bindings)
+        return None
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if debug:
+            print(f"Matching {expr} with {pattern}")
+        if isinstance(pattern, Variable):
+            if pattern.name in bindings:
+                return bindings[pattern.name] == expr
+            bindings[pattern.name] = expr
+            if debug:
+                print(f"Bound variable {pattern.name} to {expr}")
+            return True
+        elif isinstance(pattern, Number) and isinstance(expr, Number):
+            return pattern.value == expr.value
+        elif isinstance(pattern, BinaryOp) and isinstance(expr, BinaryOp):
+            return (pattern.op == expr.op and
+                    self.match(expr.left, pattern.left, bindings) and
+                    self.match(expr.right, pattern.right, bindings))
+        elif isinstance(pattern, UnaryOp) and isinstance(expr, UnaryOp):
+            return pattern.op == expr.op and self.match(expr.expr, pattern.expr, bindings)
+        return False
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        if isinstance(template, Variable):
+            return bindings.get(template.name, template)
+        elif isinstance(template, Number):
+            return template
+        elif isinstance(template, BinaryOp):
+            left = self.instantiate(template.left, bindings)
+            right = self.instantiate(template.right, bindings)
+            if self.evaluate:
+                folded = evaluate_op(template.op, left, right)
+                if folded is not None:
+                    return folded
+            return BinaryOp(template.op, left, right)
+        elif isinstance(template, UnaryOp):
+            expr = self.instantiate(template.expr, bindings)
+            if self.evaluate:
+                folded = evaluate_op(template.op, expr)
+                if folded is not None:
+                    return folded
+            return UnaryOp(template.op, expr)
+
+def evaluate_expression(expr: Expression) -> Expression:
+    if isinstance(expr, BinaryOp):
+        left = evaluate_expression(expr.left)
+        right = evaluate_expression(expr.right)
+        folded = evaluate_op(expr.op, left, right)
+        return folded if folded is not None else BinaryOp(expr.op, left, right)
+    elif isinstance(expr, UnaryOp):
+        sub_expr = evaluate_expression(expr.expr)
+        folded = evaluate_op(expr.op, sub_expr)
+        return folded if folded is not None else UnaryOp(expr.op, sub_expr)
+    return expr
+
+class EvalRule(Rule):
+    """Folds a single operator whose operands are all constants."""
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if isinstance(expr, BinaryOp):
+            folded = evaluate_op(expr.op, expr.left, expr.right)
+        elif isinstance(expr, UnaryOp):
+            folded = evaluate_op(expr.op, expr.expr)
+        else:
+            return False
+        if folded is None:
+            return False
+        bindings["value"] = folded
+        return True
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        return bindings["value"]
+
+class GeneralRule(Rule):
+    """Collects a left-leaning chain of repeated terms, e.g. a + a + a -> 3 * a."""
+
+    def match(self, expr: Expression, pattern: Expression, bindings: dict) -> bool:
+        if isinstance(expr, BinaryOp) and expr.op == "+":
+            elements = self.collect_repeated_elements(expr)
+            if elements:
+                bindings["count"] = number(len(elements))
+                bindings["element"] = elements[0]
+                return True
+        return False
+
+    def collect_repeated_elements(self, expr: Expression) -> Optional[List[Expression]]:
+        elements = []
+        while isinstance(expr, BinaryOp) and expr.op == "+":
+            elements.append(expr.right)
+            expr = expr.left
+        elements.append(expr)
+        if len(elements) > 2 and all(e == elements[0] for e in elements):
+            return elements
+        return None
+
+    def instantiate(self, template: Expression, bindings: dict) -> Expression:
+        return BinaryOp("*", bindings["count"], bindings["element"])
+
+# A redex is a rule together with the position it matches and its bindings.
+Redex = Tuple[Rule, Path, dict]
+
+class RuleIndex:
+    """Indexes rules by the root symbol of their pattern.
+
+    Only the rules whose pattern head equals the head of a subexpression (plus
+    the rules with a bare variable pattern) are tried against it.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = list(rules)
+        self._by_head: Dict[tuple, List[Rule]] = {}
+        self._wildcard: List[Rule] = []
+        for rule in self.rules:
+            for key in rule.keys():
+                if key is None:
+                    self._wildcard.append(rule)
+                else:
+                    self._by_head.setdefault(key, []).append(rule)
+        self._candidates: Dict[tuple, List[Rule]] = {}
+
+    def candidates(self, expr: Expression) -> List[Rule]:
+        key = head(expr)
+        rules = self._candidates.get(key)
+        if rules is None:
+            keyed = self._by_head.get(key, [])
+            rules = [rule for rule in self.rules if rule in keyed or rule in self._wildcard]
+            self._candidates[key] = rules
+        return rules
+
+    def redexes(self, expr: Expression) -> List[Redex]:
+        found = []
+        for path, sub in subexpressions(expr):
+            for rule in self.candidates(sub):
+                bindings = {}
+                if rule.match(sub, rule.pattern, bindings):
+                    found.append((rule, path, bindings))
+        return found
+
+def rewrite_redex(expr: Expression, redex: Redex) -> Expression:
+    rule, path, bindings = redex
+    return replace_at(expr, path, rule.instantiate(rule.replacement, bindings))
+
+# A proof step: the rule name, the expression after the step, and the path of
+# the subexpression the rule rewrote (None for the initial expression).
+Step = Tuple[str, Expression, Optional[Path]]
+
+class ProofGenerator:
+    """Random walks over the rewrite graph.
+
+    `rng` is anything with the random()/randint()/choice() interface of the
+    random module (a random.Random or an rng.ProofRandom); by default the
+    global random module is used.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.index = RuleIndex(rules)
+        self.rule_ids = {}
+        for i, rule in enumerate(rules):
+            self.rule_ids.setdefault(rule.name, i)
+
+    def compact(self, proof: List[Step]) -> "CompactProof":
+        return CompactProof(proof[0][1], [self.rule_ids[name] for name, _, _ in proof[1:]],
+                            [path for _, _, path in proof[1:]])
+
+    def expand(self, compact: "CompactProof") -> List[Step]:
+        """Rebuild the full proof, replaying each step at its recorded path."""
+        current = compact.start
+        proof = [("Initial", current, None)]
+        for rule_id, code in zip(compact.rule_ids, compact.paths):
+            rule = self.rules[rule_id]
+            path = code if isinstance(code, tuple) else decode_path(code)
+            current = rule.apply_at(current, path)
+            proof.append((rule.name, current, path))
+        return proof
+
+    def choose(self, redexes: List[Redex], rng=random) -> Redex:
+        # Pick an applicable rule uniformly, then one of its positions.
+        by_rule: Dict[Rule, List[Redex]] = {}
+        for redex in redexes:
+            by_rule.setdefault(redex[0], []).append(redex)
+        rule = rng.choice(list(by_rule))
+        return rng.choice(by_rule[rule])
+
+    def random_walk(self, start_expression: Expression, steps: int, rng=random) -> List[Step]:
+        current = start_expression
+        proof = [("Initial", current, None)]
+        for _ in range(steps):
+            redexes = self.index.redexes(current)
+            if not redexes:
+                break
+            redex = self.choose(redexes, rng)
+            current = rewrite_redex(current, redex)
+            proof.append((redex[0].name, current, redex[1]))
+        return proof
+
+def encode_path(path: Path) -> int:
+    """Pack a path of binary child indices into an int, with a leading 1 bit as terminator."""
+    code = 1
+    for i in path:
+        code = code << 1 | i
+    return code
+
+def decode_path(code: int) -> Path:
+    return tuple(int(bit) for bit in bin(code)[3:])
+
+class CompactProof:
+    """A proof held as its start expression plus one (rule id, path code) pair per step.
+
+    Intermediate expressions are rebuilt on demand by ProofGenerator.expand(),
+    which makes this the cheap form for proofs that wait in memory before
+    being written out.
+    """
+
+    __slots__ = ("start", "rule_ids", "paths")
+
+    def __init__(self, start: Expression, rule_ids: List[int], paths: List[Path]):
+        self.start = start
+        self.rule_ids = array("H", rule_ids)
+        if any(i > 1 for path in paths for i in path):
+            # Paths into NaryOp operands are not binary; keep them as tuples.
+            self.paths = [encode_path(path) if all(i < 2 for i in path) else path for path in paths]
+            return
+        codes = [encode_path(path) for path in paths]
+        # Paths longer than 63 steps do not fit a machine word.
+        self.paths = array("Q", codes) if all(code < 2**64 for code in codes) else codes
+
+    def __len__(self) -> int:
+        return len(self.rule_ids) + 1
+
+def generate_random_expression(depth: int, rng=random) -> Expression:
+    if depth == 0 or rng.random() < 0.5:
+        return rng.choice([leaf(Number, rng.randint(1, 10)), leaf(Variable, chr(rng.randint(97, 122)))])
+    else:
+        op = rng.choice(["+", "-", "*", "/"])
+        left = generate_random_expression(depth - 1, rng)
+        right = generate_random_expression(depth - 1, rng)
+        return BinaryOp(op, left, right)
+
+# The rule set of proof.py
+basic_rules = [
+    Rule("Commutativity of Addition",
+         BinaryOp("+", Variable("A"), Variable("B")),
+         BinaryOp("+", Variable("B"), Variable("A"))),
+    Rule("Commutativity of Multiplication",
+         BinaryOp("*", Variable("A"), Variable("B")),
+         BinaryOp("*", Variable("B"), Variable("A"))),
+    Rule("Associativity of Addition",
+         BinaryOp("+", BinaryOp("+", Variable("A"), Variable("B")), Variable("C")),
+         BinaryOp("+", Variable("A"), BinaryOp("+", Variable("B"), Variable("C")))),
+    Rule("Distributive Property",
+         BinaryOp("*", Variable("A"), BinaryOp("+", Variable("B"), Variable("C"))),
+         BinaryOp("+", BinaryOp("*", Variable("A"), Variable("B")), BinaryOp("*", Variable("A"), Variable("C")))),
+    Rule("Identity of Addition",
+         BinaryOp("+", Variable("A"), Number(0)),
+         Variable("A")),
+    Rule("Identity of Multiplication",
+         BinaryOp("*", Variable("A"), Number(1)),
+         Variable("A"))
+]
+
+# The rule set of newdat.py
+simple_rules = basic_rules + [
+    Rule("Negation",
+         UnaryOp("-", Variable("A")),
+         BinaryOp("-", Number(0), Variable("A"))),
+    Rule("Double Negation",
+         UnaryOp("-", UnaryOp("-", Variable("A"))),
+         Variable("A")),
+    Rule("Additive Inverse",
+         BinaryOp("+", Variable("A"), UnaryOp("-", Variable("A"))),
+         Number(0)),
+    Rule("Multiplicative Inverse",
+         BinaryOp("*", Variable("A"), BinaryOp("/", Number(1), Variable("A"))),
+         Number(1)),
+    Rule("Rewrite 1 as X/X",
+         Number(1),
+         BinaryOp("/", Variable("X"), Variable("X"))),
+    Rule("Rewrite -4 as -1 * 4",
+         Number(-4),
+         BinaryOp("*", Number(-1), Number(4))),
+    Rule("Rewrite x + x as 2*x",
+         BinaryOp("+", Variable("x"), Variable("x")),
+         BinaryOp("*", Number(2), Variable("x"))),
+    GeneralRule("Rewrite n*a as Repeated",
+         BinaryOp("+", Variable("a"), Variable("a")),
+         BinaryOp("*", Variable("count"), Variable("a"))),
+    EvalRule("Eval", Variable("X"), Variable("X"), evaluate=True)
+]
+
+if __name__ == "__main__":
+    test_expressions = [
+        BinaryOp("*", BinaryOp("+", Variable("a"), Variable("a")), Number(4)),
+        BinaryOp("*", BinaryOp("+", Number(2), Number(3)), Number(4)),
+        BinaryOp("+", BinaryOp("*", Variable("a"), Variable("b")), BinaryOp("*", Variable("a"), Variable("c"))),
+        BinaryOp("+", Variable("a"), BinaryOp("+", Variable("a"), BinaryOp("+", Variable("a"), Variable("a"))))
+    ]
+
+    printer = ExpressionPrinter()
+    generator = ProofGenerator(simple_rules)
+
+    for expr in test_expressions:
+        print(f"\nStarting expression: {printer.to_string(expr)}")
+        proof = generator.random_walk(expr, 10)
+
+        print("Proof:")
+        for step, expr, _ in proof:
+            print(f"{step}: {printer.to_string(expr)}")
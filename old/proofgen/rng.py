@@ -0,0 +1,52 @@
+import hashlib
+import random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class ProofRandom:
+    """Random stream for proof `index` of the dataset with seed `dataset_seed`.
+
+    The stream comes from a counter-based Philox generator keyed by
+    (dataset_seed, index), so any proof can be regenerated on its own, in any
+    order, from those two numbers alone.  It offers the subset of the random
+    module interface used by the generator: random(), randint() and choice().
+    """
+
+    block = 256
+
+    def __init__(self, dataset_seed: int, index: int):
+        self.key = (dataset_seed % 2**64) << 64 | index % 2**64
+        self.generator = np.random.Generator(np.random.Philox(key=self.key))
+        self.buffer = []
+
+    def random(self) -> float:
+        if not self.buffer:
+            self.buffer = self.generator.random(self.block).tolist()
+            self.buffer.reverse()
+        return self.buffer.pop()
+
+    def randint(self, a: int, b: int) -> int:
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+def _fallback_random(dataset_seed: int, index: int) -> random.Random:
+    digest = hashlib.blake2b(f"{dataset_seed}:{index}".encode(), digest_size=16).digest()
+    return random.Random(int.from_bytes(digest, "little"))
+
+# Name of the stream in use; stored with datasets since the two differ.
+rng_kind = "philox" if np is not None else "mt19937-blake2b"
+
+def proof_rng(dataset_seed: int, index: int):
+    """The random stream of one proof.
+
+    Without NumPy this falls back to a Mersenne Twister seeded from a hash of
+    (dataset_seed, index): still random access, but a different stream.
+    """
+    if np is not None:
+        return ProofRandom(dataset_seed, index)
+    return _fallback_random(dataset_seed, index)
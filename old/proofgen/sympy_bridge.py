@@ -0,0 +1,142 @@
+from fractions import Fraction
+from typing import Iterable, List, Set, Tuple
+import argparse
+import random
+
+import sympy as sp
+
+from rewrite import (BinaryOp, Expression, ExpressionPrinter, Number, ProofGenerator, Rule, UnaryOp, Undefined,
+                     Variable, leaf, number, undefined)
+
+# Conversion between unevaluated SymPy expressions and the proofgen AST.
+#
+# SymPy is only needed at the edges: parsing input, checking that the end of
+# a walk still equals its start, and LaTeX output.  The walk itself runs in
+# the native engine.  Conversion follows SymPy's own structure, so a - b is
+# Add(a, Mul(-1, b)) and a / b is Mul(a, Pow(b, -1)) in both directions;
+# Add and Mul with more than two arguments become left-leaning chains.
+
+functions = {sp.sin: "sin", sp.cos: "cos", sp.tan: "tan", sp.exp: "exp", sp.log: "log"}
+
+def from_sympy(expr: sp.Basic) -> Expression:
+    if isinstance(expr, sp.Wild):
+        if expr.exclude or expr.properties:
+            raise ValueError(f"wildcard {expr} has constraints the native engine cannot express")
+        return Variable(expr.name)
+    elif isinstance(expr, sp.Symbol):
+        return leaf(Variable, expr.name)
+    elif isinstance(expr, sp.Integer):
+        return number(int(expr))
+    elif expr is sp.nan or expr is sp.zoo:
+        return undefined
+    elif isinstance(expr, sp.Rational):
+        return number(Fraction(int(expr.p), int(expr.q)))
+    elif isinstance(expr, sp.Float):
+        return leaf(Number, float(expr))
+    elif isinstance(expr, (sp.Add, sp.Mul)):
+        op = "+" if isinstance(expr, sp.Add) else "*"
+        args = [from_sympy(arg) for arg in expr.args]
+        result = args[0]
+        for arg in args[1:]:
+            result = BinaryOp(op, result, arg)
+        return result
+    elif isinstance(expr, sp.Pow):
+        return BinaryOp("^", from_sympy(expr.base), from_sympy(expr.exp))
+    elif expr.func in functions and len(expr.args) == 1:
+        return UnaryOp(functions[expr.func], from_sympy(expr.args[0]))
+    raise ValueError(f"cannot convert {type(expr).__name__} expression {expr}")
+
+def to_sympy(expr: Expression, wilds: Set[str] = frozenset()) -> sp.Basic:
+    """The unevaluated SymPy form of `expr`; variables named in `wilds` become sp.Wild."""
+    if isinstance(expr, Number):
+        if isinstance(expr.value, float):
+            return sp.Float(expr.value)
+        return sp.Rational(expr.value.numerator, expr.value.denominator)
+    elif isinstance(expr, Undefined):
+        return sp.nan
+    elif isinstance(expr, Variable):
+        return sp.Wild(expr.name) if expr.name in wilds else sp.Symbol(expr.name)
+    elif isinstance(expr, BinaryOp):
+        left, right = to_sympy(expr.left, wilds), to_sympy(expr.right, wilds)
+        if expr.op == "+":
+            return sp.Add(left, right, evaluate=False)
+        elif expr.op == "-":
+            return sp.Add(left, sp.Mul(-1, right, evaluate=False), evaluate=False)
+        elif expr.op == "*":
+            return sp.Mul(left, right, evaluate=False)
+        elif expr.op == "/":
+            return sp.Mul(left, sp.Pow(right, -1, evaluate=False), evaluate=False)
+        elif expr.op == "^":
+            return sp.Pow(left, right, evaluate=False)
+    elif isinstance(expr, UnaryOp):
+        operand = to_sympy(expr.expr, wilds)
+        if expr.op == "-":
+            return sp.Mul(-1, operand, evaluate=False)
+        return getattr(sp, expr.op)(operand, evaluate=False)
+    raise ValueError(f"cannot convert {expr} to SymPy")
+
+def parse(text: str) -> Expression:
+    return from_sympy(sp.parse_expr(text, evaluate=False))
+
+def verify(start: Expression, end: Expression) -> bool:
+    """Whether SymPy can show that two expressions are equal."""
+    # doit() re-evaluates the unevaluated trees; simplify() trips over forms such as a*0 otherwise.
+    return sp.simplify((to_sympy(start) - to_sympy(end)).doit()) == 0
+
+def to_latex(expr: Expression) -> str:
+    return sp.latex(to_sympy(expr))
+
+def rules_from_sympy(pairs: Iterable[Tuple]) -> List[Rule]:
+    """Native rules from (pattern, replacement) pairs written with sp.Wild, as in algebra.ipynb."""
+    rules = []
+    for pattern, replacement in pairs:
+        pattern, replacement = sp.sympify(pattern), sp.sympify(replacement)
+        rules.append(Rule(f"{pattern} -> {replacement}", from_sympy(pattern), from_sympy(replacement)))
+    return rules
+
+def notebook_rules() -> List[Tuple]:
+    """The `rules` list of algebra.ipynb."""
+    x, y, z = sp.symbols("x y z")
+    a = sp.Wild("a")
+    return [
+        (sp.Add(a, -a, evaluate=False), 0),
+        (a, sp.Add(a, sp.Integer(0), evaluate=False)),
+        (a, sp.Mul(a, sp.Integer(1), evaluate=False)),
+        (sp.Integer(0), sp.Mul(a, 0, evaluate=False)),
+        (sp.Add(a, sp.Mul(-1, 0, evaluate=False), evaluate=False), a),
+        (2 * a, sp.Add(a, a, evaluate=False)),
+        (1, sp.sin(x) ** 2 + sp.cos(x) ** 2),
+        (1, sp.sin(y) ** 2 + sp.cos(y) ** 2),
+        (1, sp.sin(z) ** 2 + sp.cos(z) ** 2),
+    ]
+
+def sympy_rewrite(expr: sp.Basic, rules: List[Tuple], steps: int, rng: random.Random,
+                  max_tries: int = 1000) -> Tuple[sp.Basic, int]:
+    """The random rewriting loop of algebra.ipynb; returns the result and the steps taken."""
+    taken = 0
+    while taken < steps and max_tries > 0:
+        pattern, replacement = rng.choice(rules)
+        max_tries -= 1
+        expr, mapping = expr.replace(pattern, replacement, simultaneous=False, map=True)
+        if mapping:
+            taken += 1
+    return expr, taken
+
+def main():
+    parser = argparse.ArgumentParser(description="Random rewriting of a SymPy expression in the native engine.")
+    parser.add_argument("expression", help="e.g. '3*(x+1) + sin(x)**2'")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    printer = ExpressionPrinter()
+    start = parse(args.expression)
+    proof = ProofGenerator(rules_from_sympy(notebook_rules())).random_walk(start, args.steps,
+                                                                           random.Random(args.seed))
+    for name, expr, _ in proof:
+        print(f"{name}: {printer.to_string(expr)}")
+    print(f"LaTeX: {to_latex(proof[-1][1])}")
+    print(f"equal to the start: {verify(start, proof[-1][1])}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+from check import check_record
+from generate import generate_proof, proof_to_record
+
+def record(form: str = "binary") -> dict:
+    return dict(proof_to_record(generate_proof(7, 3, 3, 10, form=form)), form=form)
+
+def test_generated_records_check():
+    for form in ("binary", "nary"):
+        assert check_record(record(form), strict=True) is None
+
+def test_theorem_must_start_from_first_step():
+    changed = record()
+    changed["theorem"][0] = "(" + changed["theorem"][0] + " + 1)"
+    assert check_record(changed) == "theorem does not start from the first step"
@@ -0,0 +1,10 @@
+from rewrite import BinaryOp, number
+from latex import to_latex
+
+def test_small_float_uses_a_power_of_ten():
+    assert to_latex(number(1e-05)) == "1 \\times 10^{-5}"
+    assert to_latex(BinaryOp("^", number(1e-05), number(2))) == "\\left(1 \\times 10^{-5}\\right)^{2}"
+
+def test_float_rounding_noise_is_hidden():
+    assert to_latex(number(0.1 + 0.2)) == "0.3"
+    assert to_latex(number(-2.5)) == "-2.5"
@@ -0,0 +1,16 @@
+from nary import CollectLikeTerms, flatten, nary_rules
+from rewrite import number, parse_expression
+
+collect = next(rule for rule in nary_rules if isinstance(rule, CollectLikeTerms))
+
+def collected(text: str):
+    expr = flatten(parse_expression(text))
+    bindings = {}
+    assert collect.match(expr, collect.pattern, bindings)
+    return collect.instantiate(collect.replacement, bindings)
+
+def test_all_constant_chain_folds_to_a_number():
+    assert collected("((1 + 1) + 1)") == number(3)
+
+def test_constants_collect_next_to_like_terms():
+    assert collected("(((2 + x) + 3) + (2 * x))") == flatten(parse_expression("(5 + (3 * x))"))